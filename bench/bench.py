@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+#
+# Benchmark the dump pipeline of dbdump. Please see the README file in this directory for how to
+# use this script. You might also try calling this program with '--help'.
+#
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DBDUMP = os.path.join(os.path.dirname(BENCH_DIR), 'dbdump', 'dbdump.py')
+COMMANDS = {'zstd': 'zstd', 'lz4': 'lz4', 'xz': 'xz'}  # codecs that need an external command
+GPG_USER = 'dbdump-bench@example.invalid'
+
+
+def err(msg, *args):
+    print(msg % args, file=sys.stderr)
+
+
+def split(value):
+    return [v for v in value.split(',') if v]
+
+
+parser = argparse.ArgumentParser(
+    description="Benchmark dbdump with stand-ins for the database tools.")
+parser.add_argument('--backend', type=split, default=['postgresql'], metavar='NAME[,NAME...]',
+                    help="Backends to benchmark: mysql, postgresql, ejabberd (default: %(default)s).")
+parser.add_argument('--compression', type=split, default=['gzip', 'zstd', 'lz4', 'none'],
+                    metavar='CODEC[,CODEC...]',
+                    help="Compressions to benchmark (default: %(default)s).")
+parser.add_argument('--compression-threads', type=split, default=['0'], metavar='N[,N...]',
+                    help="Values for compression-threads (default: %(default)s).")
+parser.add_argument('--parallel', type=split, default=['1', '4'], metavar='N[,N...]',
+                    help="Number of concurrent dumps (default: %(default)s).")
+parser.add_argument('--jobs', type=split, default=['0'], metavar='N[,N...]',
+                    help="Values for mysql-jobs/postgresql-jobs (default: %(default)s).")
+parser.add_argument('--storage', type=split, default=['file'], metavar='STORAGE[,STORAGE...]',
+                    help="Storages to benchmark: file, dedup (default: %(default)s).")
+parser.add_argument('--gpg', action='store_true', default=False,
+                    help="Also benchmark encrypted dumps, using a temporary key.")
+parser.add_argument('--remote', action='store_true', default=False,
+                    help="Also benchmark dumps to a remote location (see --remote-host).")
+parser.add_argument('--remote-host', metavar='HOST',
+                    help="""Host used with --remote, e.g. localhost with a local sshd. By default,
+                    stand-ins for ssh and rsync run everything locally.""")
+parser.add_argument('--upload-workers', type=split, default=['0'], metavar='N[,N...]',
+                    help="Values for upload-workers with --remote (default: %(default)s).")
+parser.add_argument('--databases', type=int, default=4, metavar='N',
+                    help="Number of databases (default: %(default)s).")
+parser.add_argument('--size', type=int, default=64, metavar='MB',
+                    help="Size of every dump in MB (default: %(default)s).")
+parser.add_argument('--entropy', type=float, default=0.3, metavar='FRACTION',
+                    help="""Fraction (0 to 1) of the dump that is random data, the rest is text
+                    (default: %(default)s).""")
+parser.add_argument('--repeat', type=int, default=1, metavar='N',
+                    help="Run every benchmark N times and keep the fastest run.")
+parser.add_argument('--dir', metavar='PATH',
+                    help="Directory for dumps (default: a temporary directory).")
+parser.add_argument('--output', metavar='FILE', help="Write results as JSON to FILE.")
+parser.add_argument('--baseline', metavar='FILE',
+                    help="Compare results to a file written with --output before.")
+parser.add_argument('--tolerance', type=float, default=10, metavar='PERCENT',
+                    help="""With --baseline, fail if the throughput of any benchmark dropped by
+                    more than PERCENT (default: %(default)s).""")
+parser.add_argument('--verbose', action='store_true', default=False,
+                    help="Show the output of dbdump.")
+args = parser.parse_args()
+
+
+def get_benchmarks():
+    """Get a list of benchmarks as (name, options) tuples."""
+
+    compressions = []
+    for codec in args.compression:
+        if codec in COMMANDS and shutil.which(COMMANDS[codec]) is None:
+            err("Warning: %s: Command not found, skipping compression.", COMMANDS[codec])
+        else:
+            compressions.append(codec)
+
+    destinations = [('local', {})]
+    if args.remote:
+        host = args.remote_host or 'loopback'
+        for workers in args.upload_workers:
+            name = host if workers == '0' else '%s,upload-workers=%s' % (host, workers)
+            destinations.append((name, {'remote': args.remote_host or 'localhost',
+                                        'upload-workers': workers}))
+    encryption = [False, True] if args.gpg else [False]
+
+    benchmarks = []
+    for backend, codec, threads, parallel, jobs, storage, (dest, dest_opts), gpg in \
+            itertools.product(args.backend, compressions, args.compression_threads,
+                              args.parallel, args.jobs, args.storage, destinations, encryption):
+        if storage == 'dedup' and (dest != 'local' or gpg):
+            continue  # not supported by dbdump
+        if jobs != '0' and backend == 'ejabberd':
+            continue
+
+        name = [backend, codec]
+        options = {'backend': backend, 'compression': codec, 'compression-threads': threads,
+                   'parallel': parallel, 'storage': storage, 'delay': '0',
+                   'ejabberd-base-dir': '%(bench-dir)s/ejabberd'}
+        if threads != '0':
+            name.append('threads=%s' % threads)
+        name.append('parallel=%s' % parallel)
+        if jobs != '0':
+            name.append('jobs=%s' % jobs)
+            options['%s-jobs' % backend] = jobs
+        if storage != 'file':
+            name.append(storage)
+        if gpg:
+            name.append('gpg')
+            options['recipient'] = GPG_USER
+        name.append(dest)
+        options.update(dest_opts)
+
+        benchmarks.append(('/'.join(name), options))
+    return benchmarks
+
+
+def make_gpg_home(path):
+    """Create a GnuPG home directory with a key without a passphrase in ``path``."""
+
+    os.mkdir(path, 0o700)
+    cmd = ['gpg', '--batch', '--quiet', '--passphrase', '', '--quick-generate-key', GPG_USER,
+           'default', 'default', 'never']
+    env = dict(os.environ, GNUPGHOME=path)
+    subprocess.check_call(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # Otherwise the first gpg started by dbdump prints the result of this check
+    subprocess.check_call(['gpg', '--batch', '--check-trustdb'], env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def run(name, options, tmpdir, env):
+    """Run dbdump once, returns a dictionary of results."""
+
+    datadir = os.path.join(tmpdir, 'data')
+    for path in [datadir, os.path.join(tmpdir, 'ejabberd'), os.path.join(tmpdir, 'spool')]:
+        shutil.rmtree(path, ignore_errors=True)
+        os.mkdir(path, 0o700)
+
+    metrics = os.path.join(tmpdir, 'metrics.jsonl')
+    if os.path.exists(metrics):
+        os.remove(metrics)
+
+    config = os.path.join(tmpdir, 'dbdump.conf')
+    with open(config, 'w') as stream:
+        stream.write('[bench]\nbench-dir = %s\ndatadir = %s\nspool-dir = %s/spool\n'
+                     'mysql-defaults = %s/my.cnf\nmetrics-file = %s\n'
+                     % (tmpdir, datadir, tmpdir, tmpdir, metrics))
+        for key, value in sorted(options.items()):
+            stream.write('%s = %s\n' % (key, value))
+
+    cmd = [sys.executable, DBDUMP, '-c', config, 'bench']
+    if args.verbose:
+        cmd.insert(2, '--verbose')
+        print('# %s: %s' % (name, ' '.join(cmd)))
+    output = None if args.verbose else subprocess.DEVNULL
+
+    # wait4() returns the resources used by dbdump and all processes it started
+    start = time.time()
+    proc = subprocess.Popen(cmd, env=env, stdout=output)
+    pid, status, usage = os.wait4(proc.pid, 0)
+    duration = time.time() - start
+    proc.returncode = os.WEXITSTATUS(status)
+
+    records = []
+    if os.path.exists(metrics):
+        with open(metrics) as stream:
+            records = [json.loads(line) for line in stream]
+    failed = [r['database'] for r in records if r['status'] != 'dumped']
+    expected = 1 if options['backend'] == 'ejabberd' else args.databases
+    if status != 0 or failed or len(records) != expected:
+        raise Exception('%s: dbdump failed (exit status %s, failed databases: %s).'
+                        % (name, proc.returncode, ', '.join(failed) or 'none'))
+
+    raw = sum(r.get('raw_bytes', 0) for r in records)
+    stored = sum(r.get('bytes', 0) for r in records)
+    stages = {}
+    for record in records:
+        for stage, values in record.get('stages', {}).items():
+            if values.get('cpu') is not None:  # only commands have a CPU time
+                stages[stage] = stages.get(stage, 0) + values['cpu']
+
+    return {
+        'name': name,
+        'duration': round(duration, 3),
+        'throughput': round(raw / duration / 1048576, 1),  # MB/s
+        'cpu': round(usage.ru_utime + usage.ru_stime, 3),
+        'stage_cpu': {stage: round(cpu, 3) for stage, cpu in stages.items()},
+        'max_rss': round(usage.ru_maxrss / 1024, 1),  # MB, of the largest single process
+        'raw_bytes': raw,
+        'bytes': stored,
+        'ratio': round(raw / stored, 2) if stored else None,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print regressions compared to ``baseline``, returns ``False`` if there are any."""
+
+    ok = True
+    previous = {r['name']: r for r in baseline}
+    for result in results:
+        if result['name'] not in previous:
+            continue
+
+        old = previous[result['name']]['throughput']
+        change = (result['throughput'] - old) / old * 100 if old else 0
+        if change < -tolerance:
+            print('REGRESSION: %s: %.1f MB/s instead of %.1f MB/s (%+.1f%%)'
+                  % (result['name'], result['throughput'], old, change))
+            ok = False
+    return ok
+
+
+if args.databases < 1 or args.size < 1 or args.repeat < 1:
+    parser.error("--databases, --size and --repeat must be positive.")
+if not 0 <= args.entropy <= 1:
+    parser.error("--entropy must be between 0 and 1.")
+if args.gpg and shutil.which('gpg') is None:
+    parser.error("gpg: Command not found.")
+
+baseline = None
+if args.baseline:
+    with open(args.baseline) as stream:
+        baseline = json.load(stream)
+
+tmpdir = tempfile.mkdtemp(prefix='dbdump-bench-', dir=args.dir)
+try:
+    # Prefer the stand-ins over any installed tool
+    path = [os.path.join(BENCH_DIR, 'bin')]
+    if args.remote and not args.remote_host:
+        path.append(os.path.join(BENCH_DIR, 'loopback'))
+    env = dict(os.environ, PATH=os.pathsep.join(path + [os.environ.get('PATH', '')]),
+               BENCH_DATABASES=str(args.databases), BENCH_SIZE=str(args.size * 1024 * 1024),
+               BENCH_ENTROPY=str(args.entropy))
+
+    with open(os.path.join(tmpdir, 'my.cnf'), 'w') as stream:
+        stream.write('[client]\nuser = bench\n')
+    os.chmod(os.path.join(tmpdir, 'my.cnf'), 0o600)
+    if args.gpg:
+        env['GNUPGHOME'] = os.path.join(tmpdir, 'gnupg')
+        make_gpg_home(env['GNUPGHOME'])
+
+    print('%-64s %9s %8s %9s %8s %6s' % ('benchmark', 'MB/s', 'CPU (s)', 'RSS (MB)', 'time (s)',
+                                         'ratio'))
+    results = []
+    for name, options in get_benchmarks():
+        runs = [run(name, options, tmpdir, env) for i in range(args.repeat)]
+        result = max(runs, key=lambda r: r['throughput'])
+        results.append(result)
+        print('%-64s %9.1f %8.1f %9.1f %8.1f %6.2f' % (
+            name, result['throughput'], result['cpu'], result['max_rss'], result['duration'],
+            result['ratio'] or 0))
+        sys.stdout.flush()
+except Exception as e:
+    err('Error: %s', e)
+    sys.exit(1)
+finally:
+    shutil.rmtree(tmpdir)
+
+if args.output:
+    with open(args.output, 'w') as stream:
+        json.dump(results, stream, indent=4, sort_keys=True)
+        stream.write('\n')
+if baseline is not None and not compare(results, baseline, args.tolerance):
+    sys.exit(1)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+#
+# Benchmark the retention planner of dbclean. Please see the README file in this directory for how
+# to use this script.
+#
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'dbclean'))
+
+from libclean import retention  # NOQA: E402
+
+parser = argparse.ArgumentParser(description="Benchmark the retention planner of dbclean.")
+parser.add_argument('--databases', type=int, default=10, metavar='N',
+                    help="Number of databases (default: %(default)s).")
+parser.add_argument('--hours', type=int, default=24 * 365, metavar='N',
+                    help="Hourly backups of every database (default: %(default)s).")
+parser.add_argument('--format', default='%Y-%m-%d_%H:%M:%S',
+                    help="Format of timestamps (default: %(default)s).")
+parser.add_argument('--dir', metavar='PATH',
+                    help="Directory for backups (default: a temporary directory).")
+args = parser.parse_args()
+
+tmpdir = tempfile.mkdtemp(prefix='dbclean-bench-', dir=args.dir)
+try:
+    # Every backup consists of a dump and its checksum, all files are empty.
+    now = time.time()
+    for i in range(args.databases):
+        path = os.path.join(tmpdir, 'bench%02d' % i)
+        os.mkdir(path)
+        for hour in range(args.hours):
+            stamp = time.strftime(args.format, time.gmtime(now - hour * 3600))
+            for ext in ['.gz', '.gz.sha256']:
+                open(os.path.join(path, stamp + ext), 'w').close()
+
+    files = removed = 0
+    start = time.time()
+    parser = retention.timestamp_parser(args.format)
+    keep = retention.policy()
+    for name in sorted(os.listdir(tmpdir)):
+        backups, scanned = retention.scan(os.path.join(tmpdir, name), parser)
+        files += scanned
+        removed += sum(len(b.files) for b in keep.plan(backups.values(), now))
+    duration = time.time() - start
+
+    print('Planned %s files in %.3fs (%.0f files/s), %s files would be removed.'
+          % (files, duration, files / max(duration, 0.001), removed))
+    if parser.regex is None:
+        print('Note: %s: Format is parsed with time.strptime().' % args.format)
+finally:
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+#
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+#
+# Stand-ins for the tools called by dbdump, used by bench.py. The files in bin/ and loopback/ are
+# symlinks to this file, the tool to emulate is chosen by the name it is called with.
+#
+# The dump tools write synthetic SQL. Its size and how well it compresses are configured with
+# environment variables:
+#
+#   BENCH_DATABASES  number of databases (named bench00, bench01, ...)
+#   BENCH_SIZE       size of every dump in bytes
+#   BENCH_ENTROPY    fraction (0 to 1) of every row that is random data
+
+import base64
+import os
+import random
+import shutil
+import sys
+
+ROW_LENGTH = 120  # payload of a single row in bytes
+ROWS = 1000  # rows per INSERT statement, so that a statement is roughly 128 KB
+WORDS = b'''lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt
+ut labore et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris
+nisi aliquip ex ea commodo consequat duis aute irure in reprehenderit voluptate velit esse cillum
+eu fugiat nulla pariatur excepteur sint occaecat cupidatat non proident sunt culpa qui officia
+deserunt mollit anim id est laborum'''.split()
+
+
+def get_databases():
+    return ['bench%02d' % i for i in range(int(os.environ.get('BENCH_DATABASES', '4')))]
+
+
+def get_size():
+    return int(os.environ.get('BENCH_SIZE', str(64 * 1024 * 1024)))
+
+
+def get_text(length):
+    """Get ``length`` bytes of text that compresses about as well as natural language."""
+
+    rand = random.Random(0)
+    text = b''
+    while len(text) < length:
+        text += b' '.join(rand.choice(WORDS) for i in range(100)) + b' '
+    return text[:length]
+
+
+def generate(stream, database, size, entropy):
+    """Write ``size`` bytes of a mysqldump-like dump of ``database`` to ``stream``."""
+
+    random_length = int(ROW_LENGTH * entropy)
+    text_length = ROW_LENGTH - random_length
+    text = get_text(1024 * 1024)
+    rand = random.Random(database)
+
+    header = ('-- Dump of synthetic database %s\n\nDROP TABLE IF EXISTS `data`;\n'
+              'CREATE TABLE `data` (`id` int NOT NULL, `payload` text, PRIMARY KEY (`id`));\n\n'
+              % database).encode('ascii')
+    stream.write(header)
+    written = len(header)
+
+    row = 0
+    while written < size:
+        # urandom is random enough to be incompressible, base64 makes it printable
+        data = base64.b64encode(os.urandom(random_length * ROWS * 3 // 4 + 3))
+        rows = []
+        for i in range(ROWS):
+            offset = rand.randrange(len(text) - text_length)
+            rows.append(b"(%d,'%s%s')" % (row + i, text[offset:offset + text_length],
+                                          data[i * random_length:(i + 1) * random_length]))
+        row += ROWS
+
+        statement = b'INSERT INTO `data` VALUES ' + b','.join(rows) + b';\n'
+        statement = statement[:size - written]
+        stream.write(statement)
+        written += len(statement)
+
+
+def dump(database, path=None):
+    entropy = float(os.environ.get('BENCH_ENTROPY', '0.3'))
+    if path is None:
+        generate(sys.stdout.buffer, database, get_size(), entropy)
+    else:
+        with open(path, 'wb') as stream:
+            generate(stream, database, get_size(), entropy)
+
+
+def dump_directory(database, path, jobs):
+    """Dump ``database`` to a directory with ``jobs`` files, like pg_dump -Fd or mydumper."""
+
+    os.makedirs(path)
+    with open(os.path.join(path, 'toc.dat'), 'w') as stream:
+        stream.write('synthetic dump of %s\n' % database)
+
+    entropy = float(os.environ.get('BENCH_ENTROPY', '0.3'))
+    size = get_size() // jobs
+    for i in range(jobs):
+        with open(os.path.join(path, '%s.%05d.sql' % (database, i)), 'wb') as stream:
+            generate(stream, '%s.%s' % (database, i), size, entropy)
+
+
+def get_option(argv, name):
+    return argv[argv.index(name) + 1] if name in argv else None
+
+
+def mysql(argv):
+    query = [a for a in argv if a.startswith('--execute=')][0][10:]
+    if 'information_schema.SCHEMATA' in query:
+        for database in get_databases():
+            print('%s\tInnoDB\t1\t%s\tNULL\t2019-01-01 00:00:00\t%s\t%s'
+                  % (database, get_size(), get_size() // ROW_LENGTH, get_size() // ROW_LENGTH))
+        print('information_schema\tNULL\t0\tNULL\tNULL\tNULL\tNULL\tNULL')
+    elif 'Uptime' in query:
+        print('Uptime\t86400')
+    elif 'VERSION()' in query:
+        print('8.0.33')
+    # SHOW SLAVE STATUS: not a replica
+
+
+def psql(argv):
+    query = argv[argv.index('-c') + 1]
+    for database in get_databases():
+        if 'pg_database_size' in query:
+            print('%s|%s' % (database, get_size()))
+        elif 'pg_stat_database' in query:
+            print('%s|1|0|0||2019-01-01 00:00:00' % database)
+        elif 'pg_is_in_recovery' in query:
+            return  # not a replica
+        else:
+            print(database)
+
+
+def ssh(argv):
+    """Run the remote command locally, ignoring all options and the host name."""
+
+    options_with_argument = ['-o', '-S', '-O', '-p', '-i', '-l', '-F', '-c', '-m']
+    args = argv[1:]
+    while args and args[0].startswith('-'):
+        if args[0] == '-O':  # control command (e.g. "exit") for a master connection
+            return
+        args = args[2:] if args[0] in options_with_argument else args[1:]
+    os.execvp('sh', ['sh', '-c', ' '.join(args[1:])])
+
+
+def rsync(argv):
+    """Copy the files to the directory given as last argument (``host:path/``)."""
+
+    args = []
+    skip = False
+    for arg in argv[1:]:
+        if skip:
+            skip = False
+        elif arg in ['-e', '--rsync-path']:
+            skip = True
+        elif not arg.startswith('-'):
+            args.append(arg)
+
+    dest = args[-1].split(':', 1)[1]
+    os.makedirs(dest, 0o700, exist_ok=True)
+    for path in args[:-1]:
+        shutil.copy(path, dest)
+
+
+def main(argv):
+    name = os.path.basename(argv[0])
+    if name in ['mysqldump', 'pg_dump'] and '-f' not in argv:
+        dump(argv[-1])
+    elif name == 'pg_dump':
+        dump_directory(argv[-1], get_option(argv, '-f'), int(get_option(argv, '-j')))
+    elif name == 'mydumper':
+        dump_directory(get_option(argv, '--database'), get_option(argv, '--outputdir'),
+                       int(get_option(argv, '--threads')))
+    elif name == 'pg_dumpall':
+        print('CREATE ROLE bench;')
+    elif name == 'ejabberdctl':
+        dump('ejabberd', argv[-1])
+    elif name == 'mysql':
+        mysql(argv)
+    elif name == 'psql':
+        psql(argv)
+    elif name == 'ssh':
+        ssh(argv)
+    elif name == 'rsync':
+        rsync(argv)
+    else:
+        print('%s: Unknown tool.' % name, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -20,11 +20,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
-import calendar
+import collections
 import configparser
 import os
 import sys
-import time
+import threading
+
+from libclean import clean
 
 
 def err(msg, *args):
@@ -44,137 +46,133 @@ parser.add_argument(
     '-c', '--config', type=str, dest='config', action='append',
     default=config_file, help="""Additional config-files to use (default: %(default)s). Can be
         given multiple times to name multiple config-files.""")
-parser.add_argument('section', action='store', type=str, help="Section in the config-file to use.")
+parser.add_argument('--dry-run', action='store_true', default=False,
+                    help="Only print the files that would be removed.")
+parser.add_argument('--reconcile', action='store_true', default=False,
+                    help="""Update the catalog with the backups found in datadir instead of
+                    removing backups.""")
+parser.add_argument('--all', action='store_true', default=False,
+                    help="Clean all sections in the config-files.")
+parser.add_argument('--workers', type=int, default=1, metavar='N',
+                    help="Clean up to N sections at the same time (default: %(default)s).")
+parser.add_argument('sections', nargs='*', metavar='section',
+                    help="Sections in the config-file to use.")
 args = parser.parse_args()
 
-if args.section == 'DEFAULT':
-    parser.error("--section must not be 'DEFAULT'.")
-
-config = configparser.SafeConfigParser({
-    'format': '%%Y-%%m-%%d_%%H:%%M:%%S',
-    'hourly': '24', 'daily': '31',
-    'monthly': '12', 'yearly': '3',
-    'last': '3',
-})
+config = configparser.SafeConfigParser(clean.DEFAULTS)
 if not config.read(args.config):
     parser.error("No config-files could be read.")
 
-# check validity of config-file:
-if args.section not in config:
-    err("Error: %s: No section found with that name.", args.section)
-    sys.exit(1)
-if 'datadir' not in config[args.section]:
-    err("Error: %s: Section does not contain option 'datadir'.", args.section)
-    sys.exit(1)
-
-# get directory containing backups:
-datadir = config.get(args.section, 'datadir')
-
-# check that given directory exists and is a directory:
-if not os.path.exists(datadir):
-    err("Error: %s: No such directory.", datadir)
-    sys.exit(1)
-elif not os.path.isdir(datadir):
-    err("Error: %s: Not a directory.", datadir)
-    sys.exit(1)
-
-timeformat = config[args.section]['format']
-hourly = int(config[args.section]['hourly'])
-daily = int(config[args.section]['daily'])
-monthly = int(config[args.section]['monthly'])
-yearly = int(config[args.section]['yearly'])
-last = int(config[args.section]['last'])
-now = time.time()
-
-
-class backup():
-    files = []
-
-    def __init__(self, time, base, file):
-        self.time = time
-        self.base = base
-        self.files = [file]
-
-    def add(self, file):
-        self.files.append(file)
-
-    def is_daily(self):
-        if self.time.tm_hour == 0:
-            return True
-        else:
-            return False
-
-    def is_monthly(self):
-        if self.is_daily() and self.time.tm_mday == 1:
-            return True
-        else:
-            return False
-
-    def is_yearly(self):
-        if self.is_monthly() and self.time.tm_mon == 1:
-            return True
-        else:
-            return False
-
-    def remove(self):
-        for file in self.files:
-            os.remove(file)
-
-    def __str__(self):
-        return "%s in %s" % (self.files, self.base)
-
-
-# loop through each dir in datadir
-for dir in os.listdir(datadir):
-    if dir.startswith('.'):
-        # skip hidden directories
-        continue
-    if dir == 'lost+found':
-        continue
-
-    fullpath = os.path.normpath(datadir + '/' + dir)
-    if not os.path.isdir(fullpath):
-        print("Warning: %s: Not a directory." % fullpath)
-        continue
-    os.chdir(fullpath)
-
-    backups = {}
-
-    files = os.listdir('.')
-    files.sort()
-
-    for file in files:
-        filestamp = file.split('.')[0]
-        timestamp = ''
-        try:
-            timestamp = time.strptime(filestamp, timeformat)
-        except ValueError as e:
-            print('%s: %s' % (file, e))
-            continue
-
-        if timestamp not in list(backups.keys()):
-            backups[timestamp] = backup(timestamp, fullpath, file)
-        else:
-            backups[timestamp].add(file)
 
-    backup_items = sorted(backups.items(), key=lambda t: t[0])
-    if last:  # NOTE: if last == 0, the slice returns an empty list!
-        backup_items = backup_items[:-last]
+def get_cleaner(name):
+    """Get a :py:class:`~libclean.clean.cleaner` for the section called ``name``, exits if it is
+    not valid."""
 
-    for stamp, bck in backup_items:
-        bck = backups[stamp]
-        bck_seconds = calendar.timegm(stamp)
+    if name == 'DEFAULT':
+        parser.error("--section must not be 'DEFAULT'.")
 
-        if bck_seconds > now - (hourly * 3600):
-            continue
+    # check validity of config-file:
+    if name not in config:
+        err("Error: %s: No section found with that name.", name)
+        sys.exit(1)
+    if 'datadir' not in config[name]:
+        err("Error: %s: Section does not contain option 'datadir'.", name)
+        sys.exit(1)
 
-        if bck.is_daily() and bck_seconds > now - (daily * 86400):
-            continue
+    # get directory containing backups:
+    datadir = config.get(name, 'datadir')
 
-        if bck.is_monthly() and bck_seconds > now - (monthly * 2678400):
-            continue
+    # check that given directory exists and is a directory:
+    if not os.path.exists(datadir):
+        err("Error: %s: No such directory.", datadir)
+        sys.exit(1)
+    elif not os.path.isdir(datadir):
+        err("Error: %s: Not a directory.", datadir)
+        sys.exit(1)
 
-        if bck.is_yearly() and bck_seconds > now - (yearly * 31622400):
-            continue
-
-        bck.remove()
+    backup_catalog = None
+    if config[name]['catalog']:
+        try:
+            from libdump import catalog
+        except ImportError:
+            err("Error: The catalog option requires libdump (see dbdump/setup.py).")
+            sys.exit(1)
+        backup_catalog = catalog.catalog(config[name]['catalog'])
+    elif args.reconcile:
+        parser.error("--reconcile requires the catalog option.")
+
+    return clean.cleaner(name, config[name], catalog=backup_catalog, dry_run=args.dry_run)
+
+
+def run(cleaners, workers):
+    """Run ``cleaners`` with up to ``workers`` threads.
+
+    Sections with a datadir on the same filesystem are limited to destination-parallel
+    concurrent cleanups, so that several sections do not overload the same disks.
+    """
+
+    limits = {}
+    for cleaner in cleaners:
+        limit = int(cleaner.section['destination-parallel'])
+        if limit:  # sections on the same filesystem might set different limits, use the lowest
+            limits[cleaner.device] = min(limits.get(cleaner.device, limit), limit)
+
+    pending = list(cleaners)
+    running = collections.Counter()
+    cond = threading.Condition()
+    failed = []
+
+    def get_cleaner():
+        with cond:
+            while pending:
+                for i, cleaner in enumerate(pending):
+                    if running[cleaner.device] < limits.get(cleaner.device, len(cleaners)):
+                        running[cleaner.device] += 1
+                        return pending.pop(i)
+                cond.wait()
+
+    def worker():
+        while True:
+            cleaner = get_cleaner()
+            if cleaner is None:
+                return
+            try:
+                if args.reconcile:
+                    cleaner.reconcile()
+                else:
+                    cleaner.run()
+            except Exception as e:
+                err("Error: %s: %s", cleaner.name, e)
+                failed.append(cleaner)
+            finally:
+                with cond:
+                    running[cleaner.device] -= 1
+                    cond.notify_all()
+
+    threads = [threading.Thread(target=worker) for i in range(min(max(workers, 1),
+                                                                  len(cleaners)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return not failed
+
+
+names = config.sections() if args.all else args.sections
+if not names:
+    parser.error("Name sections to clean or use --all.")
+cleaners = [get_cleaner(name) for name in names]
+ok = run(cleaners, args.workers)
+
+if not args.dry_run and not args.reconcile:
+    # sections might share the same textfile, so every file is written once with all sections
+    textfiles = collections.OrderedDict()
+    for cleaner in cleaners:
+        if cleaner.section['metrics-textfile'] and 'duration_seconds' in cleaner.stats:
+            textfiles.setdefault(cleaner.section['metrics-textfile'], []).append(
+                (cleaner.name, cleaner.stats))
+    for textfile, results in textfiles.items():
+        clean.write_textfile(textfile, results)
+
+if not ok:
+    sys.exit(1)
@@ -0,0 +1,265 @@
+# This file is part of dbclean (https://github.com/mathiasertl/db-backup).
+#
+# dbclean is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbclean is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbclean. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import datetime
+import json
+import os
+import time
+
+from libclean import retention
+
+# Default values of all options of a section in the config-file of dbclean.
+DEFAULTS = {
+    'format': '%%Y-%%m-%%d_%%H:%%M:%%S',
+    'hourly': '24', 'daily': '31',
+    'monthly': '12', 'yearly': '3',
+    'last': '3',
+    'metrics-file': '', 'metrics-textfile': '',
+    'catalog': '',
+    'destination-parallel': '0',
+    'chunk-grace': '24',
+}
+
+
+def write_metrics(section, stats, jsonfile):
+    """Append ``stats`` to ``jsonfile`` as JSON line."""
+
+    record = dict(stats, section=section,
+                  time=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+    with open(jsonfile, 'a') as stream:
+        stream.write('%s\n' % json.dumps(record, sort_keys=True))
+
+
+def write_textfile(textfile, results):
+    """Write the stats of several sections (a list of (section, stats)) to ``textfile`` in the
+    format read by the textfile collector of the Prometheus node exporter."""
+
+    lines = []
+    for key in sorted(set(key for section, stats in results for key in stats)):
+        lines.append('# TYPE dbclean_%s gauge' % key)
+        for section, stats in results:
+            if key in stats:
+                label = 'section="%s"' % section.replace('\\', '\\\\').replace('"', '\\"')
+                lines.append('dbclean_%s{%s} %s' % (key, label, stats[key]))
+    tmp = '%s.%s.tmp' % (textfile, os.getpid())
+    with open(tmp, 'w') as stream:
+        stream.write('\n'.join(lines) + '\n')
+    os.rename(tmp, textfile)
+
+
+class cleaner:
+    """Remove the backups of a section that are no longer kept by its retention policy."""
+
+    def __init__(self, name, section, catalog=None, dry_run=False):
+        self.name = name
+        self.section = section
+        self.catalog = catalog
+        self.datadir = os.path.abspath(section['datadir'])
+        self.chunkdir = os.path.join(self.datadir, '.chunks')
+        self.device = os.stat(self.datadir).st_dev  # see destination-parallel
+        self.timestamps = retention.timestamp_parser(section['format'])
+        self.keep = retention.policy(hourly=int(section['hourly']), daily=int(section['daily']),
+                                     monthly=int(section['monthly']),
+                                     yearly=int(section['yearly']), last=int(section['last']))
+        # Unreferenced chunks of deduplicated dumps are only removed if dbdump did not use them
+        # for this many seconds, see remove_chunk()
+        self.chunk_grace = float(section['chunk-grace']) * 3600
+
+        self.dry_run = dry_run
+        self.now = time.time()
+        self.stats = {'files_scanned': 0, 'files_removed': 0, 'bytes_freed': 0,
+                      'chunks_removed': 0}
+        # removed files, so that chunks only used by them are removed with --dry-run
+        self.removed = set()
+
+    def remove(self, path):
+        """Remove ``path`` (or only print it with ``dry_run``), returns the number of bytes
+        freed."""
+
+        size = os.path.getsize(path)
+        if self.dry_run:
+            print('rm %s # %.1f MB' % (path, size / 1048576))
+        else:
+            os.remove(path)
+        return size
+
+    def get_directories(self):
+        """Get the names of all directories in datadir."""
+
+        for entry in sorted(os.scandir(self.datadir), key=lambda e: e.name):
+            if entry.name.startswith('.'):
+                # skip hidden directories
+                continue
+            if entry.name == 'lost+found':
+                continue
+
+            if not entry.is_dir():
+                print("Warning: %s: Not a directory." % entry.path)
+                continue
+            yield entry.name
+
+    def get_catalog_backups(self):
+        """Get the backups recorded in the catalog as dictionary of lists, with databases as
+        keys."""
+
+        backups = {}
+        for row in self.catalog.backups('', self.datadir):
+            stamp = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=row['time'])
+            bck = retention.backup(stamp, row['timestamp'])
+            bck.files = [os.path.join(self.datadir, row['database'], name)
+                         for name in row['files']]
+            backups.setdefault(row['database'], []).append(bck)
+        return backups
+
+    def reconcile(self):
+        """Update the catalog with the backups actually found in datadir."""
+
+        rows = {(row['database'], row['timestamp']): row
+                for row in self.catalog.backups('', self.datadir)}
+        added = 0
+        for database in self.get_directories():
+            backups, scanned = retention.scan(os.path.join(self.datadir, database),
+                                              self.timestamps)
+            self.stats['files_scanned'] += scanned
+
+            for bck in backups.values():
+                files = sorted(os.path.basename(path) for path in bck.files)
+                row = rows.pop((database, bck.name), None)
+                if row is not None and sorted(row['files']) == files:
+                    continue
+
+                print('# %s: add %s to catalog' % (database, bck.name))
+                added += 1
+                if self.dry_run:
+                    continue
+
+                checksums = None
+                for path in bck.files:
+                    if path.endswith('.sha256'):
+                        with open(path) as stream:
+                            checksums = stream.read()
+
+                row = row or {}
+                self.catalog.add(
+                    location='', datadir=self.datadir, database=database, timestamp=bck.name,
+                    time=bck.seconds, files=files, checksums=checksums, codec=row.get('codec'),
+                    size=sum(os.path.getsize(p) for p in bck.files if not p.endswith('.sha256')),
+                    duration=row.get('duration'))
+
+        for (database, timestamp), row in sorted(rows.items()):
+            print('# %s: remove %s from catalog (no longer exists)' % (database, timestamp))
+            if not self.dry_run:
+                self.catalog.remove('', self.datadir, database, timestamp)
+        print('# %s: %s backups added to the catalog, %s removed.'
+              % (self.name, added, len(rows)))
+
+    def clean(self):
+        """Remove backups that are no longer kept."""
+
+        if self.catalog is None:
+            databases = self.get_directories()
+        else:
+            # only the catalog is read, listing directories with many backups can be slow
+            catalog_backups = self.get_catalog_backups()
+            databases = sorted(catalog_backups)
+
+        for database in databases:
+            if self.catalog is None:
+                backups, scanned = retention.scan(os.path.join(self.datadir, database),
+                                                  self.timestamps)
+                backups = backups.values()
+            else:
+                backups = catalog_backups[database]
+                scanned = sum(len(bck.files) for bck in backups)
+            self.stats['files_scanned'] += scanned
+
+            for bck in self.keep.plan(backups, self.now):
+                for path in sorted(bck.files):
+                    try:
+                        self.stats['bytes_freed'] += self.remove(path)
+                    except FileNotFoundError:  # catalog is out of date
+                        print('Warning: %s: No such file (use --reconcile to update the '
+                              'catalog).' % path)
+                        continue
+                    self.stats['files_removed'] += 1
+                    self.removed.add(path)
+
+                if self.catalog is not None and not self.dry_run:
+                    self.catalog.remove('', self.datadir, database, bck.name)
+
+    def remove_chunks(self):
+        """Remove chunks of deduplicated dumps (see storage=dedup in dbdump) no index refers to
+        anymore."""
+
+        if not os.path.isdir(self.chunkdir):
+            return
+
+        referenced = set()
+        for dir in os.listdir(self.datadir):
+            fullpath = os.path.join(self.datadir, dir)
+            if dir.startswith('.') or not os.path.isdir(fullpath):
+                continue
+            for file in os.listdir(fullpath):
+                path = os.path.join(fullpath, file)
+                if file.endswith('.idx') and path not in self.removed:
+                    with open(path) as stream:
+                        referenced.update(line.strip() for line in stream)
+
+        for prefix in os.listdir(self.chunkdir):
+            for entry in os.scandir(os.path.join(self.chunkdir, prefix)):
+                if entry.name not in referenced and self.remove_chunk(entry.path):
+                    self.stats['chunks_removed'] += 1
+
+    def remove_chunk(self, path):
+        """Remove the chunk at ``path`` unless dbdump used it recently, returns ``True`` if it
+        was removed.
+
+        dbdump touches a chunk instead of writing it again, and writes it again if touching it
+        fails. So the chunk is first renamed and only removed if it was still unused afterwards.
+        If dbdump touched it in the meantime, it is renamed back.
+        """
+
+        limit = self.now - self.chunk_grace
+        try:
+            if os.stat(path).st_mtime >= limit:
+                return False
+            if self.dry_run:
+                self.stats['bytes_freed'] += self.remove(path)
+                return True
+
+            tmp = '%s.%s.remove' % (path, os.getpid())
+            os.rename(path, tmp)
+        except FileNotFoundError:  # removed by a concurrent run
+            return False
+
+        if os.stat(tmp).st_mtime >= limit:
+            os.rename(tmp, path)
+            return False
+        self.stats['bytes_freed'] += self.remove(tmp)
+        return True
+
+    def run(self):
+        """Remove backups and unused chunks, returns the stats of this run."""
+
+        self.clean()
+        self.remove_chunks()
+        if self.dry_run:
+            print('# %s: %s files and %s chunks (%.1f MB) would be removed.'
+                  % (self.name, self.stats['files_removed'], self.stats['chunks_removed'],
+                     self.stats['bytes_freed'] / 1048576))
+            return self.stats
+
+        self.stats['duration_seconds'] = round(time.time() - self.now, 3)
+        if self.section['metrics-file']:
+            write_metrics(self.name, self.stats, self.section['metrics-file'])
+        return self.stats
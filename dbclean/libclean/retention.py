@@ -0,0 +1,199 @@
+# This file is part of dbclean (https://github.com/mathiasertl/db-backup).
+#
+# dbclean is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbclean is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbclean. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import calendar
+import datetime
+import os
+import re
+import time
+
+# Suffixes of files written by dbdump: checksums, gpg, all supported compression codecs, archives
+# of directory dumps and indexes of deduplicated dumps.
+SUFFIXES = ('.sha256', '.gpg', '.gz', '.zst', '.lz4', '.xz', '.tar', '.idx')
+
+# Suffix of the parts of a dump written with split-size
+PART_RE = re.compile(r'\.part[0-9]{4,}$')
+
+# strftime directives understood by :py:class:`timestamp_parser`: (field, regular expression)
+DIRECTIVES = {
+    'Y': ('year', r'\d{4}'),
+    'y': ('year2', r'\d{2}'),
+    'm': ('month', r'\d{1,2}'),
+    'd': ('day', r'\d{1,2}'),
+    'H': ('hour', r'\d{1,2}'),
+    'M': ('minute', r'\d{1,2}'),
+    'S': ('second', r'\d{1,2}'),
+}
+
+
+def get_filestamp(file):
+    """Get the timestamp part of a filename, e.g. '2019-01-01_00:00:00' for
+    '2019-01-01_00:00:00.zst.gpg' or '2019-01-01_00:00:00.zst.gpg.part0003'."""
+    stamp = PART_RE.sub('', file)
+    while stamp.endswith(SUFFIXES):
+        stamp = os.path.splitext(stamp)[0]
+    if stamp == file:  # no known suffix, assume that the timestamp does not contain a dot
+        stamp = stamp.split('.')[0]
+    return stamp
+
+
+def compile_format(format):
+    """Compile a strftime format to a regular expression, ``None`` if it is not supported."""
+
+    pattern = ''
+    fields = set()
+    i = 0
+    while i < len(format):
+        char = format[i]
+        if char == '%' and i + 1 < len(format):
+            directive = format[i + 1]
+            i += 2
+            if directive == '%':
+                pattern += '%'
+                continue
+            elif directive not in DIRECTIVES or DIRECTIVES[directive][0] in fields:
+                return None
+
+            field, regex = DIRECTIVES[directive]
+            fields.add(field)
+            pattern += '(?P<%s>%s)' % (field, regex)
+        elif char.isspace():  # like strptime(), match any amount of whitespace
+            pattern += r'\s+'
+            i += 1
+        else:
+            pattern += re.escape(char)
+            i += 1
+
+    if 'year' in fields and 'year2' in fields:
+        return None
+    return re.compile(pattern + '$')
+
+
+class timestamp_parser:
+    """Parse timestamps in filenames, much faster than time.strptime().
+
+    The format is compiled to a regular expression once. Formats using directives other than
+    those in :py:data:`DIRECTIVES` are parsed with time.strptime() instead.
+    """
+
+    def __init__(self, format):
+        self.format = format
+        self.regex = compile_format(format)
+
+    def parse(self, stamp):
+        """Parse ``stamp``, returns a naive datetime in UTC or raises ``ValueError``."""
+
+        if self.regex is None:
+            return datetime.datetime(*time.strptime(stamp, self.format)[:6])
+
+        match = self.regex.match(stamp)
+        if match is None:
+            raise ValueError('time data %r does not match format %r' % (stamp, self.format))
+        values = match.groupdict()
+
+        if 'year2' in values:  # same as strptime(): 69-99 are 1969-1999, 0-68 are 2000-2068
+            year = int(values['year2'])
+            year += 1900 if year >= 69 else 2000
+        else:
+            year = int(values.get('year', 1900))
+        return datetime.datetime(year, int(values.get('month', 1)), int(values.get('day', 1)),
+                                 int(values.get('hour', 0)), int(values.get('minute', 0)),
+                                 int(values.get('second', 0)))
+
+
+class backup:
+    """All files of a single backup (e.g. the dump and its checksum).
+
+    ``time`` is a naive datetime in UTC, ``name`` the timestamp as used in filenames.
+    """
+
+    def __init__(self, time, name=None):
+        self.time = time
+        self.name = name
+        self.seconds = calendar.timegm(time.timetuple())
+        self.files = []
+
+    def is_daily(self):
+        return self.time.hour == 0
+
+    def is_monthly(self):
+        return self.is_daily() and self.time.day == 1
+
+    def is_yearly(self):
+        return self.is_monthly() and self.time.month == 1
+
+    def __str__(self):
+        return '%s' % self.files
+
+
+def scan(path, parser):
+    """Get the backups in the directory ``path`` as dictionary with the timestamp as key.
+
+    Also returns the number of files found. Hidden files (e.g. partial uploads of dbdump) are
+    ignored, files with a name that cannot be parsed are reported and ignored as well.
+    """
+
+    backups = {}
+    scanned = 0
+    for entry in os.scandir(path):
+        scanned += 1
+        if entry.name.startswith('.'):
+            continue
+
+        name = get_filestamp(entry.name)
+        try:
+            stamp = parser.parse(name)
+        except ValueError as e:
+            print('%s: %s' % (entry.name, e))
+            continue
+
+        bck = backups.get(stamp)
+        if bck is None:
+            bck = backups[stamp] = backup(stamp, name)
+        bck.files.append(entry.path)
+    return backups, scanned
+
+
+class policy:
+    """Decide which backups to keep.
+
+    Backups are kept for ``hourly`` hours, backups made at midnight for ``daily`` days, backups
+    made at midnight of the first day of a month for ``monthly`` months and backups made at
+    midnight of the first of January for ``yearly`` years. The ``last`` backups are always kept.
+    """
+
+    def __init__(self, hourly=24, daily=31, monthly=12, yearly=3, last=3):
+        self.hourly = hourly
+        self.daily = daily
+        self.monthly = monthly
+        self.yearly = yearly
+        self.last = last
+
+    def keep(self, bck, now):
+        if bck.seconds > now - (self.hourly * 3600):
+            return True
+        if bck.is_daily() and bck.seconds > now - (self.daily * 86400):
+            return True
+        if bck.is_monthly() and bck.seconds > now - (self.monthly * 2678400):
+            return True
+        if bck.is_yearly() and bck.seconds > now - (self.yearly * 31622400):
+            return True
+        return False
+
+    def plan(self, backups, now):
+        """Get the list of backups to remove (oldest first) from a list of backups."""
+
+        backups = sorted(backups, key=lambda b: b.time)
+        if self.last:  # NOTE: if last == 0, the slice returns an empty list!
+            backups = backups[:-self.last]
+        return [bck for bck in backups if not self.keep(bck, now)]
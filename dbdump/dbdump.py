@@ -20,12 +20,17 @@
 import argparse
 import configparser
 import os
+import signal
 import sys
+import threading
 import time
 
-from libdump import ejabberd
-from libdump import mysql
-from libdump import postgresql
+from libdump import catalog
+from libdump import compress
+from libdump import conf
+from libdump import daemon
+from libdump import metrics
+from libdump import scheduler
 
 
 def err(msg, *args):
@@ -33,6 +38,7 @@ def err(msg, *args):
 
 
 config_file = ['/etc/dbdump/dbdump.conf', os.path.expanduser('~/.dbdump.conf')]
+clean_config_file = ['/etc/dbclean/dbclean.conf', os.path.expanduser('~/.dbclean.conf')]
 
 parser = argparse.ArgumentParser(description="Dump databases to a specified directory.")
 parser.add_argument('--version', action='version', version="%(prog)s 1.1")
@@ -42,77 +48,240 @@ parser.add_argument(
             name multiple config-files.""")
 parser.add_argument('--verbose', action='store_true', default=False,
                     help="Print all called commands to stdout.")
-parser.add_argument('section', action='store', type=str,
-                    help="Section in the config-file to use.")
+parser.add_argument('--all', action='store_true', default=False,
+                    help="Dump all sections in the config-files.")
+parser.add_argument('--workers', type=int, default=0, metavar='N',
+                    help="""Dump up to N databases at the same time across all sections (default:
+                    the largest value of parallel).""")
+parser.add_argument('--daemon', action='store_true', default=False,
+                    help="""Keep running and dump every section at the interval configured in
+                    the config-file.""")
+parser.add_argument('--status-file', metavar='PATH',
+                    help="With --daemon, write the state of all sections to PATH as JSON.")
+parser.add_argument(
+    '--clean-config', action='append', default=clean_config_file, metavar='PATH',
+    help="""Additional config-files of dbclean, read for the clean option (default:
+            %(default)s).""")
+parser.add_argument('sections', nargs='*', metavar='section',
+                    help="Sections in the config-file to use.")
 args = parser.parse_args()
 
-if args.section == 'DEFAULT':
-    parser.error("--section must not be 'DEFAULT'.")
-
-config = configparser.ConfigParser({
-    'format': '%%Y-%%m-%%d_%%H:%%M:%%S',
-    'datadir': '/var/backups/%(backend)s',
-    'mysql-ignore-tables': '',
-    'ejabberd-base-dir': '/var/lib/ejabberd',
-    'ejabberd-options': '--no-timeout',  # https://github.com/processone/ejabberd/issues/866
-    'ssh-timeout': '10',
-    'ssh-options': '',
-})
+config = configparser.ConfigParser(conf.DEFAULTS)
 if not config.read(args.config):
     parser.error("No config-files could be read.")
 
-# check validity of config-file:
-if args.section not in config:
-    err("Error: %s: No section found with that name.", args.section)
-    sys.exit(1)
-if 'datadir' not in config[args.section]:
-    err("Error: %s: Section does not contain option 'datadir'.", args.section)
-    sys.exit(1)
 
-section = config[args.section]
+def check_section(name):
+    """Get the section called ``name``, exits if it is not valid."""
+
+    if name == 'DEFAULT':
+        parser.error("--section must not be 'DEFAULT'.")
+    if name not in config:
+        err("Error: %s: No section found with that name.", name)
+        sys.exit(1)
+    if 'datadir' not in config[name]:
+        err("Error: %s: Section does not contain option 'datadir'.", name)
+        sys.exit(1)
+
+    section = config[name]
+
+    if 'remote' not in section:
+        # Note that if we dump to a remote location, there is no real way to check to check if
+        # datadir exists and is writeable. We have to rely on the competence of the admin in that
+        # case.
+        datadir = section['datadir']
+        if not os.path.exists(datadir):
+            print("Error: %s: Does not exist." % datadir, sys.stderr)
+            sys.exit(1)
+        elif not os.path.isdir(datadir):
+            print("Error: %s: Not a directory." % datadir, sys.stderr)
+            sys.exit(1)
+        elif not os.access(datadir, (os.R_OK | os.W_OK | os.X_OK)):
+            print("Error: %s: Permission denied." % datadir, sys.stderr)
+            sys.exit(1)
 
-if 'remote' not in section:
-    # Note that if we dump to a remote location, there is no real way to check to check if datadir
-    # exists and is writeable. We have to rely on the competence of the admin in that case.
-    datadir = section['datadir']
-    if not os.path.exists(datadir):
-        print("Error: %s: Does not exist." % datadir, sys.stderr)
+    if section['skip-unchanged'] not in ['no', 'skip', 'link']:
+        err("Error: %s: skip-unchanged must be one of no, skip or link.",
+            section['skip-unchanged'])
+        sys.exit(1)
+    if 'remote' in section and section.getint('split-size') and \
+            not section.getint('upload-workers'):
+        err("Error: split-size requires upload-workers when dumping to a remote location.")
+        sys.exit(1)
+    if section['storage'] not in ['file', 'dedup']:
+        err("Error: %s: storage must be either file or dedup.", section['storage'])
         sys.exit(1)
-    elif not os.path.isdir(datadir):
-        print("Error: %s: Not a directory." % datadir, sys.stderr)
+    unsupported = [o for o in ['remote', 'sign-key', 'recipient'] if o in section]
+    if section.getint('split-size'):
+        unsupported.append('split-size')
+    if section['storage'] == 'dedup' and unsupported:
+        err("Error: storage=dedup cannot be used with %s.", ', '.join(unsupported))
+        sys.exit(1)
+    if section['compression'] not in compress.CODECS:
+        err("Error: %s: Unknown compression. Supported are: %s", section['compression'],
+            ', '.join(sorted(compress.CODECS)))
+        sys.exit(1)
+    if section.getint('interval') <= 0:
+        err("Error: %s: interval must be a positive number of minutes.", section['interval'])
+        sys.exit(1)
+    if section['start-at']:
+        try:
+            time.strptime(section['start-at'], '%H:%M')
+        except ValueError:
+            err("Error: %s: start-at must be a time of day like 03:30.", section['start-at'])
+            sys.exit(1)
+    if section['clean'] and 'remote' in section:
+        err("Error: clean cannot be used with remote, run dbclean on %s.", section['remote'])
+        sys.exit(1)
+    return section
+
+
+clean_config = None  # config-files of dbclean, read when a section uses the clean option
+clean_stats = {}  # stats of the last run of every section of dbclean, for metrics-textfile
+clean_lock = threading.Lock()
+
+
+def get_clean(section):
+    """Get a function removing old dumps of ``section`` with the retention policy of the section
+    of dbclean named by the clean option, ``None`` if the option is not set."""
+
+    global clean_config
+
+    name = section['clean']
+    if not name:
+        return None
+
+    try:
+        from libclean import clean
+    except ImportError:
+        err("Error: The clean option requires libclean (see the README of dbclean).")
         sys.exit(1)
-    elif not os.access(datadir, (os.R_OK | os.W_OK | os.X_OK)):
-        print("Error: %s: Permission denied." % datadir, sys.stderr)
+
+    if clean_config is None:
+        clean_config = configparser.ConfigParser(clean.DEFAULTS)
+        clean_config.read(args.clean_config)
+    if name not in clean_config or 'datadir' not in clean_config[name]:
+        err("Error: %s: No section with a datadir found in the config-files of dbclean.", name)
         sys.exit(1)
 
-if section['backend'] == "mysql":
-    backend = mysql.mysql(section, args)
-elif section['backend'] == "postgresql":
-    backend = postgresql.postgresql(section, args)
-elif section['backend'] == "ejabberd":
-    backend = ejabberd.ejabberd(section, args)
-else:
-    err("Error: %s. Unknown backend specified. Only mysql, postgresql and ejabberd are supported.",
-        section['backend'])
+    def run():
+        clean_section = clean_config[name]
+        backup_catalog = None
+        if clean_section['catalog']:
+            backup_catalog = catalog.catalog(clean_section['catalog'])
+        try:
+            cleaner = clean.cleaner(name, clean_section, catalog=backup_catalog)
+            stats = cleaner.run()
+        finally:
+            if backup_catalog is not None:
+                backup_catalog.close()
+
+        if args.verbose:
+            print('# %s: removed %s files and %s chunks (%.1f MB)'
+                  % (name, stats['files_removed'], stats['chunks_removed'],
+                     stats['bytes_freed'] / 1048576))
+
+        textfile = clean_section['metrics-textfile']
+        if textfile:  # sections might share the same textfile, it includes all of them
+            with clean_lock:
+                clean_stats[name] = stats
+                clean.write_textfile(textfile, [
+                    (n, s) for n, s in sorted(clean_stats.items())
+                    if clean_config[n]['metrics-textfile'] == textfile])
+    return run
+
+
+def get_limits(section):
+    """Get the limits of concurrent dumps shared with other sections (see scheduler.pool)."""
+
+    destination = 'localhost'
+    if 'remote' in section:
+        destination = section['remote'].rpartition('@')[2]
+    return {
+        ('source', section['source-host']): section.getint('source-parallel'),
+        ('destination', destination): section.getint('destination-parallel'),
+    }
+
+
+names = config.sections() if args.all else args.sections
+if not names:
+    parser.error("Name sections to dump or use --all.")
+if args.status_file and not args.daemon:
+    parser.error("--status-file requires --daemon.")
+sections = [check_section(name) for name in names]
+if len(set((s['nice'], s['ionice']) for s in sections)) > 1:
+    err("Error: nice and ionice must be the same for all sections.")
     sys.exit(1)
+cleans = {section.name: get_clean(section) for section in sections}
 
-databases = backend.get_db_list()
-timestamp = time.strftime(section['format'], time.gmtime())
+dumps = scheduler.pool(args.workers or max(s.getint('parallel') for s in sections))
+
+if args.daemon:
+    jobs = []
+    for section in sections:
+        try:
+            backend = conf.get_backend(section, args)
+        except ValueError as e:
+            err("Error: %s", e)
+            sys.exit(1)
+        jobs.append(daemon.job(backend, limits=get_limits(section), clean=cleans[section.name]))
+
+    jobs[0].backend.set_priority()
+    server = daemon.daemon(jobs, dumps, status_file=args.status_file, verbose=args.verbose)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: server.stop())
+    server.run()
+    sys.exit(0)
+
+now = time.gmtime()
+backends = []
+dumpers = []
+runs = []
+failed = False
+
+for section in sections:
+    try:
+        backend = conf.get_backend(section, args)
+    except ValueError as e:
+        err("Error: %s", e)
+        sys.exit(1)
 
-# finally: loop through the databases and dump them:
-backend.prepare()
-for database in databases:
     try:
-        backend.prepare_db(database)
-        backend.dump(database, timestamp)
-        backend.cleanup_db(database)
-    except RuntimeError as e:
-        print(e)
-        break
+        dumper, databases = scheduler.get_scheduler(backend, now, limits=get_limits(section))
     except Exception as e:
-        print(e)
+        err("Error: %s: %s", section.name, e)
+        failed = True
         continue
-    if database != databases[-1]:
-        time.sleep(3)
 
-backend.cleanup()
+    if dumper.metrics is not None:
+        runs.append(dumper.metrics)
+    dumps.add(dumper, databases)
+    backends.append(backend)
+    dumpers.append(dumper)
+
+# finally: dump the databases (largest first), using up to 'parallel' concurrent dumps per section
+# and up to --workers concurrent dumps in total:
+try:
+    if backends:
+        backends[0].set_priority()
+    for backend in backends:
+        backend.prepare()
+    dumps.run()
+finally:
+    for backend in backends:
+        if not backend.cleanup():
+            failed = True
+    metrics.write_textfiles(runs)
+
+# remove old dumps of sections that were not aborted (see clean):
+for dumper in dumpers:
+    clean = cleans[dumper.backend.section.name]
+    if clean is not None and not dumper.aborted.is_set():
+        try:
+            clean()
+        except Exception as e:
+            err("Error: %s: %s", dumper.backend.section['clean'], e)
+            failed = True
+
+if failed:
+    sys.exit(1)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+#
+# This program restores dumps created by dbdump.py. Please see the README file for how to use this
+# script. You might also try calling this program with '--help'.
+#
+# Copyright 2009-2019 Mathias Ertl <mati@fsinf.at>
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import configparser
+import os
+import sys
+
+from libdump import conf
+from libdump import restore
+
+
+def err(msg, *args):
+    print(msg % args, file=sys.stderr)
+
+
+config_file = ['/etc/dbdump/dbdump.conf', os.path.expanduser('~/.dbdump.conf')]
+
+parser = argparse.ArgumentParser(description="Restore dumps created by dbdump.")
+parser.add_argument('--version', action='version', version="%(prog)s 1.1")
+parser.add_argument(
+    '-c', '--config', action='append', default=config_file,
+    help="""Additional config-files to use (default: %(default)s). Can be given multiple times to
+            name multiple config-files.""")
+parser.add_argument('--verbose', action='store_true', default=False,
+                    help="Print all called commands to stdout.")
+parser.add_argument('--dry-run', action='store_true', default=False,
+                    help="Only print how databases would be restored.")
+parser.add_argument('--list', action='store_true', default=False,
+                    help="List available dumps instead of restoring them.")
+parser.add_argument('--all', action='store_true', default=False,
+                    help="Restore all databases with a dump.")
+parser.add_argument('--timestamp', metavar='TIMESTAMP',
+                    help="Restore the dump made at TIMESTAMP (default: the newest dump).")
+parser.add_argument('--as', dest='target', metavar='NAME',
+                    help="Restore a single database under a different name.")
+parser.add_argument('--output', metavar='DIR',
+                    help="Write decrypted and decompressed dumps to DIR instead of restoring them.")
+parser.add_argument('--verify-first', action='store_true', default=False,
+                    help="Verify the checksums of all dumps before restoring anything.")
+parser.add_argument('--parallel', type=int, default=1, metavar='N',
+                    help="Restore up to N databases at the same time (default: %(default)s).")
+parser.add_argument('--threads', type=int, default=0, metavar='N',
+                    help="""Threads used to decompress a single dump and jobs used to load
+                    directory dumps (default: number of CPUs).""")
+parser.add_argument('section', action='store', type=str,
+                    help="Section in the config-file to use.")
+parser.add_argument('databases', nargs='*', metavar='database',
+                    help="Databases to restore.")
+args = parser.parse_args()
+
+if args.section == 'DEFAULT':
+    parser.error("--section must not be 'DEFAULT'.")
+if bool(args.databases) == args.all and not args.list:
+    parser.error("Name databases to restore or use --all.")
+if args.target and len(args.databases) != 1:
+    parser.error("--as can only be used to restore a single database.")
+if args.output and not os.path.isdir(args.output):
+    parser.error("%s: No such directory." % args.output)
+
+config = configparser.ConfigParser(conf.DEFAULTS)
+if not config.read(args.config):
+    parser.error("No config-files could be read.")
+
+if args.section not in config:
+    err("Error: %s: No section found with that name.", args.section)
+    sys.exit(1)
+
+section = config[args.section]
+try:
+    backend = conf.get_backend(section, args)
+except ValueError as e:
+    err("Error: %s", e)
+    sys.exit(1)
+
+restorer = restore.restorer(backend, threads=args.threads, verbose=args.verbose,
+                            dry_run=args.dry_run)
+if 'remote' in section and section.getboolean('ssh-multiplex'):
+    backend.start_master()
+
+try:
+    databases = args.databases or restorer.get_databases()
+    if args.list:
+        for database in databases:
+            for dump in restorer.get_dumps(database):
+                print('%s %s' % (database, dump.timestamp))
+        sys.exit(0)
+
+    dumps = []
+    for database in databases:
+        try:
+            dumps.append((restorer.find(database, args.timestamp), args.target or database))
+        except Exception as e:
+            err("Error: %s", e)
+            sys.exit(1)
+
+    if args.verify_first:
+        corrupt = False
+        for dump, target in dumps:
+            errors = restorer.verify(dump)
+            if errors:
+                print('CORRUPT: %s: %s' % (dump, '; '.join(errors)))
+                corrupt = True
+            elif args.verbose:
+                print('# %s: OK' % dump)
+        if corrupt:
+            sys.exit(1)
+
+    ok = restorer.run(dumps, parallel=args.parallel, output=args.output)
+    if not args.dry_run:
+        print('# Restored %s.' % restorer.stats())
+    if not ok:
+        sys.exit(1)
+finally:
+    backend.cleanup()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# This program verifies dumps created by dbdump.py using the checksums written along with every
+# dump. Please see the README file for how to use this script. You might also try calling this
+# program with '--help'.
+#
+# Copyright 2009-2019 Mathias Ertl <mati@fsinf.at>
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import configparser
+import os
+import sys
+import time
+
+from libdump import state
+from libdump import verify
+
+
+def err(msg, *args):
+    print(msg % args, file=sys.stderr)
+
+
+config_file = ['/etc/dbdump/dbdump.conf', os.path.expanduser('~/.dbdump.conf')]
+
+parser = argparse.ArgumentParser(description="Verify dumps created by dbdump.")
+parser.add_argument('--version', action='version', version="%(prog)s 1.1")
+parser.add_argument(
+    '-c', '--config', action='append', default=config_file,
+    help="""Additional config-files to use (default: %(default)s). Can be given multiple times to
+            name multiple config-files.""")
+parser.add_argument('--verbose', action='store_true', default=False,
+                    help="Also print dumps that are OK.")
+parser.add_argument('--decode', action='store_true', default=False,
+                    help="Also decrypt and decompress every dump (to /dev/null).")
+parser.add_argument('--since-last-run', action='store_true', default=False,
+                    help="Only verify dumps written since the last run without corrupt dumps.")
+parser.add_argument('--workers', type=int, default=0, metavar='N',
+                    help="Verify N dumps at once (default: number of CPUs).")
+parser.add_argument('section', action='store', type=str,
+                    help="Section in the config-file to use.")
+args = parser.parse_args()
+
+if args.section == 'DEFAULT':
+    parser.error("--section must not be 'DEFAULT'.")
+
+config = configparser.ConfigParser({
+    'datadir': '/var/backups/%(backend)s',
+    'state-dir': '/var/lib/dbdump',
+})
+if not config.read(args.config):
+    parser.error("No config-files could be read.")
+
+if args.section not in config:
+    err("Error: %s: No section found with that name.", args.section)
+    sys.exit(1)
+
+section = config[args.section]
+if 'remote' in section:
+    err("Error: %s: Dumps are stored on %s, run dbverify there.", args.section, section['remote'])
+    sys.exit(1)
+
+datadir = section['datadir']
+if not os.path.isdir(datadir):
+    err("Error: %s: No such directory.", datadir)
+    sys.exit(1)
+
+# The time of the last run is stored in the state directory of dbdump, next to the state of
+# skip-unchanged (which uses the section name as filename).
+verify_state = state.state(os.path.join(section['state-dir'], '%s.verify.json' % args.section))
+since = None
+if args.since_last_run:
+    last = verify_state.get('last-run')
+    if last is not None:
+        since = last['started']
+
+started = time.time()
+verifier = verify.verifier(datadir, workers=args.workers, decode=args.decode,
+                           verbose=args.verbose)
+ok = verifier.run(verifier.find(since=since))
+print('# Verified %s.' % verifier.stats())
+
+if not ok:
+    sys.exit(1)
+
+verify_state.data['last-run'] = {'started': started, 'dumps': verifier.dumps}
+verify_state.save()
@@ -11,4 +11,4 @@
 # You should have received a copy of the GNU General Public License along with dbdump. If not,
 # see <http://www.gnu.org/licenses/>.
 
-__all__ = ['backend', 'mysql', 'postgresql', 'ejabberd']
+__all__ = ['backend', 'mysql', 'postgresql', 'ejabberd', 'scheduler']
@@ -11,10 +11,22 @@
 # You should have received a copy of the GNU General Public License along with dbdump. If not,
 # see <http://www.gnu.org/licenses/>.
 
+import calendar
 import os
 import shlex
-from subprocess import PIPE
-from subprocess import Popen
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from libdump import catalog
+from libdump import compress
+from libdump import dedup
+from libdump import pipeline
+from libdump import sink
+from libdump import throttle
+from libdump import upload
 
 
 class backend:
@@ -27,17 +39,40 @@ class backend:
         else:
             self.gpg = False
 
+        self.spool = {}  # temporary directories created by make_spool()
+        self.control = None  # control socket of the shared SSH connection, see start_master()
+        self.persist = 60  # seconds the shared SSH connection stays open when it is not used
+        self.uploader = None  # uploads dumps written to local disk first, see upload-workers
+        self.split = section.getint('split-size') * 1024 * 1024
+        self.dedup = section['storage'] == 'dedup'
+        self.catalog = None  # records every dump, see catalog
+        if section['catalog']:
+            self.catalog = catalog.catalog(section['catalog'])
+
+        # count bytes passing through the pipeline for metrics:
+        self.count = bool(section['metrics-file'] or section['metrics-textfile'])
+        self.stats = {}
+
+        rate = section.getfloat('rate-limit') * 1024 * 1024
+        check = None
+        if section['max-load'] or section['max-replication-lag']:
+            check = self.is_busy
+        self.throttle = None
+        if rate or check:
+            self.throttle = throttle.throttle(rate, check=check, verbose=args.verbose)
+
+        level = section['compression-level']
+        self.compressor = compress.get_codec(section['compression'],
+                                             level=int(level) if level else None,
+                                             threads=section.getint('compression-threads'))
+
     def make_su(self, cmd):
         if 'su' in self.section:
             cmd = ['su', '-', self.section['su'], '-s',
                    '/bin/bash', '-c', ' '.join(cmd)]
         return cmd
 
-    def get_ssh(self, path, cmds):
-        cmds = [' '.join(cmd) for cmd in cmds]
-        prefix = 'umask 077; mkdir -m 0700 -p %s; ' % os.path.dirname(path)
-        ssh_cmd = prefix + ' | '.join(cmds) + ' > %s.sha256' % path
-
+    def get_ssh_options(self):
         ssh = ['ssh']
         timeout = self.section['ssh-timeout']
         if timeout:
@@ -46,90 +81,516 @@ class backend:
         opts = self.section['ssh-options']
         if opts:
             ssh += shlex.split(opts)
+        if self.control is not None:
+            # If the master connection is gone, ssh just opens a new connection.
+            ssh += ['-S', self.control]
+        return ssh
 
-        ssh += [self.section['remote'], ssh_cmd]
+    def get_ssh_command(self, remote_cmd):
+        return self.get_ssh_options() + [self.section['remote'], remote_cmd]
 
-        return ssh
+    def start_master(self):
+        """Open a single SSH connection that is shared by all dumps of this run.
 
-    def dump(self, db, timestamp):
-        cmd = self.make_su(self.get_command(db))
-        if not cmd:
+        Every dump is sent through this connection as a separate session (see ControlMaster in
+        ssh_config(5)), so the handshake and authentication only happen once. The master exits by
+        itself if it is not used for ``persist`` seconds (a minute by default), even if dbdump is
+        killed.
+        """
+        tmpdir = tempfile.mkdtemp(prefix='dbdump-ssh-')
+        control = os.path.join(tmpdir, 'master')
+        cmd = self.get_ssh_options() + ['-M', '-S', control,
+                                        '-o', 'ControlPersist=%s' % self.persist,
+                                        self.section['remote'], 'true']
+        if self.args.verbose:
+            print('%s # open shared SSH connection' % ' '.join(cmd))
+
+        # stdout must not be a pipe, the master keeps it open in the background.
+        code = subprocess.call(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        if code == 0:
+            self.control = control
+        else:
+            print('Warning: Could not open shared SSH connection (exit code %s), using one '
+                  'connection per dump.' % code, file=sys.stderr)
+            shutil.rmtree(tmpdir)
+
+    def is_master_running(self):
+        if self.control is None:
+            return False
+        cmd = self.get_ssh_options() + ['-O', 'check', self.section['remote']]
+        return subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+    def stop_master(self):
+        if self.control is None:
             return
 
-        dirname = os.path.abspath(os.path.join(self.base, db))
-        path = os.path.join(dirname, '%s.gz' % timestamp)
+        cmd = self.get_ssh_options() + ['-O', 'exit', self.section['remote']]
+        if self.args.verbose:
+            print('%s # close shared SSH connection' % ' '.join(cmd))
+        subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(os.path.dirname(self.control), ignore_errors=True)
+        self.control = None
+
+    def get_ssh(self, path, cmds):
+        cmds = [' '.join(cmd) for cmd in cmds]
+        prefix = 'umask 077; mkdir -m 0700 -p %s; ' % os.path.dirname(path)
+        ssh_cmd = prefix + ' | '.join(cmds) + ' > %s.sha256' % path
+        return self.get_ssh_command(ssh_cmd)
+
+    def remove_remote(self, path):
+        """Remove a (partial) dump and its checksum from the remote location."""
+        cmd = self.get_ssh_command('rm -f %s %s' % (shlex.quote(path), shlex.quote(path + '.sha256')))
+        if self.args.verbose:
+            print('%s # remove partial dump' % ' '.join(cmd))
+        subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def get_gpg(self):
+        gpg = ['gpg']
+        if 'sign-key' in self.section:
+            gpg += ['-s', '-u', self.section['sign-key']]
+        if 'recipient' in self.section:
+            gpg += ['-e', '-r', self.section['recipient']]
+        return gpg
+
+    def get_store(self):
+        """Get a :py:class:`~libdump.dedup.store` for a single dump."""
+
+        level = self.section['compression-level']
+        return dedup.store(self.base, level=int(level) if level else 6,
+                           threads=self.section.getint('compression-threads'),
+                           average=self.section.getint('dedup-chunk-size') * 1024)
+
+    def get_pipeline(self, cmd, name, store=None):
+        """Get a pipeline that dumps and compresses (and optionally encrypts) a database.
+
+        If ``store`` is given, the dump is stored in chunks instead and the pipeline outputs the
+        index.
+        """
+
+        dump = pipeline.pipeline()
+        dump.add(pipeline.process(cmd, name=name))
+        throttled = self.throttle is not None and self.throttle.rate
+        if throttled:
+            dump.add(pipeline.filter(self.throttle.copy, 'throttle', label=str(self.throttle)))
+
+        compress_cmd = self.compressor.get_command()
+        in_process = store is not None or not (
+            compress_cmd or isinstance(self.compressor, compress.none))
+        if self.count and not throttled and not in_process:
+            dump.add(pipeline.filter(pipeline.copy, 'count'))
+
+        if store is not None:
+            dump.add(pipeline.filter(store.write, 'dedup', label=str(store)))
+        elif compress_cmd:
+            dump.add(pipeline.process(compress_cmd))
+        elif not isinstance(self.compressor, compress.none):
+            dump.add(pipeline.filter(self.compressor.compress, self.compressor.name,
+                                     label=str(self.compressor)))
+
         if self.gpg:
-            gpg = ['gpg']
-            if 'sign_key' in self.section:
-                gpg += ['-s', '-u', self.section['sign-key']]
-            if 'recipient' in self.section:
-                gpg += ['-e', '-r', self.section['recipient']]
-            path += '.gpg'
-
-        gzip = ['gzip', '-f', '-9', '-', '-']
-        tee = ['tee', path]
-        sha = ['sha256sum']
-        sed = ['sed', 's/-$/%s/' % os.path.basename(path)]
-
-        if 'remote' in self.section:
-            ssh = self.get_ssh(path, [tee, sha, sed])
+            dump.add(pipeline.process(self.get_gpg()))
+        return dump
 
-            cmds = [cmd, gzip, ]  # just for output
-            p_dump = Popen(cmd, stdout=PIPE)
-            p_gzip = Popen(gzip, stdin=p_dump.stdout, stdout=PIPE)
-            ssh_stdin = p_gzip.stdout  # what to pipe into SSH
-            if self.gpg:
-                p_gpg = Popen(gpg, stdin=p_gzip.stdout, stdout=PIPE)
-                ssh_stdin = p_gpg.stdout
-                cmds.append(gpg)
+    def get_extension(self, database):
+        """File extension of the uncompressed output of :py:meth:`get_command`, if any."""
+        return ''
 
-            cmds.append(ssh)
-            if self.args.verbose:
-                str_cmds = [' '.join(c) for c in cmds]
-                print('# Dump databases:')
-                print(' | '.join(str_cmds))
+    def make_spool(self, database):
+        """Create a private temporary directory in ``spool-dir``.
+
+        If ``su`` is used, the directory is owned by that user, so that commands run with su can
+        write to it. The directory is removed by :py:meth:`cleanup_db`.
+        """
+        path = tempfile.mkdtemp(prefix='dbdump-%s-' % database, dir=self.section['spool-dir'])
+        if 'su' in self.section:
+            shutil.chown(path, user=self.section['su'])
+        self.spool[database] = path
+        return path
+
+    def get_dirname(self, db):
+        return os.path.abspath(os.path.join(self.base, db))
+
+    def get_path(self, db, timestamp):
+        """Get the directory, path and file extension of the dump of ``db`` at ``timestamp``."""
+        dirname = self.get_dirname(db)
+        if self.dedup:  # the dump is an index of chunks
+            ext = self.get_extension(db) + '.idx'
+        else:
+            ext = self.get_extension(db) + self.compressor.extension
+        if self.gpg:
+            ext += '.gpg'
+        return dirname, os.path.join(dirname, '%s%s' % (timestamp, ext)), ext
 
-            p_ssh = Popen(ssh, stdin=ssh_stdin, stdout=PIPE)
-            p_ssh.communicate()
-            if p_ssh.returncode == 255:
+    def link(self, db, previous, timestamp, done=None):
+        """Make the dump at ``previous`` available under ``timestamp`` using hard links.
+
+        ``done`` is called once the linked dump is stored, see :py:meth:`dump`.
+        """
+
+        src = self.get_path(db, previous)[1]
+        dirname, dest, ext = self.get_path(db, timestamp)
+        if self.uploader is not None and \
+                os.path.exists('%s.sha256' % self.uploader.get_local_path(db, src)):
+            # the previous dump was not uploaded yet
+            src = self.uploader.get_local_path(db, src)
+            dest = self.uploader.get_local_path(db, dest)
+            self.link_local(src, dest)
+            row = None
+            if self.catalog is not None:
+                row = self.get_catalog_row(db, timestamp, dest, duration=0)
+            self.uploader.add(db, dest, done=self.get_upload_callback(db, dest, row, done))
+            return
+        elif 'remote' in self.section:
+            # Link every file named in the checksum file (the parts of a split dump) and rewrite it
+            src, dest = os.path.basename(src), os.path.basename(dest)
+            sed = 's/  %s/  %s/' % (src, dest)
+            cmd = self.get_ssh_command(
+                'umask 077; cd %s && while read checksum name; do ln "$name" %s"${name#%s}" || '
+                'exit 1; done < %s.sha256 && sed %s %s.sha256 > %s.sha256' % (
+                    shlex.quote(dirname), shlex.quote(dest), shlex.quote(src), shlex.quote(src),
+                    shlex.quote(sed), shlex.quote(src), shlex.quote(dest)))
+            if self.args.verbose:
+                print('%s # link unchanged dump' % ' '.join(cmd))
+            p = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+            p.communicate()
+            if p.returncode == 255:
                 raise RuntimeError("SSH returned with exit code 255.")
-            elif p_ssh.returncode != 0:
-                raise RuntimeError("%s returned with exit code %s." % (ssh, p_ssh.returncode))
+            elif p.returncode != 0:
+                raise Exception("Could not link %s to %s." % (src, dest))
+        else:
+            self.link_local(src, dest)
+
+        if self.catalog is not None:
+            self.catalog.link(self.section.get('remote', ''), os.path.abspath(self.base), db,
+                              previous, timestamp, self.get_time(timestamp))
+        if done is not None:
+            done(True)
+
+    def link_local(self, src, dest):
+        dirname = os.path.dirname(src)
+        src_name, dest_name = os.path.basename(src), os.path.basename(dest)
+        with open('%s.sha256' % src) as stream:
+            checksums = [line.split() for line in stream if line.strip()]
+
+        # Link every file named in the checksum file (the parts of a split dump)
+        lines = []
+        try:
+            for checksum, name in checksums:
+                new = dest_name + name[len(src_name):]
+                if self.args.verbose:
+                    print('ln %s %s # link unchanged dump'
+                          % (os.path.join(dirname, name), os.path.join(dirname, new)))
+                os.link(os.path.join(dirname, name), os.path.join(dirname, new))
+                lines.append('%s  %s\n' % (checksum, new))
+        except Exception:
+            # Remove links already created, a new dump must not overwrite the previous dump
+            for line in lines:
+                os.remove(os.path.join(dirname, line.split()[1]))
+            raise
+
+        with open('%s.sha256' % dest, 'w') as stream:
+            stream.writelines(lines)
+
+    def dump(self, db, timestamp, done=None):
+        """Dump ``db``, returns the path of the dump or ``None`` if nothing was dumped.
+
+        ``done`` is called with ``True`` once the dump is stored at its final location or with
+        ``False`` if it could not be uploaded there (see upload-workers). The dump is only added
+        to the catalog at this point.
+        """
+        cmd = self.get_command(db)
+        if not cmd:
+            return
+        name = os.path.basename(cmd[0])
+        cmd = self.make_su(cmd)
+
+        dirname, path, ext = self.get_path(db, timestamp)
+
+        store = self.get_store() if self.dedup else None
+        dump = self.get_pipeline(cmd, name, store=store)
+        local = 'remote' not in self.section or self.uploader is not None
+        if self.uploader is not None:  # write to local disk, upload in the background
+            path = self.uploader.get_local_path(db, path)
+            dirname = os.path.dirname(path)
+
+        out = digest = None
+        if not local:
+            if self.catalog is not None:  # sha256sum runs on the remote host
+                digest = sink.digest()
+                dump.add(pipeline.filter(digest.copy, 'checksum'))
+            elif self.count:
+                dump.add(pipeline.filter(pipeline.copy, 'count-output'))
+
+            tee = ['tee', path]
+            sha = ['sha256sum']
+            sed = ['sed', 's/-$/%s/' % os.path.basename(path)]
+            ssh = self.get_ssh(path, [tee, sha, sed])
+            dump.add(pipeline.process(ssh, exception=RuntimeError))
         else:
             if not os.path.exists(dirname):
                 os.mkdir(dirname, 0o700)
 
-            f = open(path + '.sha256', 'w')
-            cmds = [cmd, gzip, ]  # just for output
-            p_dump = Popen(cmd, stdout=PIPE)
-            p_gzip = Popen(gzip, stdin=p_dump.stdout, stdout=PIPE)
-            tee_pipe = p_gzip.stdout
-            if self.gpg:
-                p_gpg = Popen(gpg, stdin=p_dump.stdout, stdout=PIPE)
-                tee_pipe = p_gpg.stdout
-                cmds.append(gpg)
-
-            p_tee = Popen(tee, stdin=tee_pipe, stdout=PIPE)
-            p_sha = Popen(sha, stdin=p_tee.stdout, stdout=PIPE)
-            p_sed = Popen(sed, stdin=p_sha.stdout, stdout=f)
-
-            cmds += [tee, sha, sed]
+            size = sink.previous_size(dirname, ext)
+            if self.split:
+                out = sink.split_file(path, self.split, size=size)
+                label = '[write %s.partNNNN (%s MB each) and %s.sha256]' % (
+                    path, self.split // 1048576, path)
+            else:
+                out = sink.checksum_file(path, size=size)
+                label = '[write %s and %s.sha256]' % (path, path)
+            dump.add(pipeline.sink(out, label=label))
+
+        if self.args.verbose:
+            print('# Dump databases:')
+            print(dump)
+
+        start = time.time()
+        try:
+            dump.run()
+            self.check_db(db)
+        except Exception:
+            if local:
+                out.discard()
+            else:
+                self.remove_remote(path)
+            raise
+        finally:
+            self.stats[db] = self.get_stats(dump, out, store)
+
+        if self.args.verbose:
+            print('# %s: %s' % (db, dump.timings()))
+            if store is not None:
+                print('# %s: %s' % (db, store.stats()))
+        row = None
+        if self.catalog is not None:
+            row = self.get_catalog_row(db, timestamp, path, out, digest, time.time() - start)
+        if self.uploader is not None:
+            self.uploader.add(db, path, done=self.get_upload_callback(db, path, row, done))
+        else:
+            if row is not None:
+                self.catalog.add(**row)
+            if done is not None:
+                done(True)
+        return path
+
+    def get_catalog_row(self, db, timestamp, path, out=None, digest=None, duration=None):
+        """Get the catalog row of a finished dump written to ``out`` (a local file) or ``digest``
+        (sent via SSH). Without either, the local files listed in the checksum file are used."""
+
+        if digest is not None:
+            files = [path]
+            checksums = '%s  %s\n' % (digest.hexdigest(), os.path.basename(path))
+            size = digest.written
+        else:
+            with open('%s.sha256' % path) as stream:
+                checksums = stream.read()
+            if out is not None:
+                files = out.get_parts() if self.split else [path]
+                size = out.written
+            else:
+                dirname = os.path.dirname(path)
+                files = [os.path.join(dirname, line.split()[1])
+                         for line in checksums.splitlines() if line.strip()]
+                size = sum(os.path.getsize(f) for f in files)
+
+        codec = 'dedup' if self.dedup else self.compressor.name
+        if self.gpg:
+            codec += '+gpg'
+        return dict(location=self.section.get('remote', ''), datadir=os.path.abspath(self.base),
+                    database=db, timestamp=timestamp, time=self.get_time(timestamp),
+                    checksums=checksums, size=size, codec=codec,
+                    files=[os.path.basename(f) for f in files + ['%s.sha256' % path]],
+                    duration=None if duration is None else round(duration, 3))
+
+    def get_upload_callback(self, db, path, row=None, done=None):
+        """Get the function called by the uploader once the dump at ``path`` is uploaded.
+
+        Dumps left over from a previous run are added to the catalog without a ``row``, it is read
+        from the local files before they are uploaded.
+        """
+
+        if self.catalog is not None and row is None:
+            name, ext = os.path.basename(path), self.get_path(db, '')[2]
+            try:
+                if not name.endswith(ext):  # e.g. written with another compression
+                    raise ValueError('Unknown extension.')
+                row = self.get_catalog_row(db, name[:len(name) - len(ext)], path)
+            except Exception as e:
+                print('%s: Not adding %s to the catalog: %s' % (db, path, e), file=sys.stderr)
+
+        def finished(uploaded):
+            if uploaded and row is not None:
+                self.catalog.add(**row)
+            if done is not None:
+                done(uploaded)
+        return finished
+
+    def get_time(self, timestamp):
+        """Get ``timestamp`` (formatted with ``format``) in seconds since the epoch."""
+        return calendar.timegm(time.strptime(timestamp, self.section['format']))
+
+    def get_stats(self, dump, out, store):
+        """Get timings and byte counts of a dump (see :py:mod:`~libdump.metrics`)."""
+
+        stats = {'stages': dump.stats()}
+        filters = [s for s in dump.stages if isinstance(s, pipeline.filter)]
+        if filters:  # the first filter reads the uncompressed dump
+            stats['raw_bytes'] = filters[0].bytes
+        if out is not None:
+            stats['stored_bytes'] = out.written
+            if store is not None:
+                stats['stored_bytes'] += store.written_bytes
+        elif filters:  # the last filter feeds ssh
+            stats['stored_bytes'] = filters[-1].bytes
+        return stats
+
+    def get_db_sizes(self):
+        """Return a dictionary of estimated database sizes in bytes.
+
+        Databases missing from the dictionary have an unknown size. Backends that cannot estimate
+        sizes simply return an empty dictionary.
+        """
+        return {}
+
+    def get_fingerprints(self):
+        """Return a dictionary of cheap fingerprints of the databases.
+
+        A fingerprint is a string that changes whenever the data in the database changes. Databases
+        missing from the dictionary are always dumped.
+        """
+        return {}
+
+    def is_busy(self):
+        """Get the reason why no new dumps should be started right now, ``None`` if they may."""
+
+        if self.section['max-load']:
+            load = os.getloadavg()[0]
+            if load > self.section.getfloat('max-load'):
+                return 'load average is %.2f' % load
+        if self.section['max-replication-lag']:
+            lag = self.get_replication_lag()
+            if lag is not None and lag > self.section.getfloat('max-replication-lag'):
+                return 'replication lag is %.0fs' % lag
+        return None
+
+    def get_replication_lag(self):
+        """Get the replication lag in seconds, ``None`` if unknown or not a replica."""
+        return None
+
+    def wait_until_idle(self):
+        """Block while new dumps are held back, see max-load and max-replication-lag."""
+        if self.throttle is not None:
+            self.throttle.resume.wait()
+
+    def set_priority(self):
+        """Set the CPU and I/O priority of dbdump, inherited by all commands it starts.
+
+        The priority applies to the whole process, so this is only called once per run.
+        """
+
+        if self.section['nice']:
             if self.args.verbose:
-                str_cmds = [' '.join(c) for c in cmds]
-                print('# Dump databases:')
-                print(' | '.join(str_cmds))
+                print('# nice %s' % self.section['nice'])
+            os.nice(self.section.getint('nice'))
 
-            p_sed.communicate()
-            f.close()
+        if self.section['ionice']:
+            cls, _, level = self.section['ionice'].partition(':')
+            cmd = ['ionice', '-c', cls]
+            if level:
+                cmd += ['-n', level]
+            cmd += ['-p', str(os.getpid())]
+            if self.args.verbose:
+                print('%s # set I/O priority' % ' '.join(cmd))
+            if subprocess.call(cmd) != 0:
+                print('Warning: Could not set I/O priority.', file=sys.stderr)
 
     def prepare(self):
-        pass
+        """Called before every run, see :py:meth:`cleanup`."""
+
+        if self.throttle is not None:
+            self.throttle.start()
+
+        if 'remote' not in self.section:
+            return
+
+        # The shared SSH connection of the previous run is reused, if it is still open.
+        if self.section.getboolean('ssh-multiplex') and not self.is_master_running():
+            self.stop_master()  # removes the control socket of a master that already exited
+            self.start_master()
+        workers = self.section.getint('upload-workers')
+        if workers:
+            path = os.path.join(self.section['spool-dir'], 'dbdump-upload-%s' % self.section.name)
+            self.uploader = upload.uploader(self, path, workers=workers,
+                                            retries=self.section.getint('upload-retries'))
+            self.uploader.start()
 
     def prepare_db(self, database):
         pass
 
-    def cleanup_db(self, database):
+    def check_db(self, database):
+        """Called after a successful dump, raise an exception if the dump is incomplete anyway."""
         pass
 
-    def cleanup(self):
+    def call(self, cmd, comment):
+        """Run ``cmd``, raise an exception if it fails."""
+
+        if self.args.verbose:
+            print('%s # %s' % (' '.join(cmd), comment))
+        p = subprocess.Popen(cmd)
+        p.communicate()
+        if p.returncode != 0:
+            raise Exception("%s returned with exit code %s." % (os.path.basename(cmd[0]),
+                                                                p.returncode))
+
+    def prepare_restore(self, database, target):
+        """Called before a dump of ``database`` is restored to ``target``, e.g. to create it."""
         pass
+
+    def get_restore_command(self, database, target):
+        """Get the command that restores a dump of ``database`` read from stdin to ``target``.
+
+        Backends that can only restore from a file return ``None``, the dump is then written to
+        :py:meth:`get_restore_path` and restored with :py:meth:`restore_path`.
+        """
+        return None
+
+    def get_restore_filter(self, database, target):
+        """Get a :py:class:`~libdump.pipeline.filter` that is passed the dump of ``database``
+        before :py:meth:`get_restore_command`, ``None`` if the dump is passed on unchanged."""
+        return None
+
+    def get_restore_path(self, database, target):
+        return os.path.join(self.make_spool(target), 'dump')
+
+    def restore_path(self, database, target, path, jobs):
+        """Restore the dump of ``database`` at ``path`` to ``target``.
+
+        ``path`` is a directory for .tar dumps, which are restored using ``jobs`` parallel jobs.
+        Backends that write such dumps or return ``None`` from :py:meth:`get_restore_command` must
+        implement this method.
+        """
+        raise Exception("%s backend cannot restore %s from a file."
+                        % (self.section['backend'], database))
+
+    def cleanup_db(self, database):
+        path = self.spool.pop(database, None)
+        if path is not None:
+            if self.args.verbose:
+                print('rm -r %s # remove temporary directory' % path)
+            shutil.rmtree(path)
+
+    def cleanup(self, close=True):
+        """Called after every run, returns ``False`` if any upload failed. With ``close=False``, the
+        shared SSH connection and the catalog are kept open for the next run."""
+
+        uploaded = True
+        if self.throttle is not None:
+            self.throttle.stop()
+        if self.uploader is not None:
+            uploaded = self.uploader.finish()
+            self.uploader = None
+        if close:
+            self.stop_master()
+            if self.catalog is not None:
+                self.catalog.close()
+        return uploaded
@@ -0,0 +1,126 @@
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import sqlite3
+import threading
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS backups (
+    location TEXT NOT NULL,  -- remote host, empty for a local datadir
+    datadir TEXT NOT NULL,  -- absolute path of the datadir
+    database TEXT NOT NULL,
+    timestamp TEXT NOT NULL,  -- as used in filenames
+    time INTEGER NOT NULL,  -- the timestamp in seconds since the epoch
+    files TEXT NOT NULL,  -- JSON list of filenames in <datadir>/<database>/
+    checksums TEXT,  -- content of the .sha256 file
+    size INTEGER,  -- size of the dump (without the .sha256 file)
+    codec TEXT,
+    duration REAL,
+    PRIMARY KEY (location, datadir, database, timestamp)
+);
+CREATE INDEX IF NOT EXISTS backups_time ON backups (location, datadir, database, time);
+'''
+COLUMNS = ['location', 'datadir', 'database', 'timestamp', 'time', 'files', 'checksums', 'size',
+           'codec', 'duration']
+
+
+class catalog:
+    """An index of all backups, stored in an SQLite database.
+
+    dbdump adds every finished dump, dbclean removes backups it deletes, so dbclean does not have
+    to list every directory to find out which backups exist. Backups are identified by their
+    location (the remote host or an empty string), the datadir, the database and the timestamp.
+    Rows are dictionaries with the keys in :py:data:`COLUMNS`, ``files`` is a list.
+    """
+
+    def __init__(self, path):
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, 0o700)
+
+        self.path = path
+        self.lock = threading.Lock()
+        # Used by several dump threads, concurrent runs of dbdump/dbclean wait for each other.
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def get_row(self, row):
+        row = dict(row)
+        row['files'] = json.loads(row['files'])
+        return row
+
+    def add(self, **row):
+        """Add (or replace) a backup, see :py:data:`COLUMNS` for keyword arguments."""
+
+        row = dict(row, files=json.dumps(row['files']))
+        query = 'INSERT OR REPLACE INTO backups (%s) VALUES (%s)' % (
+            ', '.join(COLUMNS), ', '.join('?' for c in COLUMNS))
+        with self.lock, self.conn:
+            self.conn.execute(query, [row.get(c) for c in COLUMNS])
+
+    def remove(self, location, datadir, database, timestamp):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM backups WHERE location = ? AND datadir = ? AND '
+                              'database = ? AND timestamp = ?',
+                              (location, datadir, database, timestamp))
+
+    def get(self, location, datadir, database, timestamp):
+        with self.lock:
+            row = self.conn.execute('SELECT * FROM backups WHERE location = ? AND datadir = ? '
+                                    'AND database = ? AND timestamp = ?',
+                                    (location, datadir, database, timestamp)).fetchone()
+        return None if row is None else self.get_row(row)
+
+    def backups(self, location, datadir, database=None):
+        """Get all backups in ``datadir`` (of a single database, if given), oldest first."""
+
+        query = 'SELECT * FROM backups WHERE location = ? AND datadir = ?'
+        params = [location, datadir]
+        if database is not None:
+            query += ' AND database = ?'
+            params.append(database)
+        with self.lock:
+            rows = self.conn.execute(query + ' ORDER BY database, time', params).fetchall()
+        return [self.get_row(row) for row in rows]
+
+    def latest(self, location, datadir, database):
+        """Get the newest backup of ``database``, ``None`` if there is none."""
+
+        with self.lock:
+            row = self.conn.execute('SELECT * FROM backups WHERE location = ? AND datadir = ? '
+                                    'AND database = ? ORDER BY time DESC LIMIT 1',
+                                    (location, datadir, database)).fetchone()
+        return None if row is None else self.get_row(row)
+
+    def link(self, location, datadir, database, previous, timestamp, time):
+        """Add a backup at ``timestamp`` with the same content as the backup at ``previous``."""
+
+        row = self.get(location, datadir, database, previous)
+        if row is None:
+            return
+
+        # Files are named like <timestamp><extension>, see libdump.backend.backend.link_local()
+        rename = {name: timestamp + name[len(previous):] for name in row['files']}
+        checksums = row['checksums']
+        if checksums is not None:
+            checksums = ''.join('%s  %s\n' % (line.split()[0], rename[line.split()[1]])
+                                for line in checksums.splitlines() if line.strip())
+        self.add(**dict(row, timestamp=timestamp, time=time, checksums=checksums,
+                        files=[rename[name] for name in row['files']], duration=0))
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,244 @@
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import collections
+import os
+import shutil
+import struct
+import subprocess
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_SIZE = 1024 * 1024
+
+# Header of a gzip member written by compress_block(): magic, deflate, FEXTRA flag, no mtime, no
+# extra flags, unknown OS and an extra field with a single subfield "DB" with the member size.
+GZIP_HEADER = struct.Struct('<BBBBIBBH2sHI')
+GZIP_HEADER_START = GZIP_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 255, 8, b'DB', 4, 0)[:-4]
+
+
+def compress_block(data, level):
+    """Compress ``data`` to a complete gzip member.
+
+    Like BGZF, the header contains the size of the member in an extra field (ignored by gunzip),
+    so that the members of a dump can be decompressed in parallel, see :py:meth:`gzip.decompress`.
+    """
+
+    # negative wbits make zlib write raw deflate data, header and trailer are written here
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    size = GZIP_HEADER.size + len(body) + 8
+    return GZIP_HEADER_START + struct.pack('<I', size) + body + \
+        struct.pack('<II', zlib.crc32(data), len(data) & 0xffffffff)
+
+
+def decompress_stream(data, src, dst):
+    """Decompress gzip members (starting with ``data``) read from ``src`` one after another."""
+
+    while data:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while not decompressor.eof:
+            dst.write(decompressor.decompress(data))
+            data = src.read(BLOCK_SIZE)
+            if not data and not decompressor.eof:
+                raise Exception('Unexpected end of compressed data.')
+        data = decompressor.unused_data + data
+        if not data:
+            data = src.read(BLOCK_SIZE)
+
+
+class codec:
+    """Base class for compression codecs.
+
+    Codecs either name an external command that compresses stdin to stdout (see
+    :py:meth:`get_command`) or compress in-process (see :py:meth:`compress`). The ``none`` codec
+    just copies the data. ``decompress_command`` decompresses stdin to stdout.
+    """
+
+    name = None
+    extension = ''
+    default_level = None
+    decompress_command = None
+
+    def __init__(self, level=None, threads=0):
+        self.level = self.default_level if level is None else level
+        self.threads = threads or os.cpu_count() or 1
+
+    def get_command(self):
+        return None
+
+    def compress(self, src, dst):
+        """Read ``src`` until EOF and write the compressed data to ``dst``.
+
+        Codecs without a command must override this method. The default implementation runs the
+        command of the codec and copies the data through it.
+        """
+
+        cmd = self.get_command()
+        if cmd is None:
+            raise Exception('%s cannot compress in-process.' % type(self).__name__)
+
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        errors = []
+
+        def feed():
+            try:
+                shutil.copyfileobj(src, proc.stdin, BLOCK_SIZE)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                try:
+                    proc.stdin.close()
+                except OSError:  # the command already exited, its exit code is checked below
+                    pass
+
+        thread = threading.Thread(target=feed, name='%s-feed' % self.name)
+        thread.start()
+        try:
+            shutil.copyfileobj(proc.stdout, dst, BLOCK_SIZE)
+        finally:
+            proc.stdout.close()
+            thread.join()
+            proc.wait()
+
+        if proc.returncode != 0:
+            raise Exception("%s returned with exit code %s." % (cmd[0], proc.returncode))
+        elif errors:
+            raise errors[0]
+
+    def __str__(self):
+        return ' '.join(self.get_command())
+
+
+class none(codec):
+    name = 'none'
+
+    def compress(self, src, dst):
+        shutil.copyfileobj(src, dst, BLOCK_SIZE)
+
+    def __str__(self):
+        return '[no compression]'
+
+
+class gzip(codec):
+    """Block-parallel gzip compression.
+
+    The input is split into blocks that are compressed concurrently (zlib releases the GIL while
+    compressing). Every block becomes a gzip member of its own, the members are written in order.
+    A concatenation of gzip members is a valid gzip file, so the output can be read by gunzip.
+    """
+
+    name = 'gzip'
+    extension = '.gz'
+    default_level = 9
+    decompress_command = ['gzip', '-dc']
+
+    def __init__(self, level=None, threads=0, blocksize=BLOCK_SIZE):
+        super().__init__(level=level, threads=threads)
+        self.blocksize = blocksize
+
+    def __str__(self):
+        return '[gzip -%s, %s threads]' % (self.level, self.threads)
+
+    def compress(self, src, dst):
+        """Read ``src`` until EOF and write the compressed data to ``dst``."""
+
+        written = False
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            while True:
+                block = src.read(self.blocksize)
+                if not block:
+                    break
+
+                pending.append(pool.submit(compress_block, block, self.level))
+
+                # Bound the number of blocks held in memory
+                if len(pending) >= self.threads * 2:
+                    dst.write(pending.popleft().result())
+                    written = True
+
+            while pending:
+                dst.write(pending.popleft().result())
+                written = True
+
+        if not written:  # gunzip does not accept empty files
+            dst.write(compress_block(b'', self.level))
+
+    def decompress(self, src, dst):
+        """Read ``src`` until EOF and write the decompressed data to ``dst``.
+
+        Members written by :py:func:`compress_block` are decompressed concurrently, anything
+        else (e.g. dumps written by older versions) is decompressed sequentially.
+        """
+
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            while True:
+                header = src.read(GZIP_HEADER.size)
+                if len(header) < GZIP_HEADER.size or \
+                        header[:GZIP_HEADER.size - 4] != GZIP_HEADER_START:
+                    break
+
+                size = GZIP_HEADER.unpack(header)[-1]
+                member = header + src.read(size - GZIP_HEADER.size)
+                pending.append(pool.submit(zlib.decompress, member, 16 + zlib.MAX_WBITS))
+                if len(pending) >= self.threads * 2:
+                    dst.write(pending.popleft().result())
+
+            while pending:
+                dst.write(pending.popleft().result())
+
+        decompress_stream(header, src, dst)
+
+
+class zstd(codec):
+    name = 'zstd'
+    extension = '.zst'
+    default_level = 3
+    decompress_command = ['zstd', '-q', '-dc']
+
+    def get_command(self):
+        return ['zstd', '-q', '-c', '-%s' % self.level, '-T%s' % self.threads]
+
+
+class lz4(codec):
+    name = 'lz4'
+    extension = '.lz4'
+    default_level = 1
+    decompress_command = ['lz4', '-q', '-dc']
+
+    def get_command(self):
+        return ['lz4', '-q', '-c', '-%s' % self.level]
+
+
+class xz(codec):
+    name = 'xz'
+    extension = '.xz'
+    default_level = 6
+    decompress_command = ['xz', '-q', '-dc']
+
+    def get_command(self):
+        return ['xz', '-q', '-c', '-%s' % self.level, '-T%s' % self.threads]
+
+
+CODECS = {c.name: c for c in [none, gzip, zstd, lz4, xz]}
+EXTENSIONS = {c.extension: c for c in CODECS.values() if c.extension}
+
+
+def get_codec(name, level=None, threads=0):
+    if name not in CODECS:
+        raise ValueError("%s: Unknown compression, use one of %s."
+                         % (name, ', '.join(sorted(CODECS))))
+    return CODECS[name](level=level, threads=threads)
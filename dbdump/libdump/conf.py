@@ -0,0 +1,77 @@
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+
+from libdump import ejabberd
+from libdump import mysql
+from libdump import postgresql
+
+# Default values of all options, shared by all programs reading the config-file of dbdump.
+DEFAULTS = {
+    'format': '%%Y-%%m-%%d_%%H:%%M:%%S',
+    'datadir': '/var/backups/%(backend)s',
+    'mysql-ignore-tables': '',
+    'mysql-jobs': '0',
+    'mysql-chunk-rows': '0',
+    'mysql-hot-copy': 'no',
+    'ejabberd-base-dir': '/var/lib/ejabberd',
+    'ejabberd-options': '--no-timeout',  # https://github.com/processone/ejabberd/issues/866
+    'ejabberd-stream': 'yes',
+    'ssh-timeout': '10',
+    'ssh-options': '',
+    'ssh-multiplex': 'yes',
+    'parallel': '1',
+    'source-host': 'localhost',
+    'source-parallel': '0',
+    'destination-parallel': '0',
+    'delay': '3',
+    'estimated-rate': '20',
+    'compression': 'gzip',
+    'compression-level': '',
+    'compression-threads': '0',
+    'spool-dir': '/var/tmp',
+    'postgresql-jobs': '0',
+    'postgresql-globals': 'no',
+    'upload-workers': '0',
+    'upload-retries': '3',
+    'split-size': '0',
+    'storage': 'file',
+    'dedup-chunk-size': '1024',
+    'rate-limit': '0',
+    'nice': '',
+    'ionice': '',
+    'max-load': '',
+    'max-replication-lag': '',
+    'metrics-file': '',
+    'metrics-textfile': '',
+    'catalog': '',
+    'skip-unchanged': 'no',
+    'state-dir': '/var/lib/dbdump',
+    'interval': '60',
+    'start-at': '',
+    'clean': '',
+}
+
+BACKENDS = {
+    'mysql': mysql.mysql,
+    'postgresql': postgresql.postgresql,
+    'ejabberd': ejabberd.ejabberd,
+}
+
+
+def get_backend(section, args):
+    """Get the backend configured in ``section``, raises ``ValueError`` if it is unknown."""
+
+    if section['backend'] not in BACKENDS:
+        raise ValueError("%s. Unknown backend specified. Only mysql, postgresql and ejabberd are "
+                         "supported." % section['backend'])
+    return BACKENDS[section['backend']](section, args)
@@ -0,0 +1,209 @@
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import json
+import math
+import os
+import threading
+import time
+
+from libdump import metrics
+from libdump import scheduler
+
+STATUS_INTERVAL = 60  # seconds between two updates of the status file while nothing happens
+
+
+def format_time(seconds):
+    if seconds is None:
+        return None
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+class job:
+    """A section dumped by the :py:class:`daemon` every ``interval`` minutes.
+
+    ``clean`` is an optional function called after every run that was not aborted, e.g. to remove
+    old dumps.
+    """
+
+    def __init__(self, backend, limits=None, clean=None):
+        self.backend = backend
+        self.name = backend.section.name
+        self.limits = limits
+        self.clean = clean
+        self.interval = backend.section.getint('interval') * 60
+        self.start_at = backend.section['start-at']
+
+        # Keep the shared SSH connection open until the next run, it still exits by itself if the
+        # daemon is killed.
+        backend.persist = self.interval + 60
+
+        self.next = None  # time of the next run
+        self.thread = None  # thread of the current run, if any
+        self.metrics = None  # metrics of the last run, if enabled
+        self.status = {'runs': 0, 'failures': 0, 'last_run': None, 'last_duration': None,
+                       'last_status': None, 'last_error': None}
+
+    def schedule(self, now, offset=0):
+        """Set the time of the next run after ``now``.
+
+        The first run of a section without start-at starts ``offset`` seconds after ``now``, all
+        later runs follow every ``interval`` seconds, skipping runs that were missed because the
+        previous run took too long.
+        """
+
+        if self.start_at:
+            hour, minute = self.start_at.split(':')
+            base = time.mktime(time.localtime(now)[:3] + (int(hour), int(minute), 0, 0, 0, -1))
+        elif self.next is None:
+            self.next = now + offset
+            return
+        else:
+            base = self.next
+        self.next = base + (math.floor((now - base) / self.interval) + 1) * self.interval
+
+    def get_status(self):
+        return dict(self.status, running=self.thread is not None,
+                    next_run=None if self.thread else format_time(self.next),
+                    last_run=format_time(self.status['last_run']))
+
+
+class daemon:
+    """Dump the sections of ``jobs`` at regular intervals until :py:meth:`stop` is called.
+
+    Sections without start-at are staggered: the first runs of all sections with the same
+    interval are spread evenly over the interval, so that they do not all start at the same time.
+    Dumps of all sections share ``pool``, so the limits of the pool (see --workers,
+    source-parallel and destination-parallel) also apply to sections that happen to run at the
+    same time. Backends are only cleaned up with ``close=False`` between runs, so the shared SSH
+    connection and the catalog are reused by the next run.
+
+    With ``status_file``, a JSON file with the queued and running dumps and the last run of every
+    section is written whenever a run starts or ends and every :py:data:`STATUS_INTERVAL` seconds.
+    """
+
+    def __init__(self, jobs, pool, status_file=None, verbose=False):
+        self.jobs = jobs
+        self.pool = pool
+        self.status_file = status_file
+        self.verbose = verbose
+
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.started = time.time()
+
+    def stop(self):
+        """Stop the daemon, running dumps are finished first."""
+        self.stopped.set()
+
+    def stagger(self, now):
+        groups = {}
+        for job in self.jobs:
+            if job.start_at:
+                job.schedule(now)
+            else:
+                groups.setdefault(job.interval, []).append(job)
+
+        for interval, jobs in groups.items():
+            for i, job in enumerate(jobs):
+                job.schedule(now, offset=i * interval / len(jobs))
+
+    def write_status(self):
+        if self.status_file is None:
+            return
+
+        now = time.time()
+        with self.lock:
+            status = dict(self.pool.get_status(), pid=os.getpid(), time=format_time(now),
+                          started=format_time(self.started),
+                          sections={job.name: job.get_status() for job in self.jobs})
+
+            # Write to a temporary file first, so that readers never see a partial file
+            tmp = '%s.%s.tmp' % (self.status_file, os.getpid())
+            with open(tmp, 'w') as stream:
+                json.dump(status, stream, indent=4, sort_keys=True)
+            os.rename(tmp, self.status_file)
+
+    def run_job(self, job):
+        start = time.time()
+        error = None
+        try:
+            job.backend.prepare()
+            dumper, databases = scheduler.get_scheduler(job.backend, time.gmtime(start),
+                                                        limits=job.limits)
+            if self.verbose:
+                print('# %s: dumping %s databases' % (job.name, len(databases)))
+            self.pool.add(dumper, databases)
+            self.write_status()
+            dumper.done.wait()
+
+            # Wait for uploads first, their failures are part of the metrics of this run
+            if not job.backend.cleanup(close=False):
+                error = 'upload failed'
+            if dumper.metrics is not None:
+                dumper.metrics.finish()
+                with self.lock:
+                    job.metrics = dumper.metrics
+                    metrics.write_textfiles([j.metrics for j in self.jobs if j.metrics])
+
+            if dumper.aborted.is_set():
+                error = 'aborted'
+            elif job.clean is not None:
+                job.clean()
+        except (Exception, SystemExit) as e:  # backends exit if the configuration is invalid
+            error = str(e)
+            print('Error: %s: %s' % (job.name, e))
+        finally:
+            job.backend.cleanup(close=False)
+
+        with self.lock:
+            job.status['runs'] += 1
+            job.status['last_run'] = start
+            job.status['last_duration'] = round(time.time() - start, 3)
+            job.status['last_status'] = 'failed' if error else 'ok'
+            job.status['last_error'] = error
+            if error:
+                job.status['failures'] += 1
+            job.schedule(time.time())
+            job.thread = None
+        if self.verbose:
+            print('# %s: finished in %.1fs, next run at %s'
+                  % (job.name, time.time() - start, format_time(job.next)))
+        self.write_status()
+
+    def run(self):
+        self.stagger(time.time())
+        self.pool.serve()
+        try:
+            while not self.stopped.is_set():
+                now = time.time()
+                with self.lock:
+                    for job in self.jobs:
+                        if job.thread is None and job.next <= now:
+                            job.thread = threading.Thread(target=self.run_job, args=(job, ),
+                                                          name='section-%s' % job.name)
+                            job.thread.start()
+                    waiting = [job.next for job in self.jobs if job.thread is None]
+
+                self.write_status()
+                timeout = min([STATUS_INTERVAL] + [n - now for n in waiting])
+                self.stopped.wait(max(timeout, 0.1))
+        finally:
+            for job in self.jobs:
+                thread = job.thread
+                if thread is not None:
+                    thread.join()
+            self.pool.stop()
+            for job in self.jobs:
+                job.backend.cleanup()
+            self.write_status()
@@ -0,0 +1,150 @@
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import collections
+import hashlib
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from libdump import compress
+
+CHUNK_DIR = '.chunks'
+WINDOW = 64  # bytes at the end of a line used to decide if a chunk ends after it
+
+
+def get_chunk_path(base, checksum):
+    return os.path.join(base, CHUNK_DIR, checksum[:2], checksum)
+
+
+def find_boundary(buf, minimum, maximum, average):
+    """Find the end of the next chunk in ``buf``, ``None`` if there is none in the first
+    ``maximum`` bytes.
+
+    Chunks only end at the end of a line, and only if the line itself says so: the crc32 of the
+    last bytes of the line decides. So inserting or removing a few lines of a dump only changes
+    the chunks around them. The probability of a line ending a chunk is proportional to its
+    length, so chunks are ``average`` bytes long on average, no matter how long the lines are.
+    """
+
+    prev = buf.rfind(b'\n', 0, minimum)
+    pos = buf.find(b'\n', minimum, maximum)
+    while pos != -1:
+        length = pos - prev
+        if zlib.crc32(buf[max(pos - WINDOW, prev + 1):pos]) < (length << 32) // average:
+            return pos + 1
+        prev = pos
+        pos = buf.find(b'\n', pos + 1, maximum)
+    return None
+
+
+def chunks(src, average):
+    """Split the binary file object ``src`` into content-defined chunks."""
+
+    minimum, maximum = average // 4, average * 4
+    buf = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buf) < maximum:
+            data = src.read(compress.BLOCK_SIZE)
+            if data:
+                buf += data
+            else:
+                eof = True
+
+        if not buf:
+            return
+
+        end = find_boundary(buf, minimum, maximum, average)
+        if end is None:
+            if len(buf) < maximum:  # only at the end of the stream
+                end = len(buf)
+            else:  # no boundary found, end the chunk with the last complete line
+                end = buf.rfind(b'\n', minimum, maximum) + 1 or maximum
+
+        yield bytes(buf[:end])
+        del buf[:end]
+
+
+class store:
+    """Store dumps as chunks in a content-addressed store below ``base``.
+
+    The uncompressed dump is split into chunks (see :py:func:`find_boundary`). Every chunk is
+    stored once as gzip-compressed file named after the sha256 of its content in
+    ``<base>/.chunks/``. The dump itself becomes an index listing the checksums of its chunks, one
+    per line. Chunks that already exist are not written again but touched, so that dbclean does
+    not remove them. If dbclean removed a chunk in the meantime, it is written again.
+    """
+
+    def __init__(self, base, level=6, threads=0, average=1024 * 1024):
+        self.base = base
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.average = average
+
+        self.lock = threading.Lock()
+        self.chunks = 0
+        self.new_chunks = 0
+        self.raw_bytes = 0
+        self.written_bytes = 0
+
+    def __str__(self):
+        return '[dedup into %s, gzip -%s, %s threads]' % (
+            os.path.join(self.base, CHUNK_DIR), self.level, self.threads)
+
+    def store_chunk(self, data):
+        checksum = hashlib.sha256(data).hexdigest()
+        path = get_chunk_path(self.base, checksum)
+
+        try:
+            os.utime(path)
+            written = 0
+        except FileNotFoundError:  # a new chunk, or dbclean just removed it
+            dirname = os.path.dirname(path)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname, 0o700, exist_ok=True)
+
+            # Write to a temporary file first, so that chunks are always complete
+            tmp = '%s.%s.%s' % (path, os.getpid(), threading.get_ident())
+            compressed = compress.compress_block(data, self.level)
+            with open(tmp, 'wb') as stream:
+                stream.write(compressed)
+            os.rename(tmp, path)
+            written = len(compressed)
+
+        with self.lock:
+            self.chunks += 1
+            self.raw_bytes += len(data)
+            if written:
+                self.new_chunks += 1
+                self.written_bytes += written
+        return checksum
+
+    def write(self, src, dst):
+        """Read ``src`` until EOF, store its chunks and write the index to ``dst``."""
+
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            for chunk in chunks(src, self.average):
+                pending.append(pool.submit(self.store_chunk, chunk))
+                if len(pending) >= self.threads * 2:
+                    dst.write(('%s\n' % pending.popleft().result()).encode('ascii'))
+
+            while pending:
+                dst.write(('%s\n' % pending.popleft().result()).encode('ascii'))
+
+    def stats(self):
+        return '%s chunks (%.1f MB), %s new chunks (%.1f MB compressed)' % (
+            self.chunks, self.raw_bytes / 1048576, self.new_chunks,
+            self.written_bytes / 1048576)
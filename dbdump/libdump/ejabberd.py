@@ -11,38 +11,149 @@
 # You should have received a copy of the GNU General Public License along with dbdump. If not,
 # see <http://www.gnu.org/licenses/>.
 
+import errno
 import os
 import shlex
 import subprocess
+import threading
+import time
 
 from libdump import backend
 
 
 class ejabberd(backend.backend):
+    """Dump the ejabberd database using "ejabberdctl dump".
+
+    With ejabberd-stream (the default), ejabberd writes the dump to a named pipe that is read by
+    the first stage of the pipeline, so the dump is never written to disk uncompressed.
+    ejabberdctl runs in the background while the dump is running, its exit status is checked by
+    :py:meth:`check_db`.
+    """
+
+    def __init__(self, section, args):
+        super().__init__(section, args)
+        self.stream = section.getboolean('ejabberd-stream')
+        self.procs = {}  # ejabberdctl processes running in the background
+        self.done = {}  # set once the dump of a database is finished
+
     def get_db_list(self):
         return ['ejabberd']
 
-    def get_command(self, database):
-        path = os.path.normpath(os.path.join(
+    def get_dump_path(self, database):
+        return os.path.normpath(os.path.join(
             self.section['ejabberd-base-dir'], '%s.dump' % database))
-        return ['cat', path]
 
-    def prepare_db(self, database):
+    def get_command(self, database):
+        return ['cat', self.get_dump_path(database)]
+
+    def get_ctl(self):
         cmd = ['ejabberdctl'] + shlex.split(self.section['ejabberd-options'])
         if 'ejabberd-node' in self.section:
             cmd += ['--node', self.section['ejabberd-node']]
         if 'ejabberd-auth' in self.section:
-            cmd += ['--auth', self.section['ejabberd-auth'].split()]
+            cmd += ['--auth'] + self.section['ejabberd-auth'].split()
+        return cmd
+
+    def get_ejabberdctl(self, database):
+        cmd = self.get_ctl()
+        if self.stream:  # ejabberd might run in a different working directory
+            return cmd + ['dump', self.get_dump_path(database)]
+        return cmd + ['dump', '%s.dump' % database]
+
+    def make_fifo(self, path):
+        """Create a named pipe that ejabberd (running as owner of ejabberd-base-dir) can write to."""
+
+        if os.path.lexists(path):  # left over from a previous run
+            os.remove(path)
+        os.mkfifo(path, 0o600)
+
+        stat = os.stat(os.path.dirname(path))
+        if os.getuid() == 0:
+            os.chown(path, stat.st_uid, stat.st_gid)
+
+    def watch(self, proc, path, done):
+        """Make sure that reading the named pipe does not block forever if ejabberdctl fails."""
+
+        if proc.wait() == 0:
+            return
 
-        cmd += ['dump', '%s.dump' % database]
+        # Opening a named pipe for reading blocks until it is opened for writing, so open it once.
+        # This fails (with ENXIO) until it is opened for reading.
+        while not done.is_set():
+            try:
+                os.close(os.open(path, os.O_WRONLY | os.O_NONBLOCK))
+                return
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    return
+            done.wait(0.1)
+
+    def prepare_db(self, database):
+        cmd = self.get_ejabberdctl(database)
+
+        if not self.stream:
+            if self.args.verbose:
+                print('%s # prepare db' % ' '.join(cmd))
+            p = subprocess.Popen(cmd)
+            p.communicate()
+            if p.returncode != 0:
+                raise Exception('ejabberdctl returned with exit code %s.' % p.returncode)
+            return
+
+        path = self.get_dump_path(database)
         if self.args.verbose:
-            print('%s # prepare db' % ' '.join(cmd))
-        p = subprocess.Popen(cmd)
-        p.communicate()
+            print('mkfifo %s # create named pipe' % path)
+        self.make_fifo(path)
 
-    def cleanup_db(self, database):
-        path = os.path.normpath(os.path.join(
-            self.section['ejabberd-base-dir'], '%s.dump' % database))
         if self.args.verbose:
-            print('rm %s # remove local dump' % path)
-        os.remove(path)
+            print('%s & # dump to named pipe' % ' '.join(cmd))
+        self.done[database] = threading.Event()
+        self.procs[database] = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+        threading.Thread(target=self.watch,
+                         args=(self.procs[database], path, self.done[database])).start()
+
+    def get_restore_path(self, database, target):
+        # Not named like dumps, so that a running dump does not remove the file
+        return os.path.normpath(os.path.join(
+            self.section['ejabberd-base-dir'], '%s.restore' % target))
+
+    def restore_path(self, database, target, path, jobs):
+        try:
+            stat = os.stat(os.path.dirname(path))
+            if os.getuid() == 0:  # ejabberd runs as owner of ejabberd-base-dir
+                os.chown(path, stat.st_uid, stat.st_gid)
+            self.call(self.get_ctl() + ['load', path], 'load dump')
+        finally:
+            os.remove(path)
+
+    def check_db(self, database):
+        proc = self.procs.get(database)
+        if proc is not None and proc.wait() != 0:
+            raise Exception('ejabberdctl returned with exit code %s.' % proc.returncode)
+
+    def cleanup_db(self, database):
+        path = self.get_dump_path(database)
+        proc = self.procs.pop(database, None)
+
+        if proc is not None:
+            self.done.pop(database).set()
+            if proc.poll() is None:
+                # The dump failed: read and discard the rest of the dump so that ejabberd does not
+                # block while writing it.
+                fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+                try:
+                    while proc.poll() is None:
+                        try:
+                            if os.read(fd, 1024 * 1024):
+                                continue
+                        except BlockingIOError:
+                            pass
+                        time.sleep(0.1)
+                finally:
+                    os.close(fd)
+
+        if os.path.lexists(path):
+            if self.args.verbose:
+                print('rm %s # remove local dump' % path)
+            os.remove(path)
+        super().cleanup_db(database)
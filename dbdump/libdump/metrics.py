@@ -0,0 +1,153 @@
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import collections
+import json
+import os
+import threading
+import time
+
+# Metrics written to the Prometheus textfile for every database: (name, key, help)
+GAUGES = [
+    ('dbdump_success', 'success', 'Whether the last dump of the database succeeded.'),
+    ('dbdump_duration_seconds', 'duration', 'Wall time of the last dump.'),
+    ('dbdump_raw_bytes', 'raw_bytes', 'Size of the last dump before compression.'),
+    ('dbdump_bytes', 'bytes', 'Size of the last dump as stored.'),
+    ('dbdump_throughput_bytes_per_second', 'throughput', 'Uncompressed bytes per second.'),
+    ('dbdump_compression_ratio', 'ratio', 'Uncompressed size divided by stored size.'),
+    ('dbdump_mysqldump_seconds', 'mysqldump_seconds',
+     'Wall time of mysqldump copying to spool-dir (mysql-hot-copy), not the lock time.'),
+]
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def labels(**kwargs):
+    return ','.join('%s="%s"' % (k, escape(v)) for k, v in sorted(kwargs.items()))
+
+
+class metrics:
+    """Record metrics of every dump as JSON lines and/or as Prometheus textfile.
+
+    Every call to :py:meth:`record` appends a line to ``jsonfile``. :py:meth:`write_textfile`
+    writes the metrics of the whole run to ``textfile`` in the format read by the textfile
+    collector of the Prometheus node exporter.
+    """
+
+    def __init__(self, section, jsonfile=None, textfile=None):
+        self.section = section
+        self.jsonfile = jsonfile
+        self.textfile = textfile
+        self.lock = threading.Lock()
+        self.records = []
+        self.started = time.time()
+        self.finished = None  # set by finish(), a run that is not finished ends now
+
+    def record(self, database, status, duration, stages=None, raw_bytes=None, stored_bytes=None,
+               mysqldump_seconds=None, error=None):
+        record = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'section': self.section,
+            'database': database,
+            'status': status,
+            'duration': round(duration, 3),
+        }
+        if stages:
+            record['stages'] = stages
+        if raw_bytes is not None:
+            record['raw_bytes'] = raw_bytes
+            if duration:
+                record['throughput'] = round(raw_bytes / duration, 1)
+        if stored_bytes is not None:
+            record['bytes'] = stored_bytes
+            if raw_bytes and stored_bytes:
+                record['ratio'] = round(raw_bytes / stored_bytes, 3)
+        if mysqldump_seconds is not None:
+            record['mysqldump_seconds'] = round(mysqldump_seconds, 3)
+        if error is not None:
+            record['error'] = error
+
+        with self.lock:
+            self.records.append(record)
+            if self.jsonfile is not None:
+                with open(self.jsonfile, 'a') as stream:
+                    stream.write('%s\n' % json.dumps(record, sort_keys=True))
+
+    def finish(self):
+        self.finished = time.time()
+
+    def write_textfile(self):
+        if self.textfile is not None:
+            write_textfile(self.textfile, [self])
+
+
+def write_textfile(path, runs):
+    """Write the metrics of ``runs`` (:py:class:`metrics` of different sections) to ``path``."""
+
+    lines = []
+    records = [r for run in runs for r in run.records if r['status'] in ['dumped', 'failed']]
+    not_uploaded = set((r['section'], r['database']) for run in runs for r in run.records
+                       if r['status'] == 'upload-failed')
+    for record in records:
+        record['success'] = 1 if record['status'] == 'dumped' and (
+            record['section'], record['database']) not in not_uploaded else 0
+
+    for name, key, help in GAUGES:
+        lines += ['# HELP %s %s' % (name, help), '# TYPE %s gauge' % name]
+        for record in records:
+            if key in record:
+                lines.append('%s{%s} %s' % (name, labels(section=record['section'],
+                                                         database=record['database']),
+                                            record[key]))
+
+    for name, key, help in [('dbdump_stage_duration_seconds', 'duration',
+                             'Wall time of a stage of the last dump.'),
+                            ('dbdump_stage_cpu_seconds', 'cpu',
+                             'CPU time of a stage (commands only) of the last dump.')]:
+        lines += ['# HELP %s %s' % (name, help), '# TYPE %s gauge' % name]
+        for record in records:
+            for stage, values in sorted(record.get('stages', {}).items()):
+                if values.get(key) is not None:
+                    lines.append('%s{%s} %s' % (name, labels(
+                        section=record['section'], database=record['database'], stage=stage),
+                        values[key]))
+
+    lines += ['# HELP dbdump_run_duration_seconds Wall time of the last run.',
+              '# TYPE dbdump_run_duration_seconds gauge']
+    lines += ['dbdump_run_duration_seconds{%s} %.3f' % (labels(section=run.section),
+                                                        (run.finished or time.time()) - run.started)
+              for run in runs]
+    lines += ['# HELP dbdump_last_run_timestamp_seconds Time the last run finished.',
+              '# TYPE dbdump_last_run_timestamp_seconds gauge']
+    lines += ['dbdump_last_run_timestamp_seconds{%s} %.0f' % (labels(section=run.section),
+                                                              run.finished or time.time())
+              for run in runs]
+
+    # Write to a temporary file first, so the node exporter never reads a partial file
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as stream:
+        stream.write('\n'.join(lines) + '\n')
+    os.rename(tmp, path)
+
+
+def write_textfiles(runs):
+    """Write the textfiles of ``runs``, runs sharing a textfile are written to the same file."""
+
+    paths = collections.OrderedDict()
+    for run in runs:
+        if run.textfile is not None:
+            paths.setdefault(run.textfile, []).append(run)
+    for path, shared in paths.items():
+        write_textfile(path, shared)
@@ -11,16 +11,30 @@
 # You should have received a copy of the GNU General Public License along with dbdump. If not,
 # see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import os
+import re
 import stat
 import sys
+import time
 from subprocess import PIPE
 from subprocess import Popen
 
 from libdump import backend
 
+# Engines that reliably update UPDATE_TIME in information_schema.TABLES whenever data changes.
+# InnoDB only does so with MySQL 5.7 or later (see get_fingerprints()).
+FINGERPRINT_ENGINES = {'MyISAM', 'Aria'}
+
 
 class mysql(backend.backend):
+    def __init__(self, section, args):
+        super().__init__(section, args)
+        self.jobs = section.getint('mysql-jobs')
+        self.hot_copy = section.getboolean('mysql-hot-copy')
+        self.metadata = {}  # cached by get_db_list()
+        self.copied = {}  # wall time of mysqldump in copy_db()
+        self.version = None  # cached by get_version()
 
     @property
     def defaults(self):
@@ -44,60 +58,270 @@ class mysql(backend.backend):
             print("Warning: %s: unsafe permissions (fix with '%s')"
                   % (self.defaults, cmd), file=sys.stderr)
 
+        super().prepare()
+
+    def query(self, query):
+        """Execute ``query`` and return a list of rows (each a list of strings)."""
+        cmd = ['mysql']
+        if self.defaults:
+            cmd.append('--defaults-file=%s' % self.defaults)
+        cmd += ['-NB', '--execute=%s' % query]
+        if self.args.verbose:
+            print(' '.join(cmd))
+
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            raise Exception(stderr.decode().strip("\n"))
+        return [line.split("\t") for line in stdout.decode('utf-8').splitlines()]
+
+    def get_replication_lag(self):
+        cmd = ['mysql']
+        if self.defaults:
+            cmd.append('--defaults-file=%s' % self.defaults)
+        cmd += ['--vertical', '--execute=SHOW SLAVE STATUS']
+
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            print("Warning: Unable to get replication lag: %s" % stderr.decode().strip("\n"),
+                  file=sys.stderr)
+            return None
+
+        for line in stdout.decode('utf-8').splitlines():
+            key, _, value = line.strip().partition(': ')
+            if key == 'Seconds_Behind_Master' and value != 'NULL':
+                return float(value)
+        return None  # not a replica or replication is not running
+
+    def get_version(self):
+        """Get the version of the server as tuple ``((major, minor), is_mariadb)``.
+
+        The version is ``(0, 0)`` if the server does not return one.
+        """
+
+        if self.version is None:
+            rows = self.query('SELECT VERSION()')
+            version = rows[0][0] if rows and rows[0] else ''
+            match = re.match(r'(\d+)\.(\d+)', version)
+            numbers = (int(match.group(1)), int(match.group(2))) if match else (0, 0)
+            self.version = numbers, 'mariadb' in version.lower()
+        return self.version
+
+    def get_metadata(self):
+        """Get engines, number of tables and size of all databases with a single query.
+
+        Tables listed in ``mysql-ignore-tables`` are not included.
+        """
+        ignored = ', '.join("'%s'" % t.replace("'", "''")
+                            for t in self.section['mysql-ignore-tables'].split())
+        query = "SELECT s.SCHEMA_NAME, t.ENGINE, COUNT(t.TABLE_NAME), SUM(t.DATA_LENGTH + t.INDEX_LENGTH), MAX(t.UPDATE_TIME), MAX(t.CREATE_TIME), SUM(t.TABLE_ROWS), SUM(t.AUTO_INCREMENT) FROM information_schema.SCHEMATA s LEFT JOIN information_schema.TABLES t ON t.TABLE_SCHEMA = s.SCHEMA_NAME AND t.TABLE_TYPE = 'BASE TABLE'"  # NOQA
+        if ignored:
+            query += " AND CONCAT(t.TABLE_SCHEMA, '.', t.TABLE_NAME) NOT IN (%s)" % ignored
+        query += ' GROUP BY s.SCHEMA_NAME, t.ENGINE'
+
+        # MySQL 8.0 caches the statistics in information_schema.TABLES for a day by default, they
+        # are only used for fingerprints (see skip-unchanged).
+        if self.section['skip-unchanged'] != 'no':
+            numbers, mariadb = self.get_version()
+            if not mariadb and numbers >= (8, 0):
+                query = 'SET SESSION information_schema_stats_expiry = 0; %s' % query
+
+        if self.args.verbose:
+            print('# get list of databases, engines and sizes:')
+        metadata = {}
+        for row in self.query(query):
+            database, engine, tables, size = row[:4]
+            data = metadata.setdefault(database, {'engines': [], 'tables': 0, 'size': 0,
+                                                  'changes': []})
+            data['changes'].append('\t'.join(row[1:]))
+            if engine != 'NULL':
+                data['engines'].append(engine)
+                data['tables'] += int(tables)
+                data['size'] += int(size) if size != 'NULL' else 0
+        return metadata
+
     def get_db_list(self):
         excluded = ['information_schema', 'performance_schema', 'lost+found']
-        cmd = ['/usr/bin/mysql', '--defaults-file=%s' % self.defaults,
-               '--execute=SHOW DATABASES', '-B', '-s']
-        if self.args.verbose:
-            print('%s # get list of databases' % ' '.join(cmd))
-        p_list = Popen(cmd, stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p_list.communicate()
-        databases = stdout.decode().strip("\n").split("\n")
-        p_list.wait()
+        try:
+            self.metadata = self.get_metadata()
+        except Exception as e:
+            raise Exception("Unable to get list of databases: %s " % e)
 
-        if p_list.returncode != 0:
-            raise Exception("Unable to get list of databases: %s "
-                            % (stderr.decode().strip("\n")))
+        return [db for db in sorted(self.metadata) if db not in excluded]
 
-        return [db for db in databases if db not in excluded]
+    def get_db_sizes(self):
+        return {db: data['size'] for db, data in self.metadata.items()}
 
-    def get_command(self, database):
-        # get list of ignored tables:
+    def get_fingerprints(self):
+        """Get fingerprints based on the metadata in information_schema.TABLES.
+
+        Only databases using engines that maintain UPDATE_TIME get a fingerprint, all other
+        databases are always dumped. MariaDB and MySQL before 5.7 do not maintain UPDATE_TIME for
+        InnoDB tables. TABLE_ROWS is only an estimate for InnoDB, so it might cause unnecessary
+        dumps, but it does not hide changes.
+        """
+
+        engines = set(FINGERPRINT_ENGINES)
+        if any('InnoDB' in data['engines'] for data in self.metadata.values()):
+            numbers, mariadb = self.get_version()
+            if not mariadb and numbers >= (5, 7):
+                engines.add('InnoDB')
+
+        # InnoDB tables have an UPDATE_TIME of NULL if they were not modified since the server was
+        # started, so the start time of the server is part of the fingerprint.
+        uptime = dict(self.query("SHOW GLOBAL STATUS LIKE 'Uptime'"))['Uptime']
+        started = int((time.time() - int(uptime)) / 60)  # minutes, to ignore small deviations
+
+        fingerprints = {}
+        for database, data in self.metadata.items():
+            if not set(data['engines']) <= engines:
+                continue
+            changes = '%s\n%s' % (started, '\n'.join(sorted(data['changes'])))
+            fingerprints[database] = hashlib.sha256(changes.encode('utf-8')).hexdigest()
+        return fingerprints
+
+    def get_ignored(self, database):
+        """Get list of ignored tables (as ``database.table``) for the given database."""
         ignored_tables = self.section['mysql-ignore-tables'].split()
-        ignored = [t for t in ignored_tables if t.startswith("%s." % database)]
+        return [t for t in ignored_tables if t.startswith("%s." % database)]
 
-        # assemble query for used engines in the database
-        engine_query = "select ENGINE from information_schema.TABLES WHERE TABLE_SCHEMA='%s' AND ENGINE != 'MEMORY'" % database  # NOQA
-        for table in ignored:
-            engine_query += " AND TABLE_NAME != '%s'" % table.split('.')[1]
-        engine_query += ' GROUP BY ENGINE'
+    def get_engines(self, database):
+        """Get the storage engines used by a database, not including ignored or MEMORY tables."""
+        if database not in self.metadata:
+            return []
+        return sorted(e for e in self.metadata[database]['engines'] if e != 'MEMORY')
 
-        engine_cmd = ['mysql']
+    def get_mydumper(self, database, types):
+        path = self.spool[database]
+        cmd = ['mydumper']
         if self.defaults:
-            engine_cmd.append('--defaults-file=%s' % self.defaults)
-        engine_cmd += ['-NB', "--execute=%s" % engine_query]
+            cmd.append('--defaults-file=%s' % self.defaults)
+        cmd += ['--database', database, '--outputdir', os.path.join(path, 'dump'),
+                '--threads', str(self.jobs), '--triggers']
+        if database == 'mysql':
+            cmd.append('--events')
+
+        rows = self.section.getint('mysql-chunk-rows')
+        if rows:
+            cmd += ['--rows', str(rows)]
+
+        ignored = self.get_ignored(database)
+        if ignored:
+            omit = os.path.join(path, 'ignored-tables')
+            with open(omit, 'w') as stream:
+                stream.write(''.join('%s\n' % table for table in ignored))
+            cmd += ['--omit-from-file', omit]
+
+        if types == ['InnoDB']:
+            # Release the global read lock as soon as all threads have started their transaction.
+            cmd.append('--trx-consistency-only')
+        # else: mydumper holds the global read lock until all non-InnoDB tables are dumped
+
+        return cmd
+
+    def get_extension(self, database):
+        if self.jobs:
+            return '.tar'
+        return ''
+
+    def copy_db(self, database):
+        """Copy a database with non-InnoDB tables to spool-dir, see mysql-hot-copy.
 
+        mysqldump locks all tables of the database (and only of this database) with
+        --lock-tables while it writes the uncompressed dump to local disk, the dump is
+        compressed, encrypted and stored afterwards. The wall time of mysqldump is recorded as
+        ``mysqldump_seconds``. It includes connecting and writing the file, so it is an upper bound
+        of the time the tables were locked, not the lock time itself.
+        """
+
+        path = os.path.join(self.make_spool(database), 'dump.sql')
+        cmd = self.get_mysqldump(database) + ['--lock-tables', '--comments',
+                                              '--result-file=%s' % path, database]
+        cmd = self.make_su(cmd)
         if self.args.verbose:
-            print('# get list of database engines:')
-            print(' '.join(engine_cmd))
+            print('%s # copy to spool-dir' % ' '.join(cmd))
+
+        start = time.time()
+        p = Popen(cmd)
+        p.communicate()
+        if p.returncode != 0:
+            self.cleanup_db(database)
+            raise Exception("mysqldump returned with exit code %s." % p.returncode)
 
-        p = Popen(engine_cmd, stdout=PIPE)
-        types = p.communicate()[0].decode('utf-8').strip().split("\n")
+        self.copied[database] = time.time() - start
+        if self.args.verbose:
+            print('# %s: mysqldump copied to spool-dir in %.1fs'
+                  % (database, self.copied[database]))
 
+    def prepare_db(self, database):
+        if not self.jobs:
+            if self.hot_copy and self.get_engines(database) not in ([], ['InnoDB']):
+                self.copy_db(database)
+            return
+
+        types = self.get_engines(database)
+
+        # Dump tables with parallel threads to a directory, which is then streamed as tar archive
+        self.make_spool(database)
+        cmd = self.make_su(self.get_mydumper(database, types))
+        if self.args.verbose:
+            print('%s # dump to directory' % ' '.join(cmd))
+
+        p = Popen(cmd)
+        p.communicate()
+        if p.returncode != 0:
+            self.cleanup_db(database)
+            raise Exception("mydumper returned with exit code %s." % p.returncode)
+
+    def prepare_restore(self, database, target):
+        self.query('CREATE DATABASE IF NOT EXISTS `%s`' % target.replace('`', '``'))
+
+    def get_restore_command(self, database, target):
+        cmd = ['mysql']
+        if self.defaults:
+            cmd.append('--defaults-file=%s' % self.defaults)
+        return cmd + [target]
+
+    def restore_path(self, database, target, path, jobs):
+        cmd = ['myloader']
+        if self.defaults:
+            cmd.append('--defaults-file=%s' % self.defaults)
+        cmd += ['--directory', path, '--database', target, '--overwrite-tables',
+                '--threads', str(jobs)]
+        self.call(self.make_su(cmd), 'load dumped directory')
+
+    def get_mysqldump(self, database):
         cmd = ['mysqldump', ]
         if self.defaults:
             cmd.append('--defaults-file=%s' % self.defaults)
         if database == 'mysql':
             cmd.append('-E')  # AFTER --defaults-file!
-        for table in ignored:
+        for table in self.get_ignored(database):
             cmd.append('--ignore-table="%s"' % table)
+        return cmd
 
-        if not types:
-            return
-        elif types == ['InnoDB']:
+    def get_command(self, database):
+        if self.jobs:
+            if database not in self.spool:
+                return
+            return ['tar', '-C', self.spool[database], '-cf', '-', 'dump']
+        if database in self.spool:  # copied by copy_db()
+            return ['cat', os.path.join(self.spool[database], 'dump.sql')]
+
+        types = self.get_engines(database)
+        cmd = self.get_mysqldump(database)
+        if types == ['InnoDB']:
             cmd += ['--single-transaction', '--quick']
         else:
             cmd.append('--lock-tables')
 
         cmd += ['--comments', database]
         return cmd
+
+    def dump(self, db, timestamp, done=None):
+        try:
+            return super().dump(db, timestamp, done=done)
+        finally:
+            if db in self.copied and db in self.stats:
+                self.stats[db]['mysqldump_seconds'] = self.copied.pop(db)
@@ -0,0 +1,373 @@
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import abc
+import os
+import shutil
+import signal
+import threading
+import time
+from subprocess import DEVNULL
+from subprocess import Popen
+
+BUFFER_SIZE = 1024 * 1024
+
+
+def copy(src, dst):
+    """Function for a :py:class:`filter` that just passes on the data (e.g. to count it)."""
+    shutil.copyfileobj(src, dst, BUFFER_SIZE)
+
+
+class reader:
+    """Wrap a binary file object to count the bytes read from it."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes += len(data)
+        return data
+
+    def readinto(self, buf):
+        length = self.stream.readinto(buf)
+        self.bytes += length or 0
+        return length
+
+    def close(self):
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class stage:
+    """Base class for a single stage of a :py:class:`pipeline`."""
+
+    def __init__(self, name, exception=Exception):
+        self.name = name
+        self.exception = exception  # exception class raised if this stage fails
+
+        self.started = None
+        self.ended = None
+        self.error = None
+        self.secondary = False  # True if the stage only failed because another stage failed
+
+    @property
+    def duration(self):
+        if self.started is None or self.ended is None:
+            return None
+        return self.ended - self.started
+
+    def kill(self):
+        pass
+
+
+class process(stage):
+    """A stage running an external command.
+
+    The process is only reaped while holding ``lock``, which :py:meth:`kill` also takes, so it
+    never sends a signal to a PID that was already reused by another process.
+    """
+
+    def __init__(self, cmd, name=None, exception=Exception):
+        super().__init__(name or os.path.basename(cmd[0]), exception=exception)
+        self.cmd = cmd
+        self.proc = None
+        self.cpu = None
+        self.killed = False
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return ' '.join(self.cmd)
+
+    def start(self, stdin, stdout):
+        self.started = time.time()
+        self.proc = Popen(self.cmd, stdin=stdin, stdout=DEVNULL if stdout is None else stdout)
+
+    def run(self):
+        # Wait until the process exited without reaping it, so that its PID is not reused yet
+        os.waitid(os.P_PID, self.proc.pid, os.WEXITED | os.WNOWAIT)
+        self.ended = time.time()
+
+        # Use wait4() directly to also get the CPU time used by the process
+        with self.lock:
+            pid, status, usage = os.wait4(self.proc.pid, 0)
+            if os.WIFSIGNALED(status):
+                self.proc.returncode = -os.WTERMSIG(status)
+            else:
+                self.proc.returncode = os.WEXITSTATUS(status)
+        self.cpu = usage.ru_utime + usage.ru_stime
+
+        code = self.proc.returncode
+        if code != 0:
+            self.error = '%s returned with exit code %s.' % (self.name, code)
+            self.secondary = self.killed or code == -signal.SIGPIPE
+
+    def kill(self):
+        # Popen.terminate() would poll() and might reap the process before run() does.
+        with self.lock:
+            if self.proc is not None and self.proc.returncode is None:
+                self.killed = True
+                try:
+                    os.kill(self.proc.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+
+class filter(stage):
+    """A stage processing data in-process.
+
+    ``func`` is called with a binary file object to read from and a file-like object to write to.
+    The number of bytes read is available as ``bytes`` afterwards.
+    """
+
+    def __init__(self, func, name, label=None):
+        super().__init__(name)
+        self.func = func
+        self.label = label or '[%s]' % name
+        self.src = None
+
+    def __str__(self):
+        return self.label
+
+    @property
+    def bytes(self):
+        return None if self.src is None else self.src.bytes
+
+    def start(self, stdin, stdout):
+        self.started = time.time()
+        self.src = reader(os.fdopen(stdin, 'rb') if isinstance(stdin, int) else stdin)
+        self.dst = os.fdopen(stdout, 'wb') if isinstance(stdout, int) else stdout
+
+    def call(self):
+        with self.src:
+            self.func(self.src, self.dst)
+
+    def run(self):
+        try:
+            self.call()
+            self.dst.close()
+        except Exception as e:
+            self.error = '%s: %s' % (self.name, e)
+            self.secondary = isinstance(e, BrokenPipeError)
+            if not isinstance(self.dst, sink_writer):
+                try:
+                    self.dst.close()  # so that the next stage sees EOF
+                except OSError:
+                    pass
+        self.ended = time.time()
+
+
+class source(filter):
+    """A first stage producing data in-process.
+
+    ``func`` is called with a file-like object to write to, e.g. to read files and verify them.
+    """
+
+    def start(self, stdin, stdout):
+        self.started = time.time()
+        self.dst = os.fdopen(stdout, 'wb') if isinstance(stdout, int) else stdout
+
+    def call(self):
+        self.func(self.dst)
+
+
+class sink_writer(abc.ABC):
+    """Base class for objects written to by a :py:class:`sink`.
+
+    Subclasses implement :py:meth:`write`. A :py:class:`filter` directly before the sink calls
+    :py:meth:`write` for every block it produces, otherwise the sink passes the read end of the
+    pipe to :py:meth:`copy`.
+    """
+
+    @abc.abstractmethod
+    def write(self, data):
+        """Write the bytes-like object ``data``, which is only valid until this method returns."""
+
+    def copy(self, src):
+        """Copy all data from the binary file object ``src`` until EOF."""
+
+        buf = bytearray(BUFFER_SIZE)
+        view = memoryview(buf)
+        while True:
+            length = src.readinto(buf)
+            if not length:
+                break
+            self.write(view[:length])
+
+    def close(self):
+        pass
+
+    def discard(self):
+        """Called instead of ``close()`` if the pipeline fails."""
+        pass
+
+
+class sink(stage):
+    """Final stage writing data to a :py:class:`sink_writer`.
+
+    If the previous stage is a :py:class:`filter`, it writes to the writer directly instead of
+    going through a pipe.
+    """
+
+    def __init__(self, writer, name='write', label=None):
+        super().__init__(name)
+        self.writer = writer
+        self.label = label or '[%s]' % name
+        self.fused = False
+
+    def __str__(self):
+        return self.label
+
+    def start(self, stdin, stdout):
+        self.started = time.time()
+        self.src = os.fdopen(stdin, 'rb')
+
+    def run(self):
+        try:
+            with self.src:
+                self.writer.copy(self.src)
+            self.writer.close()
+        except Exception as e:
+            self.error = '%s: %s' % (self.name, e)
+        self.ended = time.time()
+
+
+class pipeline:
+    """Run a chain of stages, each reading the output of the previous stage.
+
+    Stages are connected with OS pipes, so a slow stage blocks the stages before it instead of
+    buffering data in memory. Every stage is monitored: as soon as any stage fails, all processes
+    are terminated and :py:meth:`run` raises the exception of the stage that failed first (stages
+    only failing because of that, e.g. with SIGPIPE, are ignored).
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.lock = threading.Lock()
+        self.failed = False
+        self.monitors = []
+
+    def add(self, stage):
+        self.stages.append(stage)
+        return stage
+
+    def __str__(self):
+        return ' | '.join(str(s) for s in self.stages)
+
+    def abort(self):
+        with self.lock:
+            self.failed = True
+            for stage in self.stages:
+                stage.kill()
+
+    def monitor(self, stage, fused):
+        stage.run()
+        if fused is not None:
+            fused.started, fused.ended = stage.started, stage.ended
+        if stage.error is not None:
+            self.abort()
+
+    def start_stages(self):
+        stdin = None
+        for i, stage in enumerate(self.stages):
+            nxt = self.stages[i + 1] if i + 1 < len(self.stages) else None
+            next_stdin = stdout = None
+
+            if isinstance(stage, sink) and stage.fused:
+                continue
+            elif isinstance(stage, filter) and isinstance(nxt, sink):
+                nxt.fused = True
+                stdout = nxt.writer
+            elif nxt is not None:
+                next_stdin, stdout = os.pipe()
+
+            try:
+                with self.lock:
+                    if self.failed:
+                        raise Exception('Pipeline aborted.')
+                    stage.start(stdin, stdout)
+            except Exception:
+                for fd in (stdin, next_stdin, stdout):
+                    if isinstance(fd, int):
+                        os.close(fd)
+                raise
+
+            if isinstance(stage, process):  # the child process has its own copies now
+                for fd in (stdin, stdout):
+                    if isinstance(fd, int):
+                        os.close(fd)
+
+            fused = nxt if isinstance(nxt, sink) and nxt.fused else None
+            monitor = threading.Thread(target=self.monitor, args=(stage, fused))
+            monitor.start()
+            self.monitors.append(monitor)
+            stdin = next_stdin
+
+    def get_error(self):
+        """Get the exception of the stage that failed first, ``None`` if no stage failed."""
+
+        failed = sorted([s for s in self.stages if s.error is not None], key=lambda s: s.ended or 0)
+        primary = [s for s in failed if not s.secondary] or failed
+        if primary:
+            return primary[0].exception(primary[0].error)
+        return None
+
+    def run(self):
+        try:
+            self.start_stages()
+        except Exception as e:
+            self.abort()
+            for monitor in self.monitors:
+                monitor.join()
+
+            # A stage that already failed (e.g. a dump command exiting right away) is the reason
+            # why the remaining stages could not be started.
+            error = self.get_error()
+            if error is not None:
+                raise error
+            raise Exception('Could not start pipeline: %s' % e)
+
+        for monitor in self.monitors:
+            monitor.join()
+
+        error = self.get_error()
+        if error is not None:
+            raise error
+
+    def stats(self):
+        """Get a dictionary with the duration and CPU time of every stage that ran."""
+        stats = {}
+        for stage in self.stages:
+            if stage.duration is not None:
+                cpu = getattr(stage, 'cpu', None)
+                stats[stage.name] = {'duration': round(stage.duration, 3),
+                                     'cpu': None if cpu is None else round(cpu, 3)}
+        return stats
+
+    def timings(self):
+        """Get a string describing how long each stage ran."""
+        timings = []
+        for stage in self.stages:
+            if stage.duration is None:
+                continue
+            timing = '%s %.1fs' % (stage.name, stage.duration)
+            if getattr(stage, 'cpu', None) is not None:
+                timing += ' (cpu %.1fs)' % stage.cpu
+            timings.append(timing)
+        return ', '.join(timings)
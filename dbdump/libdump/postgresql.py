@@ -11,22 +11,87 @@
 # You should have received a copy of the GNU General Public License along with dbdump. If not,
 # see <http://www.gnu.org/licenses/>.
 
+import os
+import re
+import shlex
+import shutil
+import sys
 from subprocess import PIPE
 from subprocess import Popen
 
 from libdump import backend
+from libdump import pipeline
+
+# Name used for the dump of global objects (roles and tablespaces)
+GLOBALS = 'pg_globals'
+
+# Options of pg_dump selecting the server and user, they are also passed to pg_dumpall
+CONNECTION_OPTIONS = ['-h', '--host', '-p', '--port', '-U', '--username', '--role']
+CONNECTION_FLAGS = ['-w', '--no-password', '-W', '--password']
+
+# The DROP statements written by "pg_dump -c" are at the start of a dump, right after the header.
+HEADER_SIZE = 1024 * 1024
+DROP_RE = re.compile(rb'^DROP [^\n]*', re.MULTILINE)
+
+
+def get_connection_options(opts):
+    """Get the options in the list ``opts`` (e.g. ``['-h', 'db', '-Fc']``) that select the server
+    or the user, e.g. ``['-h', 'db']``."""
+
+    found = []
+    opts = list(opts)
+    while opts:
+        opt = opts.pop(0)
+        if opt in CONNECTION_OPTIONS:
+            found += [opt] + opts[:1]  # the value is the next argument
+            opts = opts[1:]
+        elif opt in CONNECTION_FLAGS:
+            found.append(opt)
+        elif opt.startswith('--') and opt.split('=', 1)[0] in CONNECTION_OPTIONS:
+            found.append(opt)  # e.g. --host=db
+        elif opt[:2] in CONNECTION_OPTIONS:
+            found.append(opt)  # e.g. -hdb
+    return found
+
+
+def stop_on_error(src, dst):
+    """Function for a :py:class:`~libdump.pipeline.filter` that makes psql stop at the first error
+    and roll back the whole restore, if the dump was written with "pg_dump -c --if-exists".
+
+    Dumps written by older versions of dbdump use "pg_dump -c" without --if-exists, so their DROP
+    statements fail if the database is empty. They are passed on unchanged and psql continues
+    after errors.
+    """
+
+    head = src.read(HEADER_SIZE)
+    drop = DROP_RE.search(head)
+    stop = drop is None or b' IF EXISTS ' in drop.group(0)
+    if stop:  # the same as "psql -v ON_ERROR_STOP=1 --single-transaction"
+        dst.write(b'\\set ON_ERROR_STOP on\nBEGIN;\n')
+    dst.write(head)
+    shutil.copyfileobj(src, dst, HEADER_SIZE)
+    if stop:
+        dst.write(b'\nCOMMIT;\n')
 
 
 class postgresql(backend.backend):
-    def get_db_list(self):
-        cmd = ['psql', '-Aqt', '-c', '"select datname from pg_database"']
+    def __init__(self, section, args):
+        super().__init__(section, args)
+        self.jobs = section.getint('postgresql-jobs')
+
+    def psql(self, query):
+        cmd = ['psql', '-Aqt', '-c', query]
 
         if 'postgresql-psql-opts' in self.section:
             cmd += self.section['postgresql-psql-opts'].split(' ')
 
         if 'su' in self.section:
             cmd = ['su', self.section['su'], '-s', '/bin/bash', '-c',
-                   ' '.join(cmd)]
+                   ' '.join(shlex.quote(c) for c in cmd)]
+        return cmd
+
+    def get_db_list(self):
+        cmd = self.psql('select datname from pg_database')
 
         p_list = Popen(cmd, stdout=PIPE, stderr=PIPE)
         stdout, stderr = p_list.communicate()
@@ -38,11 +103,139 @@ class postgresql(backend.backend):
             raise Exception("Unable to get list of databases: %s "
                             % (stderr.decode().strip("\n")))
 
+        if self.section.getboolean('postgresql-globals'):
+            databases.append(GLOBALS)
         return databases
 
-    def get_command(self, database):
-        cmd = ['pg_dump', '-c']
+    def get_db_sizes(self):
+        # pg_database_size() raises an error for databases we may not connect to
+        cmd = self.psql("select datname, case when has_database_privilege(datname, 'CONNECT') "
+                        "then pg_database_size(datname) end from pg_database")
+        if self.args.verbose:
+            print('%s # get database sizes' % ' '.join(cmd))
+
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            print("Warning: Unable to get database sizes: %s" % stderr.decode().strip("\n"),
+                  file=sys.stderr)
+            return {}
+
+        sizes = {}
+        for line in stdout.decode().splitlines():
+            database, size = line.rsplit('|', 1)
+            if size:
+                sizes[database] = int(size)
+        return sizes
+
+    def get_fingerprints(self):
+        # Tuple counters include changes to the system catalogs (i.e. DDL statements). Counters
+        # are reset when the server crashes, so the start time of the server is included as well.
+        cmd = self.psql("select datname, tup_inserted, tup_updated, tup_deleted, stats_reset, "
+                        "pg_postmaster_start_time() from pg_stat_database where datname is not null")
+        if self.args.verbose:
+            print('%s # get database fingerprints' % ' '.join(cmd))
+
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            print("Warning: Unable to get database fingerprints: %s"
+                  % stderr.decode().strip("\n"), file=sys.stderr)
+            return {}
+
+        fingerprints = {}
+        for line in stdout.decode().splitlines():
+            database, fingerprint = line.split('|', 1)
+            fingerprints[database] = fingerprint
+        return fingerprints
+
+    def get_replication_lag(self):
+        # The replay timestamp does not change if the primary is idle, so check the WAL position
+        cmd = self.psql("select case when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+                        "then 0 else extract(epoch from now() - pg_last_xact_replay_timestamp()) "
+                        "end where pg_is_in_recovery()")
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            print("Warning: Unable to get replication lag: %s" % stderr.decode().strip("\n"),
+                  file=sys.stderr)
+            return None
+
+        lag = stdout.decode().strip()
+        return float(lag) if lag else None
+
+    def get_pgdump(self, database):
+        cmd = ['pg_dump']
+        if self.jobs:
+            # NOTE: pg_dump requires that the output directory does not yet exist
+            cmd += ['-Fd', '-j', str(self.jobs), '-f',
+                    os.path.join(self.spool[database], 'dump')]
+        else:
+            cmd += ['-c', '--if-exists']
         if 'postgresql-pgdump-opts' in self.section:
             cmd += self.section['postgresql-pgdump-opts'].split(' ')
         cmd.append(database)
         return cmd
+
+    def get_extension(self, database):
+        if self.jobs and database != GLOBALS:
+            return '.tar'
+        return ''
+
+    def prepare_db(self, database):
+        if not self.jobs or database == GLOBALS:
+            return
+
+        # Dump to a directory using parallel jobs, the directory is then streamed as tar archive
+        self.make_spool(database)
+        cmd = self.make_su(self.get_pgdump(database))
+        if self.args.verbose:
+            print('%s # dump to directory' % ' '.join(cmd))
+
+        p = Popen(cmd)
+        p.communicate()
+        if p.returncode != 0:
+            self.cleanup_db(database)
+            raise Exception("pg_dump returned with exit code %s." % p.returncode)
+
+    def prepare_restore(self, database, target):
+        if database == GLOBALS:
+            return
+
+        cmd = self.psql("select 1 from pg_database where datname = '%s'"
+                        % target.replace("'", "''"))
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            raise Exception("Unable to get list of databases: %s" % stderr.decode().strip("\n"))
+        if not stdout.strip():
+            self.call(self.make_su(['createdb', target]), 'create database')
+
+    def get_restore_command(self, database, target):
+        cmd = ['psql', '-q']
+        if 'postgresql-psql-opts' in self.section:
+            cmd += self.section['postgresql-psql-opts'].split(' ')
+        return cmd + ['-d', 'postgres' if database == GLOBALS else target]
+
+    def get_restore_filter(self, database, target):
+        # The globals dump contains CREATE ROLE for every role, which fails for roles that already
+        # exist, so psql prints such errors but continues.
+        if database == GLOBALS:
+            return None
+        return pipeline.filter(stop_on_error, 'check',
+                               label='[stop at the first error if written with --if-exists]')
+
+    def restore_path(self, database, target, path, jobs):
+        cmd = ['pg_restore', '-c', '--if-exists', '-j', str(jobs), '-d', target, path]
+        self.call(self.make_su(cmd), 'restore dumped directory')
+
+    def get_command(self, database):
+        if database == GLOBALS:
+            # Dump the roles of the same server as the databases
+            cmd = ['pg_dumpall', '--globals-only']
+            if 'postgresql-pgdump-opts' in self.section:
+                cmd += get_connection_options(self.section['postgresql-pgdump-opts'].split(' '))
+            return cmd
+        elif self.jobs:
+            return ['tar', '-C', self.spool[database], '-cf', '-', 'dump']
+        return self.get_pgdump(database)
@@ -0,0 +1,363 @@
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import calendar
+import collections
+import functools
+import hashlib
+import io
+import os
+import shlex
+import subprocess
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from libdump import compress
+from libdump import dedup
+from libdump import pipeline
+from libdump import sink
+from libdump import verify
+
+BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def parse_checksums(data):
+    """Parse the content of a .sha256 file, returns a list of (checksum, filename)."""
+
+    checksums = []
+    for line in data.splitlines():
+        if line.strip():
+            checksum, name = line.split(None, 1)
+            checksums.append((checksum, name.strip().lstrip('*')))  # "*" marks binary files
+    return checksums
+
+
+class dump:
+    """A single dump of ``database`` in ``dirname``, described by the checksum file ``sidecar``."""
+
+    def __init__(self, database, dirname, timestamp, time, sidecar, checksums=None):
+        self.database = database
+        self.dirname = dirname
+        self.timestamp = timestamp
+        self.time = time
+        self.sidecar = sidecar
+        self.suffixes = verify.get_suffixes(sidecar[:-7])
+        self.checksums = checksums  # see restorer.read_checksums()
+
+    def __str__(self):
+        return os.path.join(self.dirname, self.sidecar[:-7])
+
+
+class restorer:
+    """Restore dumps written by dbdump for the backend of a section.
+
+    Dumps are found in the catalog (if configured) or by listing the datadir, locally or on the
+    remote host. Every dump is restored by a :py:class:`~libdump.pipeline.pipeline`: its files are
+    read and verified against their checksums while they are streamed to gpg, the decompression
+    (gzip uses multiple threads in-process) and finally the command of the backend loading the
+    dump. Directory dumps (.tar) are extracted to the spool-dir and then loaded with ``threads``
+    parallel jobs. Several dumps can be restored concurrently with :py:meth:`run`.
+    """
+
+    def __init__(self, backend, threads=0, verbose=False, dry_run=False):
+        self.backend = backend
+        self.section = backend.section
+        self.threads = threads or os.cpu_count() or 1
+        self.verbose = verbose
+        self.dry_run = dry_run
+
+        self.remote = self.section.get('remote')
+        self.location = self.remote or ''
+        self.datadir = os.path.abspath(self.section['datadir'])
+
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.restored = []
+        self.failed = []  # (dump, target, error) of failed restores
+        self.duration = 0.0
+
+    def ssh(self, cmd):
+        """Run ``cmd`` on the remote host, returns its output."""
+
+        cmd = self.backend.get_ssh_command(cmd)
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            error = stderr.decode().strip("\n") or 'ssh returned with exit code %s.' % p.returncode
+            raise Exception('%s: %s' % (self.remote, error))
+        return stdout.decode('utf-8')
+
+    def listdir(self, path):
+        if self.remote:
+            return self.ssh('test -d %s && ls -1 %s || true'
+                            % (shlex.quote(path), shlex.quote(path))).splitlines()
+        elif not os.path.isdir(path):
+            return []
+        return os.listdir(path)
+
+    def get_time(self, timestamp):
+        return calendar.timegm(time.strptime(timestamp, self.section['format']))
+
+    def get_databases(self):
+        """Get all databases with at least one dump."""
+
+        if self.backend.catalog is not None:
+            return sorted(set(row['database'] for row in
+                              self.backend.catalog.backups(self.location, self.datadir)))
+        return sorted(name for name in self.listdir(self.datadir) if not name.startswith('.'))
+
+    def get_dumps(self, database):
+        """Get all dumps of ``database``, oldest first."""
+
+        if self.backend.catalog is not None:
+            dumps = []
+            for row in self.backend.catalog.backups(self.location, self.datadir, database):
+                sidecar = [f for f in row['files'] if f.endswith('.sha256')][0]
+                checksums = None
+                if row['checksums'] is not None:
+                    checksums = parse_checksums(row['checksums'])
+                dumps.append(dump(database, os.path.join(row['datadir'], database),
+                                  row['timestamp'], row['time'], sidecar, checksums))
+            return dumps
+
+        dirname = os.path.join(self.datadir, database)
+        dumps = []
+        for name in self.listdir(dirname):
+            if name.startswith('.') or not name.endswith('.sha256'):
+                continue
+            path = name[:-7]
+            timestamp = path[:len(path) - len(''.join(verify.get_suffixes(path)))]
+            try:
+                stamp = self.get_time(timestamp)
+            except ValueError:  # not written by dbdump
+                continue
+            dumps.append(dump(database, dirname, timestamp, stamp, name))
+        return sorted(dumps, key=lambda d: d.time)
+
+    def find(self, database, timestamp=None):
+        """Get the newest dump of ``database`` or the one at ``timestamp``."""
+
+        dumps = self.get_dumps(database)
+        if timestamp is not None:
+            dumps = [d for d in dumps if d.timestamp == timestamp]
+        if not dumps:
+            raise Exception('%s: No dump found%s.' % (
+                database, '' if timestamp is None else ' at %s' % timestamp))
+        return dumps[-1]
+
+    def read_checksums(self, dump):
+        if dump.checksums is None:
+            path = os.path.join(dump.dirname, dump.sidecar)
+            if self.remote:
+                data = self.ssh('cat %s' % shlex.quote(path))
+            else:
+                with open(path) as stream:
+                    data = stream.read()
+            dump.checksums = parse_checksums(data)
+        return dump.checksums
+
+    def verify(self, dump):
+        """Verify all files of ``dump`` before restoring it, returns a list of errors."""
+
+        if self.remote:
+            try:
+                self.ssh('cd %s && sha256sum -c --quiet %s'
+                         % (shlex.quote(dump.dirname), shlex.quote(dump.sidecar)))
+            except Exception as e:
+                return [str(e)]
+            return []
+
+        verifier = verify.verifier(self.datadir, workers=1)
+        return verifier.verify(os.path.join(dump.dirname, dump.sidecar))
+
+    def read_parts(self, dump, dst):
+        """Write all files of ``dump`` to ``dst``, raises an exception if a checksum is wrong."""
+
+        buf = bytearray(BUFFER_SIZE)
+        view = memoryview(buf)
+        for checksum, name in self.read_checksums(dump):
+            path = os.path.join(dump.dirname, name)
+            sha = hashlib.sha256()
+            proc = None
+            if self.remote:
+                cmd = self.backend.get_ssh_command('cat %s' % shlex.quote(path))
+                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+                stream = proc.stdout
+            else:
+                stream = open(path, 'rb', buffering=0)
+
+            try:
+                with stream:
+                    while True:
+                        length = stream.readinto(buf)
+                        if not length:
+                            break
+                        sha.update(view[:length])
+                        dst.write(view[:length])
+                        with self.lock:
+                            self.bytes += length
+            except Exception:
+                if proc is not None:
+                    proc.kill()
+                    proc.wait()
+                raise
+
+            if proc is not None and proc.wait() != 0:
+                raise Exception('%s: ssh returned with exit code %s.' % (path, proc.returncode))
+            if sha.hexdigest() != checksum:
+                raise Exception('%s: checksum mismatch.' % path)
+
+    def read_chunk(self, base, checksum):
+        with open(dedup.get_chunk_path(base, checksum), 'rb') as stream:
+            data = stream.read()
+        with self.lock:
+            self.bytes += len(data)
+
+        data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        if hashlib.sha256(data).hexdigest() != checksum:
+            raise Exception('corrupt chunk %s' % checksum)
+        return data
+
+    def read_chunks(self, dump, dst):
+        """Write the content of a deduplicated ``dump`` to ``dst``.
+
+        Chunks are read and decompressed concurrently, every chunk is verified against its name.
+        """
+
+        index = io.BytesIO()
+        self.read_parts(dump, index)
+        base = os.path.dirname(dump.dirname)
+
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            for checksum in index.getvalue().decode('ascii').split():
+                pending.append(pool.submit(self.read_chunk, base, checksum))
+                if len(pending) >= self.threads * 2:
+                    dst.write(pending.popleft().result())
+
+            while pending:
+                dst.write(pending.popleft().result())
+
+    def get_file(self, path):
+        return None if self.dry_run else sink.plain_file(path)
+
+    def get_pipeline(self, dump, target, output=None):
+        """Get the pipeline restoring ``dump`` to ``target`` or writing it to ``output``.
+
+        Returns the pipeline, the :py:class:`~libdump.sink.plain_file` written by it (if any) and
+        the path to pass to :py:meth:`~libdump.backend.backend.restore_path` afterwards (if any).
+        """
+
+        restore = pipeline.pipeline()
+        suffixes = list(dump.suffixes)
+        files = ', '.join(name for checksum, name in self.read_checksums(dump))
+        if suffixes[-1:] == ['.idx']:
+            suffixes.pop()
+            restore.add(pipeline.source(functools.partial(self.read_chunks, dump), 'read',
+                                        label='[read %s and its chunks]' % files))
+        else:
+            restore.add(pipeline.source(functools.partial(self.read_parts, dump), 'read',
+                                        label='[read and verify %s]' % files))
+
+        if suffixes[-1:] == ['.gpg']:
+            suffixes.pop()
+            restore.add(pipeline.process(['gpg', '--batch', '--quiet', '--decrypt']))
+        if suffixes and suffixes[-1] in compress.EXTENSIONS:
+            codec = compress.EXTENSIONS[suffixes.pop()](threads=self.threads)
+            if isinstance(codec, compress.gzip):
+                restore.add(pipeline.filter(codec.decompress, 'gunzip',
+                                            label='[gunzip, %s threads]' % codec.threads))
+            else:
+                restore.add(pipeline.process(codec.decompress_command))
+
+        ext = ''.join(suffixes)  # '.tar' for directory dumps
+        if output is not None:
+            path = os.path.join(output, '%s-%s%s' % (target, dump.timestamp, ext))
+            out = self.get_file(path)
+            restore.add(pipeline.sink(out, label='[write %s]' % path))
+            return restore, out, None
+        elif ext == '.tar':
+            spool = self.backend.make_spool(target)
+            restore.add(pipeline.process(self.backend.make_su(['tar', '-C', spool, '-xf', '-'])))
+            return restore, None, os.path.join(spool, 'dump')
+
+        cmd = self.backend.get_restore_command(dump.database, target)
+        if cmd is not None:
+            check = self.backend.get_restore_filter(dump.database, target)
+            if check is not None:
+                restore.add(check)
+            restore.add(pipeline.process(self.backend.make_su(cmd)))
+            return restore, None, None
+
+        path = self.backend.get_restore_path(dump.database, target)
+        out = self.get_file(path)
+        restore.add(pipeline.sink(out, label='[write %s]' % path))
+        return restore, out, path
+
+    def restore(self, dump, target, output=None):
+        """Restore ``dump`` to the database ``target`` or write it to the directory ``output``."""
+
+        out = None
+        try:
+            if output is None and not self.dry_run:
+                self.backend.prepare_restore(dump.database, target)
+            restore, out, path = self.get_pipeline(dump, target, output=output)
+            if self.verbose or self.dry_run:
+                msg = '# Restore %s to %s:\n%s' % (dump, output or target, restore)
+                if path is not None and output is None:
+                    msg += '\n# then restore %s' % path
+                print(msg)
+            if self.dry_run:
+                return
+
+            start = time.time()
+            restore.run()
+            if path is not None and output is None:
+                self.backend.restore_path(dump.database, target, path, self.threads)
+            if self.verbose:
+                print('# %s: %s, %.1fs in total' % (target, restore.timings(),
+                                                    time.time() - start))
+        except Exception:
+            if out is not None:
+                out.discard()
+            raise
+        finally:
+            if output is None:
+                self.backend.cleanup_db(target)
+
+    def check(self, dump, target, output):
+        try:
+            self.restore(dump, target, output=output)
+        except Exception as e:
+            with self.lock:
+                self.failed.append((dump, target, str(e)))
+            print('FAILED: %s: %s' % (target, e))
+        else:
+            with self.lock:
+                self.restored.append(target)
+
+    def run(self, dumps, parallel=1, output=None):
+        """Restore a list of (dump, target), returns ``False`` if any restore failed."""
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            list(pool.map(lambda d: self.check(d[0], d[1], output), dumps))
+        self.duration = time.time() - start
+        return not self.failed
+
+    def stats(self):
+        return '%s databases (%.1f MB read) in %.1fs (%.1f MB/s), %s failed' % (
+            len(self.restored), self.bytes / 1048576, self.duration,
+            self.bytes / 1048576 / max(self.duration, 0.001), len(self.failed))
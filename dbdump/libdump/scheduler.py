@@ -0,0 +1,347 @@
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import collections
+import os
+import threading
+import time
+
+from libdump import metrics
+from libdump import state
+
+
+class scheduler:
+    """Dump the databases of a single section, see :py:class:`pool` for running the dumps.
+
+    Databases with a known size are dumped largest first, so that a large database does not end
+    up as the last dump of the run. Databases of unknown size follow in their original order. A
+    ``RuntimeError`` raised while dumping a database (e.g. SSH returning with exit code 255)
+    aborts all remaining work of the section, any other exception only skips the database in
+    question.
+
+    ``limits`` maps keys shared by several sections (e.g. ``('destination', host)``) to the
+    maximum number of concurrent dumps (0 for no limit). The section itself is limited to
+    ``parallel`` concurrent dumps.
+    """
+
+    def __init__(self, backend, timestamp, parallel=1, delay=0, sizes=None, rate=20, state=None,
+                 fingerprints=None, unchanged='no', metrics=None, limits=None):
+        self.backend = backend
+        self.metrics = metrics
+        self.timestamp = timestamp
+        self.parallel = max(parallel, 1)
+        self.delay = delay
+        self.sizes = sizes or {}
+        self.rate = rate * 1024 * 1024  # initial guess in bytes per second
+        self.limits = dict(limits or {})
+        self.limits[('section', backend.section.name)] = self.parallel
+
+        # skip or link databases that did not change since the last dump:
+        self.state = state
+        self.fingerprints = fingerprints or {}
+        self.unchanged = unchanged
+
+        self.aborted = threading.Event()
+        self.done = threading.Event()  # set by the pool once all dumps are finished
+        self.remaining = 0  # dumps not finished yet
+        self.lock = threading.Lock()
+        self.dumped_bytes = 0
+        self.dumped_seconds = 0.0
+
+    def order(self, databases):
+        known = sorted([db for db in databases if db in self.sizes],
+                       key=lambda db: self.sizes[db], reverse=True)
+        return known + [db for db in databases if db not in self.sizes]
+
+    def estimate(self, database):
+        """Estimated duration of a dump in seconds, ``None`` if the size is unknown."""
+
+        if database not in self.sizes:
+            return None
+
+        # Prefer the throughput observed so far in this run over the configured guess
+        with self.lock:
+            rate = self.rate
+            if self.dumped_seconds and self.dumped_bytes:
+                rate = self.dumped_bytes / self.dumped_seconds
+        return self.sizes[database] / rate
+
+    def is_unchanged(self, database):
+        """Decide if the database is unchanged since the last dump, returns a reason as well."""
+
+        if self.state is None:
+            return False, None
+        fingerprint = self.fingerprints.get(database)
+        if fingerprint is None:
+            return False, 'no fingerprint available'
+
+        previous = self.state.get(database)
+        if previous is None:
+            return False, 'no previous dump'
+        elif previous['fingerprint'] != fingerprint:
+            return False, 'changed since %s' % previous['timestamp']
+        return True, 'unchanged since %s' % previous['timestamp']
+
+    def get_callback(self, database, start):
+        """Get the function called once the dump of ``database`` is stored, see
+        :py:meth:`~libdump.backend.backend.dump`.
+
+        The state is only updated once the dump is uploaded, so a dump that never reached the
+        remote location is not considered by skip-unchanged.
+        """
+
+        def done(uploaded):
+            if not uploaded:
+                if self.metrics is not None:
+                    self.metrics.record(database, 'upload-failed', time.time() - start,
+                                        error='upload failed')
+            elif self.state is not None and database in self.fingerprints:
+                self.state.update(database, self.fingerprints[database], self.timestamp)
+        return done
+
+    def dump_db(self, database):
+        """Dump a single database, returns either "dumped", "skipped" or "linked"."""
+
+        start = time.time()
+        unchanged, reason = self.is_unchanged(database)
+        if unchanged:
+            previous = self.state.get(database)['timestamp']
+            if self.unchanged == 'link':
+                try:
+                    self.backend.link(database, previous, self.timestamp,
+                                      done=self.get_callback(database, start))
+                except RuntimeError:
+                    raise
+                except Exception as e:
+                    unchanged, reason = False, 'could not link previous dump: %s' % e
+                else:
+                    reason += ', linked previous dump'
+            else:
+                reason += ', skipped'
+
+        if reason is not None and self.backend.args.verbose:
+            print('# %s: %s' % (database, reason))
+
+        if unchanged:
+            if self.unchanged == 'link':
+                return 'linked'
+            return 'skipped'
+
+        self.backend.wait_until_idle()
+        self.backend.prepare_db(database)
+        try:
+            self.backend.dump(database, self.timestamp, done=self.get_callback(database, start))
+        finally:
+            self.backend.cleanup_db(database)
+        return 'dumped'
+
+    def record(self, database, status, start, error=None):
+        if self.metrics is not None:
+            self.metrics.record(database, status, time.time() - start, error=error,
+                                **self.backend.stats.pop(database, {}))
+
+    def dump(self, database):
+        """Dump ``database`` and report the result, returns ``True`` if it was dumped."""
+
+        estimate = self.estimate(database)
+        start = time.time()
+        try:
+            status = self.dump_db(database)
+        except RuntimeError as e:
+            print('%s: %s' % (database, e))
+            self.record(database, 'failed', start, error=str(e))
+            self.aborted.set()
+            return False
+        except Exception as e:
+            print('%s: %s' % (database, e))
+            self.record(database, 'failed', start, error=str(e))
+            return False
+
+        self.record(database, status, start)
+        if status != 'dumped':
+            return False
+        duration = time.time() - start
+
+        if database in self.sizes:
+            with self.lock:
+                self.dumped_bytes += self.sizes[database]
+                self.dumped_seconds += duration
+
+        if self.backend.args.verbose:
+            if estimate is None:
+                print('# %s: dumped in %.1fs' % (database, duration))
+            else:
+                print('# %s: dumped in %.1fs (%.1f MB, estimated %.1fs)'
+                      % (database, duration, self.sizes[database] / 1048576, estimate))
+        return True
+
+    def run(self, databases):
+        """Dump ``databases`` using ``parallel`` workers, returns ``False`` if aborted."""
+
+        workers = pool(self.parallel)
+        workers.add(self, databases)
+        workers.run()
+        return not self.aborted.is_set()
+
+
+class pool:
+    """Run the dumps of one or more :py:class:`scheduler` instances using shared worker threads.
+
+    At most ``workers`` databases are dumped at once. A worker takes the largest database (of any
+    section) whose dump would not exceed any of the limits of its scheduler, so sections with a
+    free slot are not held up by sections dumping to a busy destination.
+
+    :py:meth:`run` dumps all databases added so far and returns. :py:meth:`serve` instead starts
+    workers that keep waiting for dumps added later on, until :py:meth:`stop` is called. The
+    ``done`` event of a scheduler is set once all of its dumps are finished.
+    """
+
+    def __init__(self, workers):
+        self.workers = max(workers, 1)
+        self.limits = {}
+        self.running = collections.Counter()
+        self.cond = threading.Condition()
+        self.tasks = []  # (scheduler, database) in the order they should be dumped
+        self.serving = False
+        self.threads = []
+
+    def add(self, scheduler, databases):
+        with self.cond:
+            for key, limit in scheduler.limits.items():
+                if limit:  # sections sharing a key might set different limits, use the lowest
+                    self.limits[key] = min(self.limits.get(key, limit), limit)
+
+            databases = scheduler.order(databases)
+            scheduler.remaining += len(databases)
+            if not scheduler.remaining:
+                scheduler.done.set()
+
+            tasks = self.tasks + [(scheduler, db) for db in databases]
+            known = sorted([t for t in tasks if t[1] in t[0].sizes],
+                           key=lambda t: t[0].sizes[t[1]], reverse=True)
+            self.tasks = known + [t for t in tasks if t[1] not in t[0].sizes]
+            self.cond.notify_all()
+
+    def finished(self, scheduler):
+        """Called (with ``cond`` held) whenever a dump of ``scheduler`` is finished or dropped."""
+
+        scheduler.remaining -= 1
+        if scheduler.remaining <= 0:
+            scheduler.done.set()
+
+    def is_free(self, scheduler):
+        return all(self.running[key] < self.limits[key]
+                   for key in scheduler.limits if key in self.limits)
+
+    def get_task(self):
+        """Block until a dump can be started, returns ``None`` if there is nothing left to do."""
+
+        with self.cond:
+            while True:
+                for scheduler, database in self.tasks:
+                    if scheduler.aborted.is_set():
+                        self.finished(scheduler)
+                self.tasks = [t for t in self.tasks if not t[0].aborted.is_set()]
+                if not self.tasks and not self.serving:
+                    return None
+
+                for i, (scheduler, database) in enumerate(self.tasks):
+                    if self.is_free(scheduler):
+                        del self.tasks[i]
+                        self.running.update(scheduler.limits.keys())
+                        return scheduler, database
+                self.cond.wait()
+
+    def release(self, scheduler):
+        with self.cond:
+            self.running.subtract(scheduler.limits.keys())
+            self.finished(scheduler)
+            self.cond.notify_all()
+
+    def worker(self):
+        while True:
+            task = self.get_task()
+            if task is None:
+                return
+
+            scheduler, database = task
+            try:
+                dumped = scheduler.dump(database)
+            finally:
+                self.release(scheduler)
+
+            # Give the database server some rest before this worker starts the next dump.
+            if dumped and scheduler.delay and self.tasks:
+                scheduler.aborted.wait(scheduler.delay)
+
+    def run(self):
+        workers = [threading.Thread(target=self.worker, name='dump-%s' % i)
+                   for i in range(min(self.workers, len(self.tasks)))]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+    def serve(self):
+        self.serving = True
+        self.threads = [threading.Thread(target=self.worker, name='dump-%s' % i)
+                        for i in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """Stop the workers started by :py:meth:`serve` once all dumps added so far are done."""
+
+        with self.cond:
+            self.serving = False
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def get_status(self):
+        """Get the number of queued and running dumps."""
+
+        with self.cond:
+            return {'queued': len(self.tasks), 'running': sum(
+                count for key, count in self.running.items() if key[0] == 'section')}
+
+
+def get_scheduler(backend, now, limits=None):
+    """Get the :py:class:`scheduler` for a run of the section of ``backend`` started at ``now``
+    (a ``time.struct_time``), along with the databases to dump.
+
+    Exceptions raised while listing the databases (e.g. if the server is not reachable) are
+    passed on to the caller.
+    """
+
+    section = backend.section
+    databases = backend.get_db_list()
+    sizes = backend.get_db_sizes()
+
+    dump_state = fingerprints = None
+    if section['skip-unchanged'] != 'no':
+        fingerprints = backend.get_fingerprints()
+        dump_state = state.state(os.path.join(section['state-dir'], '%s.json' % section.name))
+
+    dump_metrics = None
+    if section['metrics-file'] or section['metrics-textfile']:
+        dump_metrics = metrics.metrics(section.name, jsonfile=section['metrics-file'] or None,
+                                       textfile=section['metrics-textfile'] or None)
+
+    dumper = scheduler(backend, time.strftime(section['format'], now),
+                       parallel=section.getint('parallel'), delay=section.getfloat('delay'),
+                       sizes=sizes, rate=section.getfloat('estimated-rate'), state=dump_state,
+                       fingerprints=fingerprints, unchanged=section['skip-unchanged'],
+                       metrics=dump_metrics, limits=limits)
+    return dumper, databases
@@ -0,0 +1,198 @@
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import re
+
+from libdump import pipeline
+
+BUFFER_SIZE = 1024 * 1024
+PART_SUFFIX = '.part%04d'
+PART_RE = re.compile(r'\.part[0-9]{4,}$')
+
+
+def previous_size(dirname, suffix):
+    """Get the size of the newest dump in ``dirname`` ending with ``suffix``, 0 if there is none.
+
+    The parts of a dump written by :py:class:`split_file` are counted as a single dump.
+    """
+
+    sizes = {}
+    mtimes = {}
+    try:
+        for entry in os.scandir(dirname):
+            name = PART_RE.sub('', entry.name)
+            if not name.endswith(suffix) or name.endswith('.sha256'):
+                continue
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            sizes[name] = sizes.get(name, 0) + stat.st_size
+            mtimes[name] = max(mtimes.get(name, 0), stat.st_mtime)
+    except OSError:
+        pass
+
+    if not sizes:
+        return 0
+    return sizes[max(mtimes, key=lambda name: mtimes[name])]
+
+
+class digest:
+    """Compute the sha256 checksum and size of the data passed on by a pipeline filter."""
+
+    def __init__(self):
+        self.sha = hashlib.sha256()
+        self.written = 0
+
+    def copy(self, src, dst):
+        while True:
+            block = src.read(BUFFER_SIZE)
+            if not block:
+                break
+            self.sha.update(block)
+            dst.write(block)
+            self.written += len(block)
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+
+class plain_file(pipeline.sink_writer):
+    """Write a file, it is removed again if the pipeline fails."""
+
+    def __init__(self, path):
+        self.path = path
+        self.written = 0
+        self.stream = open(path, 'wb')
+
+    def write(self, data):
+        self.stream.write(data)
+        self.written += len(data)
+
+    def close(self):
+        self.stream.close()
+
+    def discard(self):
+        self.stream.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class checksum_file(pipeline.sink_writer):
+    """Write a file and its sha256 checksum in a single pass.
+
+    The checksum is written to ``<path>.sha256`` in the format used by sha256sum when the file is
+    closed. If ``size`` is given, the file is preallocated to reduce fragmentation.
+    """
+
+    def __init__(self, path, size=0):
+        self.path = path
+        self.sha = hashlib.sha256()
+        self.written = 0
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+
+        if size:
+            try:
+                os.posix_fallocate(self.fd, 0, size)
+            except (AttributeError, OSError):  # not supported by platform or filesystem
+                pass
+
+    def write(self, data):
+        self.sha.update(data)
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+        self.written += len(data)
+
+    def close_file(self):
+        """Close the file without writing the checksum, returns the checksum."""
+
+        os.ftruncate(self.fd, self.written)  # drop any preallocated space
+        os.close(self.fd)
+        return self.sha.hexdigest()
+
+    def close(self):
+        checksum = self.close_file()
+        with open('%s.sha256' % self.path, 'w') as stream:
+            stream.write('%s  %s\n' % (checksum, os.path.basename(self.path)))
+
+    def discard(self):
+        try:
+            os.close(self.fd)
+        except OSError:  # already closed
+            pass
+
+        for path in [self.path, '%s.sha256' % self.path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class split_file(pipeline.sink_writer):
+    """Write a file in parts of ``split`` bytes and a manifest with the checksum of every part.
+
+    Parts are named ``<path>.part0000``, ``<path>.part0001`` and so on, concatenating them in order
+    yields the complete file. The manifest is written to ``<path>.sha256`` when the file is closed,
+    in the format used by sha256sum, so ``sha256sum -c`` verifies all parts.
+    """
+
+    def __init__(self, path, split, size=0):
+        self.path = path
+        self.split = split
+        self.size = size
+        self.written = 0
+        self.part = None
+        self.parts = []  # list of (path, checksum) of finished parts
+
+    def get_parts(self):
+        return [path for path, checksum in self.parts]
+
+    def open_part(self):
+        path = self.path + PART_SUFFIX % len(self.parts)
+        self.part = checksum_file(path, size=min(self.split, max(self.size - self.written, 0)))
+
+    def close_part(self):
+        self.parts.append((self.part.path, self.part.close_file()))
+        self.part = None
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self.part is None:
+                self.open_part()
+
+            length = min(len(view), self.split - self.part.written)
+            self.part.write(view[:length])
+            self.written += length
+            view = view[length:]
+
+            if self.part.written >= self.split:
+                self.close_part()
+
+    def close(self):
+        if self.part is not None or not self.parts:  # an empty dump still has one part
+            if self.part is None:
+                self.open_part()
+            self.close_part()
+
+        with open('%s.sha256' % self.path, 'w') as stream:
+            for path, checksum in self.parts:
+                stream.write('%s  %s\n' % (checksum, os.path.basename(path)))
+
+    def discard(self):
+        if self.part is not None:
+            self.part.discard()
+        for path in self.get_parts() + ['%s.sha256' % self.path]:
+            if os.path.exists(path):
+                os.remove(path)
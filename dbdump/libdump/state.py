@@ -0,0 +1,52 @@
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import threading
+
+
+class state:
+    """Persistent per-section state, stored as JSON file.
+
+    For every database, the state records the fingerprint and timestamp of the last successful
+    dump. The file is rewritten atomically after every update.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {}
+
+        if os.path.exists(path):
+            with open(path) as stream:
+                self.data = json.load(stream)
+
+    def get(self, database):
+        with self.lock:
+            return self.data.get(database)
+
+    def update(self, database, fingerprint, timestamp):
+        with self.lock:
+            self.data[database] = {'fingerprint': fingerprint, 'timestamp': timestamp}
+            self.save()
+
+    def save(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, 0o700)
+
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as stream:
+            json.dump(self.data, stream, indent=4, sort_keys=True)
+        os.rename(tmp, self.path)
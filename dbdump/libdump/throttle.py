@@ -0,0 +1,97 @@
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import sys
+import threading
+import time
+
+from libdump import compress
+
+CHECK_INTERVAL = 10  # seconds between two checks if the database server is busy
+
+
+class throttle:
+    """Limit the throughput of all dumps of a section and hold back new dumps while the server is
+    busy.
+
+    ``rate`` is the combined limit of all concurrent dumps in bytes per second. ``check`` is a
+    function returning a reason for not starting new dumps (e.g. a high replication lag) or
+    ``None``, ``resume`` is cleared while it returns a reason. Running dumps are never paused: a
+    dump that is not read keeps its locks (e.g. with --lock-tables) and the server drops the
+    connection once net_write_timeout is exceeded.
+    """
+
+    def __init__(self, rate=0, check=None, verbose=False):
+        self.rate = rate
+        self.check = check
+        self.verbose = verbose
+
+        self.lock = threading.Lock()
+        self.next = 0.0  # time when the next block may be passed on
+        self.resume = threading.Event()
+        self.resume.set()
+        self.stopped = threading.Event()
+
+    def __str__(self):
+        return '[throttle to %.1f MB/s]' % (self.rate / 1048576)
+
+    def monitor(self, stopped):
+        while not stopped.is_set():
+            try:
+                reason = self.check()
+            except Exception as e:
+                # Start new dumps rather than waiting for a check that might never succeed
+                print('Warning: Unable to check if the server is busy: %s' % e, file=sys.stderr)
+                reason = None
+            if reason is not None and self.resume.is_set():
+                if self.verbose:
+                    print('# not starting new dumps: %s' % reason)
+                self.resume.clear()
+            elif reason is None and not self.resume.is_set():
+                if self.verbose:
+                    print('# starting new dumps again')
+                self.resume.set()
+            stopped.wait(CHECK_INTERVAL)
+
+    def start(self):
+        # A new event for every run, so that a monitor of a previous run always stops
+        self.stopped = threading.Event()
+        if self.check is not None:
+            threading.Thread(target=self.monitor, args=(self.stopped, ), name='throttle',
+                             daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        self.resume.set()
+
+    def wait(self, length):
+        """Block until ``length`` bytes may be passed on."""
+
+        if not self.rate:
+            return
+
+        # Every block reserves its own time slot, so concurrent dumps share the rate.
+        with self.lock:
+            now = time.time()
+            start = max(self.next, now)
+            self.next = start + length / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+    def copy(self, src, dst):
+        while True:
+            block = src.read(compress.BLOCK_SIZE)
+            if not block:
+                break
+            self.wait(len(block))
+            dst.write(block)
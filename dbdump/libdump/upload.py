@@ -0,0 +1,222 @@
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import fcntl
+import glob
+import os
+import queue
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+from libdump import sink
+
+RETRY_DELAY = 30  # seconds, multiplied by the number of the attempt
+
+
+class uploader:
+    """Copy finished dumps from a local spool directory to the remote location.
+
+    Dumps are queued with :py:meth:`add` and uploaded by background threads using rsync over
+    SSH, so the database is released as soon as the dump is written to local disk. Failed uploads
+    are retried. rsync keeps partially transferred files in a hidden directory on the remote side,
+    so a retry resumes the transfer. Uploaded dumps are removed from the spool directory, dumps
+    that could not be uploaded are kept and uploaded by the next run.
+
+    Dumps written in parts (see split-size) are uploaded part by part, so several workers upload
+    parts of the same dump concurrently and an interrupted upload continues with the parts that
+    are still missing. The manifest is uploaded once all parts are uploaded.
+
+    The ``done`` function passed to :py:meth:`add` is called with ``True`` once the whole dump is
+    uploaded or with ``False`` once it failed, e.g. to record it in the catalog only after it
+    actually reached the remote location.
+    """
+
+    def __init__(self, backend, path, workers=1, retries=3):
+        self.backend = backend
+        self.path = path
+        self.workers = max(workers, 1)
+        self.retries = retries
+
+        self.queue = queue.Queue()
+        self.threads = []
+        self.lock = None
+        self.failed = []  # dumps that could not be uploaded
+
+        self.parts_lock = threading.Lock()
+        self.pending = {}  # number of parts of a split dump that still have to be uploaded
+        self.callbacks = {}  # done function of a split dump
+
+    def get_local_path(self, database, path):
+        """Local path for the remote ``path`` of a dump of ``database``."""
+        return os.path.join(self.path, database, os.path.basename(path))
+
+    def start(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, 0o700)
+
+        # Only one run may pick up dumps left over from previous runs.
+        self.lock = open(os.path.join(self.path, '.lock'), 'w')
+        try:
+            fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            print('Warning: %s: Used by another run, not resuming previous uploads.' % self.path,
+                  file=sys.stderr)
+        else:
+            self.resume()
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.worker, name='upload-%s' % i)
+            thread.start()
+            self.threads.append(thread)
+
+    def resume(self):
+        """Queue dumps left over from previous runs and remove incomplete ones."""
+
+        for database in sorted(os.listdir(self.path)):
+            dirname = os.path.join(self.path, database)
+            if database.startswith('.') or not os.path.isdir(dirname):
+                continue
+
+            # The checksum (or manifest) is written last, dumps without one failed.
+            names = sorted(os.listdir(dirname))
+            for name in names:
+                path = os.path.join(dirname, name)
+                if name.endswith('.sha256'):
+                    if self.backend.args.verbose:
+                        print('# %s: resume upload of %s' % (database, path[:-7]))
+                    self.add(database, path[:-7],
+                             done=self.backend.get_upload_callback(database, path[:-7]))
+                elif not os.path.exists('%s.sha256' % sink.PART_RE.sub('', path)):
+                    os.remove(path)
+            if not names:
+                os.rmdir(dirname)
+
+    def add(self, database, path, done=None):
+        if os.path.exists(path):
+            self.queue.put((database, [path, '%s.sha256' % path], None, done))
+            return
+
+        # A split dump, parts that were already uploaded have been removed.
+        parts = sorted(glob.glob('%s.part*' % glob.escape(path)))
+        if not parts:
+            self.queue.put((database, ['%s.sha256' % path], None, done))
+            return
+
+        with self.parts_lock:
+            self.pending[path] = len(parts)
+            self.callbacks[path] = done
+        for part in parts:
+            self.queue.put((database, [part], path, None))
+
+    def part_done(self, database, path, uploaded):
+        """Called after a part of the split dump ``path`` was uploaded (or failed to upload)."""
+
+        failed = None
+        with self.parts_lock:
+            if not uploaded:
+                if self.pending[path] is not None:
+                    failed = self.callbacks.pop(path)
+                self.pending[path] = None  # never upload the manifest
+            elif self.pending[path] is not None:
+                self.pending[path] -= 1
+                if self.pending[path] == 0:
+                    self.queue.put((database, ['%s.sha256' % path], None,
+                                    self.callbacks.pop(path)))
+
+        if failed is not None:
+            failed(False)
+
+    def get_command(self, database, files):
+        dirname = self.backend.get_dirname(database)
+        ssh = ' '.join(shlex.quote(arg) for arg in self.backend.get_ssh_options())
+        rsync_path = 'umask 077; mkdir -p %s && rsync' % shlex.quote(dirname)
+
+        # rsync transfers files in sorted order, so the checksum is only there if the dump is.
+        return ['rsync', '--partial-dir=.rsync-partial', '-e', ssh, '--rsync-path', rsync_path] \
+            + files + ['%s:%s/' % (self.backend.section['remote'], dirname)]
+
+    def upload(self, database, files):
+        """Upload ``files`` and remove them afterwards, returns ``False`` if the upload failed."""
+
+        cmd = self.get_command(database, files)
+        size = sum(os.path.getsize(path) for path in files)
+
+        for attempt in range(1, self.retries + 2):
+            if self.backend.args.verbose:
+                print('%s # upload dump' % ' '.join(cmd))
+
+            start = time.time()
+            code = subprocess.call(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+            duration = time.time() - start
+            if code == 0:
+                break
+            elif attempt > self.retries:
+                print('%s: Could not upload %s (rsync returned with exit code %s), keeping it '
+                      'for the next run.' % (database, files[0], code))
+                self.failed.append(files[0])
+                return False
+
+            print('%s: rsync returned with exit code %s, retrying in %ss.'
+                  % (database, code, RETRY_DELAY * attempt), file=sys.stderr)
+            time.sleep(RETRY_DELAY * attempt)
+
+        # The directory is kept, a dump of the same database may just be writing to it. Empty
+        # directories are removed by resume().
+        for path in reversed(files):  # remove the checksum first
+            os.remove(path)
+
+        if self.backend.args.verbose:
+            print('# %s: uploaded %s in %.1fs (%.1f MB/s)'
+                  % (database, os.path.basename(files[0]), duration,
+                     size / 1048576 / max(duration, 0.001)))
+        return True
+
+    def worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+
+            database, files, dump, done = job
+            try:
+                uploaded = self.upload(database, files)
+            except Exception as e:
+                print('%s: %s' % (database, e))
+                self.failed.append(files[0])
+                uploaded = False
+
+            try:
+                if dump is not None:
+                    self.part_done(database, dump, uploaded)
+                elif done is not None:
+                    done(uploaded)
+            except Exception as e:
+                print('%s: %s' % (database, e))
+            self.queue.task_done()
+
+    def finish(self):
+        """Wait until all queued dumps are uploaded, returns ``False`` if any upload failed."""
+
+        self.queue.join()  # workers queue the manifests of split dumps themselves
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        if self.lock is not None:
+            self.lock.close()
+        return not self.failed
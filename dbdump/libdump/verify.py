@@ -0,0 +1,224 @@
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import subprocess
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from libdump import compress
+from libdump import dedup
+
+BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def get_suffixes(path):
+    """Get the suffixes of a dump, e.g. ``['.tar', '.gz', '.gpg']`` for ``<ts>.tar.gz.gpg``."""
+
+    known = set(compress.EXTENSIONS) | {'.tar', '.gpg', '.idx'}
+    suffixes = []
+    base, ext = os.path.splitext(path)
+    while ext in known:
+        suffixes.insert(0, ext)
+        base, ext = os.path.splitext(base)
+    return suffixes
+
+
+class verifier:
+    """Verify dumps written by dbdump using the .sha256 files written along with every dump.
+
+    Every dump is read once. The data is hashed and, with ``decode``, also passed to gpg and the
+    decompression command, so that a dump that cannot be decrypted or decompressed is detected as
+    well. Dumps are verified concurrently by ``workers`` threads, hashlib and zlib release the GIL
+    while working on large buffers. Chunks of deduplicated dumps are checked to exist, with
+    ``decode`` they are decompressed and their checksum is verified as well (only once per run).
+    """
+
+    def __init__(self, datadir, workers=0, decode=False, verbose=False):
+        self.datadir = datadir
+        self.workers = workers or os.cpu_count() or 1
+        self.decode = decode
+        self.verbose = verbose
+
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.files = 0
+        self.chunks = {}  # chunks already verified, with the error if the chunk is corrupt
+        self.corrupt = []  # (path, errors) of corrupt dumps
+        self.dumps = 0
+        self.duration = 0.0
+
+    def find(self, since=None):
+        """Get the .sha256 files of all dumps, only those written after ``since`` if given."""
+
+        found = []
+        for entry in sorted(os.scandir(self.datadir), key=lambda e: e.name):
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            for dump in os.scandir(entry.path):
+                if dump.name.startswith('.') or not dump.name.endswith('.sha256'):
+                    continue
+                if since is None or dump.stat().st_mtime >= since:
+                    found.append(dump.path)
+        return sorted(found)
+
+    def get_decoder(self, suffixes):
+        """Get the commands to decode a dump, the last one reads the uncompressed dump."""
+
+        cmds = []
+        if suffixes and suffixes[-1] == '.gpg':
+            cmds.append(['gpg', '--batch', '--quiet', '--decrypt'])
+            suffixes = suffixes[:-1]
+        if suffixes and suffixes[-1] in compress.EXTENSIONS:
+            cmds.append(compress.EXTENSIONS[suffixes[-1]].decompress_command)
+            suffixes = suffixes[:-1]
+        if suffixes and suffixes[-1] == '.tar':
+            cmds.append(['tar', '-tf', '-'])
+        return cmds
+
+    def start(self, cmds):
+        """Start ``cmds`` connected by pipes, returns the list of processes."""
+
+        procs = []
+        for i, cmd in enumerate(cmds):
+            last = i == len(cmds) - 1
+            proc = subprocess.Popen(cmd, stdin=procs[-1].stdout if procs else subprocess.PIPE,
+                                    stdout=subprocess.DEVNULL if last else subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL)
+            if procs:
+                procs[-1].stdout.close()  # now only used by the new process
+            procs.append(proc)
+        return procs
+
+    def check_chunk(self, base, checksum):
+        """Check a chunk of a deduplicated dump, returns an error message or ``None``."""
+
+        with self.lock:
+            if checksum in self.chunks:
+                return self.chunks[checksum]
+
+        path = dedup.get_chunk_path(base, checksum)
+        error = None
+        if not os.path.exists(path):
+            error = 'missing chunk %s' % checksum
+        elif self.decode:
+            with open(path, 'rb') as stream:
+                data = stream.read()
+            try:
+                if hashlib.sha256(zlib.decompress(data, 16 + zlib.MAX_WBITS)).hexdigest() \
+                        != checksum:
+                    error = 'corrupt chunk %s' % checksum
+            except zlib.error as e:
+                error = 'corrupt chunk %s: %s' % (checksum, e)
+            with self.lock:
+                self.bytes += len(data)
+
+        with self.lock:
+            self.chunks[checksum] = error
+        return error
+
+    def verify(self, sidecar):
+        """Verify the dump described by ``sidecar``, returns a list of errors."""
+
+        dirname = os.path.dirname(sidecar)
+        with open(sidecar) as stream:
+            checksums = [line.split(None, 1) for line in stream if line.strip()]
+        if not checksums:
+            return ['empty checksum file']
+
+        suffixes = get_suffixes(sidecar[:-7])
+        procs = self.start(self.get_decoder(suffixes)) if self.decode else []
+        feed = procs[0].stdin if procs else None
+
+        errors = []
+        buf = bytearray(BUFFER_SIZE)
+        view = memoryview(buf)
+        for checksum, name in checksums:
+            name = name.strip().lstrip('*')  # sha256sum marks binary files with a "*"
+            path = os.path.join(dirname, name)
+            sha = hashlib.sha256()
+            try:
+                with open(path, 'rb', buffering=0) as stream:
+                    while True:
+                        length = stream.readinto(buf)
+                        if not length:
+                            break
+                        sha.update(view[:length])
+                        if feed is not None:
+                            try:
+                                feed.write(view[:length])
+                            except BrokenPipeError:  # decoder failed, checked below
+                                feed = None
+                        with self.lock:
+                            self.bytes += length
+            except OSError as e:
+                errors.append('%s: %s' % (name, e.strerror))
+                continue
+
+            with self.lock:
+                self.files += 1
+            if sha.hexdigest() != checksum:
+                errors.append('%s: checksum mismatch' % name)
+
+        if procs:
+            try:
+                procs[0].stdin.close()
+            except BrokenPipeError:
+                pass
+            failed = [p for p in procs if p.wait() != 0]
+            if failed:  # later commands usually only fail because the first one did
+                errors.append('%s returned with exit code %s'
+                              % (failed[0].args[0], failed[0].returncode))
+
+        if suffixes[-1:] == ['.idx'] and not errors:
+            base = os.path.dirname(dirname)
+            path = os.path.join(dirname, checksums[0][1].strip())
+            with open(path) as stream:
+                for line in stream:
+                    error = self.check_chunk(base, line.strip())
+                    if error is not None:
+                        errors.append(error)
+                        break
+        return errors
+
+    def check(self, sidecar):
+        try:
+            errors = self.verify(sidecar)
+        except Exception as e:
+            errors = [str(e)]
+
+        path = sidecar[:-7]
+        if errors:
+            with self.lock:
+                self.corrupt.append((path, errors))
+            print('CORRUPT: %s: %s' % (path, '; '.join(errors)))
+        elif self.verbose:
+            print('# %s: OK' % path)
+
+    def run(self, sidecars):
+        """Verify the dumps of all ``sidecars``, returns ``False`` if any dump is corrupt."""
+
+        self.dumps = len(sidecars)
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(self.check, sidecars))
+        self.duration = time.time() - start
+        return not self.corrupt
+
+    def stats(self):
+        return '%s dumps (%s files, %.1f MB) in %.1fs (%.1f MB/s), %s corrupt' % (
+            self.dumps, self.files, self.bytes / 1048576,
+            self.duration, self.bytes / 1048576 / max(self.duration, 0.001), len(self.corrupt))
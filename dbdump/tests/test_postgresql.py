@@ -0,0 +1,35 @@
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from libdump import postgresql
+
+
+class get_connection_options_test(unittest.TestCase):
+    def test_separate_values(self):
+        self.assertEqual(
+            postgresql.get_connection_options(['-h', 'db', '-p', '5433', '-Fc', '-U', 'backup']),
+            ['-h', 'db', '-p', '5433', '-U', 'backup'])
+
+    def test_attached_values(self):
+        self.assertEqual(
+            postgresql.get_connection_options(['--host=db', '-p5433', '--role=r', '-Z', '9']),
+            ['--host=db', '-p5433', '--role=r'])
+
+    def test_flags(self):
+        self.assertEqual(postgresql.get_connection_options(['-w', '--no-owner']), ['-w'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# This file is part of dbdump (https://github.com/mathiasertl/db-backup).
+#
+# dbdump is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dbdump is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with dbdump. If not,
+# see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from libdump import dedup
+from libdump import verify
+
+
+class verify_dedup_test(unittest.TestCase):
+    """Verify deduplicated dumps, their index files end with ``.idx``."""
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.datadir)
+        os.mkdir(os.path.join(self.datadir, 'db1'))
+        self.store = dedup.store(self.datadir, average=64)
+
+    def write_dump(self, name):
+        """Write a deduplicated dump called ``name``, returns the path of its checksum file."""
+
+        path = os.path.join(self.datadir, 'db1', name)
+        data = b''.join(b'INSERT INTO t VALUES (%d);\n' % i for i in range(1000))
+        with open(path, 'wb') as stream:
+            self.store.write(io.BytesIO(data), stream)
+        with open(path, 'rb') as stream:
+            checksum = hashlib.sha256(stream.read()).hexdigest()
+        with open('%s.sha256' % path, 'w') as stream:
+            stream.write('%s  %s\n' % (checksum, name))
+        return '%s.sha256' % path
+
+    def remove_chunk(self, sidecar):
+        with open(sidecar[:-7]) as stream:
+            checksum = stream.readline().strip()
+        os.remove(dedup.get_chunk_path(self.datadir, checksum))
+        return checksum
+
+    def assertMissingChunk(self, name):
+        sidecar = self.write_dump(name)
+        self.assertEqual(verify.verifier(self.datadir).verify(sidecar), [])
+
+        checksum = self.remove_chunk(sidecar)
+        self.assertEqual(verify.verifier(self.datadir).verify(sidecar),
+                         ['missing chunk %s' % checksum])
+
+    def test_idx(self):
+        self.assertMissingChunk('2019-01-01_00:00:00.idx')
+
+    def test_tar_idx(self):
+        # Directory dumps (see postgresql-jobs and mysql-jobs) are stored as tar archive
+        self.assertMissingChunk('2019-01-01_00:00:00.tar.idx')
+
+
+if __name__ == '__main__':
+    unittest.main()